@@ -0,0 +1,223 @@
+"""
+
+Local stand-in for the PxWeb API serving synthetic JSON-stat cubes
+
+A POST answers with a cube of exactly the posted query, every selected value
+becomes a category, so the cube size is chosen by the query. With `periods`
+set, time dimensions selecting more than one period are widened to that many
+periods ending at the last requested one, the config queries then produce
+cubes of any length. With `max_cells` set, larger queries are refused with
+403 like PxWeb refuses queries over its cell limit. A GET
+answers with a folder listing holding every table of the config directory.
+
+Run standalone to point the app at it:
+    python benchmarks/pxweb_stub.py --port 8765 --periods 120
+    PXWEB_BASE_URL=http://127.0.0.1:8765 python src/worker.py --once --full
+
+"""
+
+
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+CONFIG_DIR = os.path.join(SRC_DIR, '..', 'config')
+CRIME_DIMENSION = 'Rikosryhmä ja teonkuvauksen tarkenne'
+
+AREA_DIMENSIONS = ('Alue', 'Kunta')
+TIME_DIMENSIONS = ('Kuukausi', 'Vuosi')
+UPDATED = "2024-12-01T08:00:00Z"
+
+
+def widen_periods(values: List[str], periods: int) -> List[str]:
+    """
+
+    Args:
+        values (List[str]): Requested periods, `2023` or `2023M05`
+        periods (int): Number of periods to serve
+
+    Returns:
+        List[str]: The `periods` periods ending at the last requested one
+
+    """
+    last = max(values)
+    if 'M' in last:
+        year, month = last.split('M')
+        end = int(year) * 12 + int(month) - 1
+        return [f"{m // 12}M{m % 12 + 1:02d}"
+                for m in range(end - periods + 1, end + 1)]
+    return [str(year) for year in range(int(last) - periods + 1, int(last) + 1)]
+
+
+def table_ids(config_dir: str = CONFIG_DIR) -> List[str]:
+    ids = []
+    for path in sorted(glob.glob(os.path.join(config_dir, '*.json'))):
+        with open(path) as file:
+            table_id = json.load(file).get('tableIdForQuery')
+        if table_id:
+            ids.append(table_id)
+    return ids
+
+
+def config_labels(config_dir: str = CONFIG_DIR) -> Dict[str, Dict[str, str]]:
+    """
+
+    Returns:
+        Dict[str, Dict[str, str]]: Labels the safety rating matches on, the
+        crime categories of the config query in the order of CRIME_WEIGHTS
+        and the population of the demographics
+
+    """
+    from fetchers.safety_rating import CRIME_WEIGHTS, POPULATION_DESCRIPTION
+
+    with open(os.path.join(config_dir, 'crime_rate.json')) as file:
+        query = json.load(file)['queryObj']['query']
+    crimes = next(item['selection']['values'] for item in query
+                  if item['code'] == CRIME_DIMENSION)
+    return {CRIME_DIMENSION: dict(zip(crimes, CRIME_WEIGHTS)),
+            'Tiedot': {'vaesto': POPULATION_DESCRIPTION}}
+
+
+class PxWebStub:
+    """
+    Threaded HTTP server answering like PxWeb, usable as a context manager
+
+    Attributes:
+        url (str): Base URL to use as `PXWEB_BASE_URL`
+        periods (Optional[int]): Periods served for time dimensions selecting
+        several, None to serve the requested ones
+        labels (Dict[str, Dict[str, str]]): Dimension code to value labels,
+        values without one are labelled by their code, defaults to
+        config_labels()
+        max_cells (Optional[int]): Cell limit of one query, None for none
+        requests (int): Number of cubes served
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 periods: Optional[int] = None,
+                 labels: Optional[Dict[str, Dict[str, str]]] = None,
+                 updated: str = UPDATED, max_cells: Optional[int] = None):
+        self.periods = periods
+        self.max_cells = max_cells
+        self.labels = config_labels() if labels is None else labels
+        self.updated = updated
+        self.requests = 0
+        self.listing = json.dumps([
+            {"id": table_id, "type": "t", "text": table_id, "updated": updated}
+            for table_id in table_ids()]).encode()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                query = json.loads(self.rfile.read(length))
+                cube = stub.cube(query)
+                if stub.max_cells is not None \
+                        and len(cube['value']) > stub.max_cells:
+                    self._send(b'{"error": "Too many values selected"}', 403)
+                    return
+                self._send(json.dumps(cube).encode())
+
+            def do_GET(self):
+                self._send(stub.listing)
+
+            def _send(self, body: bytes, status: int = 200):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread: Optional[threading.Thread] = None
+
+    def label(self, dimension: str, value: str) -> str:
+        label = self.labels.get(dimension, {}).get(value)
+        if label is not None:
+            return label
+        if dimension in AREA_DIMENSIONS:
+            return "WHOLE COUNTRY" if value == 'SSS' else f"Area {value}"
+        return value
+
+    def cube(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        """
+
+        Args:
+            query (Dict[str, Any]): Posted PxWeb query
+
+        Returns:
+            Dict[str, Any]: JSON-stat dataset with one category per selected
+            value and deterministic integer values
+
+        """
+        self.requests += 1
+        ids, sizes, dimensions = [], [], {}
+        for item in query['query']:
+            code, values = item['code'], item['selection']['values']
+            if self.periods and code in TIME_DIMENSIONS and len(values) > 1:
+                values = widen_periods(values, self.periods)
+            ids.append(code)
+            sizes.append(len(values))
+            dimensions[code] = {"label": code, "category": {
+                "index": {value: i for i, value in enumerate(values)},
+                "label": {value: self.label(code, value) for value in values},
+            }}
+
+        cells = int(np.prod(sizes)) if sizes else 0
+        values = np.random.default_rng(cells).integers(1, 5000, cells)
+        return {"class": "dataset", "label": "benchmark", "source": "stub",
+                "updated": self.updated, "id": ids, "size": sizes,
+                "dimension": dimensions, "role": {},
+                "value": values.tolist()}
+
+    def start(self) -> 'PxWebStub':
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'PxWebStub':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--periods', type=int, default=None,
+                        help="Periods served for time dimensions")
+    parser.add_argument('--max-cells', type=int, default=None,
+                        help="Refuse queries selecting more cells")
+    args = parser.parse_args()
+
+    stub = PxWebStub(port=args.port, periods=args.periods,
+                     max_cells=args.max_cells)
+    print(f"Serving synthetic PxWeb cubes on {stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
@@ -0,0 +1,645 @@
+"""
+
+Benchmarks of the ingestion and query paths
+
+Stages, each run in a fresh process so its peak RSS is its own:
+    startup    import time and memory of the app, time until a started
+               server answers its first request
+    ingest     fetch_data, parse_data and save_data of synthetic cubes of
+               every size in --months, buffered and streamed
+    refresh    run_all_fetchers against the stand-in, seeding the database
+               the query stages read
+    resolvers  latency of every root field executed in process
+    load       latency percentiles of the HTTP endpoint under concurrent
+               clients, with the response cache disabled and enabled
+
+The report is JSON, given a baseline report the run fails when a metric got
+worse by more than the tolerance:
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --baseline before.json --tolerance 0.2
+
+"""
+
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from pxweb_stub import SRC_DIR, PxWebStub, widen_periods
+
+GRAPHQL_PATH = '/graphql/v1/city_insights'
+
+AREA_FIELDS = "area code demographics { description value } " \
+              "unemploymentRate { timeframe value } crimes { description value } " \
+              "safetyRating { value rank }"
+
+# root field to the document exercising it, $area is bound per execution
+QUERIES = {
+    "demographics": "query($area: String!) { demographics(area: $area) "
+                    "{ description value } }",
+    "unemploymentRate": "query($area: String!) { unemploymentRate(area: $area) "
+                        "{ timeframe value } }",
+    "unemploymentRateMonthly": "query($area: String!) { unemploymentRate("
+                               "area: $area, granularity: MONTH) "
+                               "{ timeframe value } }",
+    "trafficAccidents": "query($area: String!) { trafficAccidents(area: $area) "
+                        "{ timeframe description value } }",
+    "trafficAccidentsSum": "query($area: String!) { trafficAccidentsSum("
+                           "area: $area) { timeframe value } }",
+    "education": "query($area: String!) { education(area: $area) "
+                 "{ age description value } }",
+    "income": "query($area: String!) { income(area: $area) "
+              "{ description value } }",
+    "crimes": "query($area: String!) { crimes(area: $area) "
+              "{ description value } }",
+    "crimesQuarterly": "query($area: String!) { crimes(area: $area, "
+                       "granularity: QUARTER) { timeframe description value } }",
+    "safetyRating": "query($area: String!) { safetyRating(area: $area) "
+                    "{ value rank contributions { category weightedPer100k } } }",
+    "safetyRatings": "query { safetyRatings(limit: 20) { area value rank } }",
+    "ranking": "query { ranking(metric: UNEMPLOYMENT_RATE, limit: 10, "
+               "order: ASC) { rank area value } }",
+    "demographicsConnection": "query($area: String!) { demographicsConnection("
+                              "area: $area, first: 5) { totalCount "
+                              "edges { cursor node { description value } } } }",
+    "areaInsights": "query($area: String!) { areaInsights(areas: [$area]) "
+                    "{ " + AREA_FIELDS + " } }",
+}
+
+# metric name suffix to whether lower values are better, and the absolute
+# change below which a difference is noise
+METRIC_UNITS = {
+    '_per_s': (False, 0.0),
+    '_ms': (True, 0.5),
+    '_s': (True, 0.01),
+    '_mb': (True, 5.0),
+}
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+
+    Args:
+        samples (List[float]): Latencies in seconds
+
+    Returns:
+        Dict[str, float]: Percentiles, mean and max in milliseconds
+
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"p50_ms": at(0.50), "p90_ms": at(0.90), "p95_ms": at(0.95),
+            "p99_ms": at(0.99), "max_ms": round(ordered[-1] * 1000, 3),
+            "mean_ms": round(statistics.fmean(ordered) * 1000, 3)}
+
+
+def isolated(func: Callable[..., Dict[str, Any]], *args,
+             env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+
+    Runs the function in a fresh interpreter, the environment is applied
+    before it imports anything of the app
+
+    Args:
+        func (Callable[..., Dict[str, Any]]): Module level function to run
+        env (Optional[Dict[str, str]]): Environment variables to set
+
+    Returns:
+        Dict[str, Any]: What the function returned
+
+    """
+    saved = dict(os.environ)
+    os.environ.update(env or {})
+    try:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            return pool.apply(func, args)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def ingest_case(url: str, workdir: str, areas: int, months: int,
+                descriptions: int, stream: bool) -> Dict[str, Any]:
+    from fetchers.fetcher import Fetcher
+
+    start_rss = peak_rss_mb()
+    query = {"query": [
+        {"code": "Alue", "selection": {
+            "filter": "item", "values": [f"KU{i:03d}" for i in range(areas)]}},
+        {"code": "Kuukausi", "selection": {
+            "filter": "item", "values": widen_periods(["2024M12"], months)}},
+        {"code": "Tiedot", "selection": {
+            "filter": "item", "values": [f"d{i}" for i in range(descriptions)]}},
+    ], "response": {"format": "json-stat2"}}
+    cells = areas * months * descriptions
+    name = f"ingest_{cells}_{'stream' if stream else 'buffered'}"
+
+    config = os.path.join(workdir, f"{name}.json")
+    with open(config, 'w') as file:
+        json.dump({"queryObj": query, "tableIdForQuery": "bench.px"}, file)
+
+    db_name = os.path.join(workdir, f"{name}.sqlite3")
+    if os.path.exists(db_name):
+        os.remove(db_name)
+
+    fetcher = Fetcher(
+        api_url=f"{url}/PxWeb/api/v1/en/StatFin/bench/bench.px",
+        query_parameters_file=config,
+        db_name=db_name,
+        # same layout and indexes as the crime_rate table, in its own file
+        table_name='crime_rate',
+        area_path='Alue',
+        description_path='Tiedot',
+        timeframe_path='Kuukausi',
+        age_path='',
+        combinations_order=['area', 'timeframe', 'description'],
+        columns=['id', 'area', 'area_code', 'timeframe', 'description',
+                 'value', 'last_updated'],
+        stream=stream,
+    )
+
+    result: Dict[str, Any] = {"cells": cells}
+    if stream:
+        started = time.perf_counter()
+        fetcher.save_batches(fetcher.fetch_batches())
+        result["fetch_save_s"] = time.perf_counter() - started
+        total = result["fetch_save_s"]
+
+        # second run of the same cube only compares, nothing changed
+        started = time.perf_counter()
+        fetcher.save_batches(fetcher.fetch_batches())
+        result["resave_s"] = time.perf_counter() - started
+    else:
+        started = time.perf_counter()
+        data = fetcher.fetch_data()
+        result["fetch_s"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        df = fetcher.parse_data(data)
+        result["parse_s"] = time.perf_counter() - started
+        del data
+
+        started = time.perf_counter()
+        fetcher.save_data(df)
+        result["save_s"] = time.perf_counter() - started
+        total = result["fetch_s"] + result["parse_s"] + result["save_s"]
+
+        started = time.perf_counter()
+        fetcher.save_data(df)
+        result["resave_s"] = time.perf_counter() - started
+        result["parse_cells_per_s"] = cells / result["parse_s"]
+        result["save_cells_per_s"] = cells / result["save_s"]
+
+    result["cells_per_s"] = cells / total
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["rss_growth_mb"] = result["peak_rss_mb"] - start_rss
+    return {key: round(value, 4) if isinstance(value, float) else value
+            for key, value in result.items()}
+
+
+def refresh_case() -> Dict[str, Any]:
+    from fetchers import fetcher
+
+    started = time.perf_counter()
+    fetcher.run_all_fetchers(full=True)
+    seconds = time.perf_counter() - started
+
+    conn = sqlite3.connect(fetcher.DB_NAME)
+    try:
+        tables = [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%'")]
+        rows = {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+                for table in tables}
+    finally:
+        conn.close()
+
+    return {"refresh_s": round(seconds, 4), "peak_rss_mb": round(peak_rss_mb(), 2),
+            "database_mb": round(os.path.getsize(fetcher.DB_NAME) / 2 ** 20, 2),
+            "snapshot_mb": round(os.path.getsize(fetcher.SNAPSHOT_PATH) / 2 ** 20, 2),
+            "rows": rows}
+
+
+def resolvers_case(iterations: int) -> Dict[str, Any]:
+    import snapshot
+    from schema import get_context, schema
+
+    started = time.perf_counter()
+    areas = list(snapshot.current().areas)
+    load_s = time.perf_counter() - started
+
+    async def measure() -> Dict[str, Any]:
+        fields = {}
+        for field, query in QUERIES.items():
+            samples, errors = [], 0
+            for _ in range(iterations):
+                for area in areas:
+                    context = await get_context()
+                    started = time.perf_counter()
+                    result = await schema.execute(
+                        query, variable_values={"area": area},
+                        context_value=context)
+                    samples.append(time.perf_counter() - started)
+                    errors += bool(result.errors)
+            fields[field] = {**percentiles(samples), "errors": errors}
+        return fields
+
+    return {"areas": len(areas), "snapshot_load_s": round(load_s, 4),
+            "peak_rss_mb": round(peak_rss_mb(), 2),
+            "fields": asyncio.run(measure())}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def drive(url: str, areas: List[str], requests: int,
+                concurrency: int) -> Dict[str, Any]:
+    """
+
+    Args:
+        url (str): GraphQL endpoint
+        areas (List[str]): Areas the queries are spread over
+        requests (int): Number of requests to send
+        concurrency (int): Number of clients sending them
+
+    Returns:
+        Dict[str, Any]: Throughput, latency percentiles and failures
+
+    """
+    documents = list(QUERIES.values())
+    rng = random.Random(0)
+    plan = [{"query": rng.choice(documents),
+             "variables": {"area": rng.choice(areas)}} for _ in range(requests)]
+    samples, statuses, errors = [], Counter(), 0
+    position = 0
+
+    async def client(http: httpx.AsyncClient):
+        nonlocal position, errors
+        while position < len(plan):
+            body = plan[position]
+            position += 1
+            started = time.perf_counter()
+            response = await http.post(url, json=body)
+            samples.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+            errors += response.status_code != 200 or b'"errors"' in response.content
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        seconds = time.perf_counter() - started
+
+    return {"requests": requests, "concurrency": concurrency,
+            "seconds_s": round(seconds, 4),
+            "requests_per_s": round(requests / seconds, 2),
+            **percentiles(samples), "errors": errors,
+            "statuses": {str(status): count for status, count in statuses.items()}}
+
+
+class ApiServer:
+    """
+    API started with uvicorn in its own process, usable as a context manager
+
+    Attributes:
+        url (str): GraphQL endpoint
+        ready_s (float): Seconds from the start to the first answered request
+    """
+
+    def __init__(self, db_dir: str, cache_size: int = 1024):
+        port = free_port()
+        env = {**os.environ, "ODFLOW_DB_DIR": db_dir, "REFRESH_WORKER": "1",
+               "RATE_LIMIT": "1000000/minute",
+               "GRAPHQL_CACHE_SIZE": str(cache_size)}
+        self.url = f"http://127.0.0.1:{port}{GRAPHQL_PATH}"
+        started = time.perf_counter()
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+             '--log-level', 'warning'],
+            cwd=SRC_DIR, env=env, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        try:
+            self._wait()
+        except BaseException:
+            self.stop()
+            raise
+        self.ready_s = time.perf_counter() - started
+
+    def _wait(self):
+        deadline = time.monotonic() + 60
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("API failed to start: "
+                                   + self.process.stderr.read().decode()[-2000:])
+            try:
+                if httpx.post(self.url, json={"query": "{ __typename }"}
+                              ).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("API did not answer within 60s")
+            time.sleep(0.05)
+
+    def rss_mb(self) -> Optional[float]:
+        # resident memory of the serving process, Linux only
+        try:
+            with open(f"/proc/{self.process.pid}/status") as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        return round(int(line.split()[1]) / 1024, 2)
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+    def __enter__(self) -> 'ApiServer':
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def load_case(db_dir: str, areas: List[str], requests: int, concurrency: int,
+              cache_size: int) -> Dict[str, Any]:
+    with ApiServer(db_dir, cache_size) as server:
+        # one pass over every document first, later passes are steady state
+        asyncio.run(drive(server.url, areas, min(requests, 200), concurrency))
+        return asyncio.run(drive(server.url, areas, requests, concurrency))
+
+
+# run by a bare interpreter, the benchmark's own imports would distort it
+IMPORT_SCRIPT = """
+import json, resource, sys, time
+started = time.perf_counter()
+import main
+import_s = time.perf_counter() - started
+import_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+main.snapshot.current()
+snapshot_s = time.perf_counter() - started
+print(json.dumps({
+    "import_s": import_s, "import_rss": import_rss, "snapshot_load_s": snapshot_s,
+    "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    "ingestion_loaded": any(name in sys.modules for name in
+                            ("pandas", "requests", "fetchers.fetcher")),
+}))
+"""
+
+
+def import_case(db_dir: str) -> Dict[str, Any]:
+    env = {**os.environ, "ODFLOW_DB_DIR": db_dir, "REFRESH_WORKER": "1"}
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=SRC_DIR,
+                            env=env, capture_output=True, text=True, check=True)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    # kilobytes on Linux, bytes on macOS
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {"import_s": round(result["import_s"], 4),
+            "import_rss_mb": round(result["import_rss"] / unit, 2),
+            "snapshot_load_s": round(result["snapshot_load_s"], 4),
+            "peak_rss_mb": round(result["peak_rss"] / unit, 2),
+            "modules": result["modules"],
+            # the request path must not load the ingestion stack
+            "ingestion_loaded": result["ingestion_loaded"]}
+
+
+def startup_case(db_dir: str, repeat: int) -> Dict[str, Any]:
+    """
+
+    Args:
+        db_dir (str): Data directory of the API
+        repeat (int): Cold starts to measure, the fastest is kept
+
+    Returns:
+        Dict[str, Any]: Import time and memory of the app in a fresh
+        interpreter, and the time until a started server answers
+
+    """
+    result = min((import_case(db_dir) for _ in range(repeat)),
+                 key=lambda run: run["import_s"])
+    ready, rss = [], None
+    for _ in range(repeat):
+        with ApiServer(db_dir) as server:
+            ready.append(server.ready_s)
+            rss = server.rss_mb()
+    result["server_ready_s"] = round(min(ready), 4)
+    if rss is not None:
+        result["server_rss_mb"] = rss
+    return result
+
+
+def snapshot_areas() -> List[str]:
+    import snapshot
+
+    return list(snapshot.current().areas)
+
+
+def flatten(report: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    metrics = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any],
+            tolerance: float) -> List[Dict[str, Any]]:
+    """
+
+    Args:
+        report (Dict[str, Any]): Report of this run
+        baseline (Dict[str, Any]): Report to compare against
+        tolerance (float): Relative change tolerated, 0.2 allows 20% worse
+
+    Returns:
+        List[Dict[str, Any]]: Every metric present in both reports with its
+        change, regressions flagged
+
+    """
+    current = flatten({k: v for k, v in report.items() if k != 'meta'})
+    previous = flatten({k: v for k, v in baseline.items()
+                        if k not in ('meta', 'comparison')})
+    rows = []
+    for name in sorted(current.keys() & previous.keys()):
+        new, old = current[name], previous[name]
+        leaf = name.rsplit('.', 1)[-1]
+        if leaf == 'errors':
+            regression = new > old
+        else:
+            unit = next((u for u in METRIC_UNITS if leaf.endswith(u)), None)
+            if unit is None:
+                continue
+            lower_is_better, noise = METRIC_UNITS[unit]
+            worse = new - old if lower_is_better else old - new
+            regression = worse > abs(old) * tolerance and worse > noise
+        change = (new - old) / old if old else None
+        rows.append({"metric": name, "baseline": old, "current": new,
+                     "change": round(change, 4) if change is not None else None,
+                     "regression": regression})
+    return rows
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages',
+                        default='startup,ingest,refresh,resolvers,load',
+                        help="Comma separated stages to run")
+    parser.add_argument('--months', default='12,120,600',
+                        help="Comma separated months of the ingest cubes")
+    parser.add_argument('--areas', type=int, default=310,
+                        help="Areas of the ingest cubes")
+    parser.add_argument('--descriptions', type=int, default=4,
+                        help="Descriptions of the ingest cubes")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs of every ingest case and cold start, the "
+                             "fastest is kept")
+    parser.add_argument('--periods', type=int, default=None,
+                        help="Periods of the time-series tables of the seeded "
+                             "database, the config queries by default")
+    parser.add_argument('--iterations', type=int, default=3,
+                        help="Executions of every resolver per area")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="Requests per load run")
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help="Concurrent clients per load run")
+    parser.add_argument('--output', help="Report file, printed when omitted")
+    parser.add_argument('--baseline', help="Report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Relative slowdown counted as a regression")
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the working directory with the databases")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    workdir = tempfile.mkdtemp(prefix='odflow-bench-')
+    db_dir = os.path.join(workdir, 'db')
+    os.makedirs(db_dir)
+
+    report: Dict[str, Any] = {"meta": {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }}
+
+    try:
+        with PxWebStub(periods=args.periods) as stub:
+            if 'ingest' in stages:
+                report["ingest"] = {}
+                for months in [int(m) for m in args.months.split(',')]:
+                    cells = args.areas * months * args.descriptions
+                    # best of the repeats, single runs of small cubes are noisy
+                    report["ingest"][f"cells_{cells}"] = {
+                        mode: max((isolated(ingest_case, stub.url, workdir,
+                                            args.areas, months, args.descriptions,
+                                            mode == 'stream')
+                                   for _ in range(args.repeat)),
+                                  key=lambda run: run["cells_per_s"])
+                        for mode in ('buffered', 'stream')}
+                    print(f"[✓] ingest {cells} cells", file=sys.stderr)
+
+            if stages != ['ingest']:
+                report["refresh"] = isolated(
+                    refresh_case,
+                    env={"PXWEB_BASE_URL": stub.url, "ODFLOW_DB_DIR": db_dir})
+                print(f"[✓] refresh {report['refresh']['refresh_s']}s",
+                      file=sys.stderr)
+
+        env = {"ODFLOW_DB_DIR": db_dir}
+        if 'startup' in stages:
+            report["startup"] = startup_case(db_dir, args.repeat)
+            print(f"[✓] startup {report['startup']['import_s']}s", file=sys.stderr)
+
+        if 'resolvers' in stages:
+            report["resolvers"] = isolated(resolvers_case, args.iterations, env=env)
+            print("[✓] resolvers", file=sys.stderr)
+
+        if 'load' in stages:
+            areas = isolated(snapshot_areas, env=env)
+            report["load"] = {
+                name: load_case(db_dir, areas, args.requests, args.concurrency,
+                                cache_size)
+                for name, cache_size in (('uncached', 0), ('cached', 1024))}
+            print("[✓] load", file=sys.stderr)
+    finally:
+        if args.keep:
+            print(f"Working directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            rows = compare(report, json.load(file), args.tolerance)
+        report["comparison"] = {"baseline": args.baseline,
+                                "tolerance": args.tolerance, "metrics": rows}
+        regressions = [row for row in rows if row["regression"]]
+        for row in regressions:
+            print(f"[!] {row['metric']}: {row['baseline']} -> {row['current']}",
+                  file=sys.stderr)
+        print(f"{len(regressions)} regressions in {len(rows)} compared metrics",
+              file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
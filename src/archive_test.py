@@ -0,0 +1,155 @@
+import glob
+import json
+import os
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from fetchers.archive import RawArchive
+
+FIRST, SECOND, THIRD = ("2024-01-01T00:00:00", "2024-02-01T00:00:00",
+                        "2024-03-01T00:00:00")
+
+
+def objects(archive: RawArchive) -> list:
+    return glob.glob(os.path.join(archive.objects_dir, '*'))
+
+
+def test_directories_are_created_with_the_first_response(tmp_path):
+    archive = RawArchive(str(tmp_path / "archive"))
+    assert not os.path.exists(archive.directory)
+    assert archive.entries("income") == []
+    assert archive.find({"query": []}) is None
+    assert archive.collect_garbage() == 0
+
+    archive.store("income", {"query": []}, b"{}", fetched_at=FIRST)
+    assert len(objects(archive)) == 1
+
+
+def test_identical_bodies_are_stored_once(tmp_path):
+    archive = RawArchive(str(tmp_path))
+    first = archive.store("income", {"query": [1]}, b'{"value": [1]}',
+                          fetched_at=SECOND)
+    second = archive.store("income", {"query": [2]}, b'{"value": [1]}',
+                           fetched_at=FIRST)
+
+    assert first == second and len(objects(archive)) == 1
+    assert [entry['query'] for entry in archive.entries("income")] == \
+        [{"query": [2]}, {"query": [1]}]
+    entry = archive.find({"query": [1]})
+    assert entry['table'] == "income" and entry['fetched_at'] == SECOND
+    assert b"".join(archive.read(entry)) == b'{"value": [1]}'
+
+
+def test_failed_response_is_not_archived(tmp_path):
+    archive = RawArchive(str(tmp_path))
+    entry = archive.open("income", {"query": []}, fetched_at=FIRST)
+
+    def chunks():
+        yield b'{"value": '
+        raise ConnectionError("response cut off")
+
+    with pytest.raises(ConnectionError):
+        for _ in entry.tee(chunks()):
+            pass
+    entry.discard()
+
+    assert objects(archive) == [] and archive.entries("income") == []
+
+
+def test_full_fetch_prunes_older_responses(tmp_path):
+    archive = RawArchive(str(tmp_path))
+    archive.store("income", {"query": [1]}, b"old", fetched_at=FIRST)
+    archive.store("income", {"query": [2]}, b"shared", fetched_at=FIRST)
+    archive.store("education", {"query": [3]}, b"shared", fetched_at=FIRST)
+    archive.store("income", {"query": [4]}, b"new", fetched_at=SECOND)
+
+    # a fetch that was not archived keeps everything
+    assert archive.prune("income", THIRD) == 0
+    assert archive.prune("income", SECOND) == 2
+
+    assert [entry['query'] for entry in archive.entries("income")] == \
+        [{"query": [4]}]
+    assert len(archive.entries("education")) == 1
+    assert archive.collect_garbage() == 1
+    assert len(objects(archive)) == 2
+
+
+def cube(values: list) -> bytes:
+    dimensions = {
+        "Tiedot": ["palk", "ltva"],
+        "Vuosi": ["2023"],
+        "Alue": ["KU091", "KU049"],
+    }
+    return json.dumps({
+        "class": "dataset",
+        "id": list(dimensions),
+        "size": [len(codes) for codes in dimensions.values()],
+        "dimension": {
+            code: {"category": {
+                "index": {value: i for i, value in enumerate(codes)},
+                "label": {value: f"Label {value}" for value in codes}}}
+            for code, codes in dimensions.items()},
+        "value": values,
+    }).encode()
+
+
+def rows(fetcher) -> list:
+    conn = sqlite3.connect(fetcher.db_name)
+    try:
+        return conn.execute(
+            "SELECT area, area_code, description, value, last_updated "
+            "FROM income ORDER BY area_code, description").fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def income(make_fetcher, tmp_path, monkeypatch):
+    archive = RawArchive(str(tmp_path / "archive"))
+    fetcher = make_fetcher("Income fetcher", archive=archive)
+    remote = {}
+    monkeypatch.setattr(fetcher, "remote_updated",
+                        lambda session=None: remote['updated'])
+    monkeypatch.setattr(fetcher, "post", lambda http, query, stream=False:
+                        SimpleNamespace(content=remote['body']))
+
+    def fetch(updated: str, values: list):
+        remote.update(updated=updated, body=cube(values))
+        assert fetcher.fetch_parse_save(full=True)
+
+    return fetcher, fetch
+
+
+def test_replay_rebuilds_the_table_without_requests(income, make_fetcher,
+                                                    tmp_path):
+    fetcher, fetch = income
+    fetch("2024-11-01T08:00:00Z", [1, 2, 3, 4])
+    fetch("2024-12-01T08:00:00Z", [1, 2, 3, 5])
+
+    replayed = make_fetcher("Income fetcher", archive=fetcher.archive,
+                            db_name=str(tmp_path / "replayed.sqlite3"),
+                            api_url="http://unreachable.invalid/table.px")
+    assert replayed.replay()
+
+    # the live table keeps the fetch time of unchanged cells, the replay
+    # stamps every cell with the response it was decoded from
+    assert [row[:4] for row in rows(replayed)] == \
+        [row[:4] for row in rows(fetcher)]
+    assert [row[3] for row in rows(replayed)] == [5, 2, 3, 1]
+    # the body of the first fetch is no longer referenced
+    assert fetcher.archive.collect_garbage() == 1
+    assert replayed.replay()
+
+
+def test_replay_skips_responses_of_another_config(income, make_fetcher,
+                                                  tmp_path):
+    fetcher, fetch = income
+    fetch("2024-11-01T08:00:00Z", [1, 2, 3, 4])
+
+    replayed = make_fetcher("Income fetcher", archive=fetcher.archive,
+                            db_name=str(tmp_path / "replayed.sqlite3"))
+    replayed.query_parameters['query'][0]['selection']['values'].pop()
+
+    assert not replayed.replay()
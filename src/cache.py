@@ -0,0 +1,326 @@
+"""
+
+Module for automatic persisted queries and the GraphQL response cache
+
+"""
+
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+PERSISTED_QUERY_NOT_FOUND = {
+    "errors": [{
+        "message": "PersistedQueryNotFound",
+        "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"},
+    }]
+}
+
+
+class LRUCache:
+    """
+    Size bounded mapping evicting the least recently used entry
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _json_param(value: Any) -> Any:
+    # GET parameters carry variables and extensions as JSON strings
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    return value
+
+
+class GraphQLCacheMiddleware:
+    """
+    ASGI middleware in front of the GraphQL router
+
+    Persisted queries: a request may send `extensions.persistedQuery.sha256Hash`
+    without the document once the hash has been registered by a request
+    carrying both.
+
+    Response cache: successful responses are kept pre-serialised, keyed on the
+    document hash, variables and operation name. Entries belong to one data
+    version and the whole cache is dropped when the version changes.
+
+    HTTP caching: successful GET responses carry an ETag derived from the data
+    version and the cache key, Last-Modified and Cache-Control. Conditional
+    GETs whose validators still match are answered with 304 without running
+    the query.
+
+    Attributes:
+        path (str): Path of the GraphQL endpoint
+        version (Callable[[], str]): Returns the current data version
+        last_modified (Callable[[], Optional[datetime]]): Returns when the
+        current data version was built
+        guard (Callable[[Request], Awaitable[Optional[Response]]]): Runs for
+        requests that skip the router, e.g. the rate limit, and returns a
+        response to send instead
+        max_age (int): Seconds shared caches may reuse a GET response
+    """
+
+    def __init__(self, app: ASGIApp, path: str, version: Callable[[], str],
+                 last_modified: Optional[Callable[[], Optional[datetime]]] = None,
+                 guard: Optional[Callable[[Request],
+                                          Awaitable[Optional[Response]]]] = None,
+                 max_entries: int = 1024, max_documents: int = 1024,
+                 max_age: int = 300):
+        self.app = app
+        self.path = path.rstrip('/')
+        self.version = version
+        self.last_modified = last_modified
+        self.guard = guard
+        self.max_age = max_age
+        self.responses = LRUCache(max_entries)
+        self.documents = LRUCache(max_documents)
+        self._cache_version: Optional[str] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"].rstrip('/') != self.path \
+                or scope["method"] not in ("GET", "POST"):
+            await self.app(scope, receive, send)
+            return
+
+        body = b''
+        if scope["method"] == "POST":
+            body = await self._read_body(receive)
+            params = self._post_params(scope, body)
+        else:
+            params = dict(parse_qsl(scope["query_string"].decode()))
+
+        if params is None or (not params.get("query") and
+                              not params.get("extensions")):
+            await self.app(scope, self._replay(body, receive), send)
+            return
+
+        query, error = self._resolve_document(params)
+        if error is not None:
+            await error(scope, receive, send)
+            return
+
+        if query != params.get("query"):
+            params["query"] = query
+            scope, body = self._rewrite(scope, params)
+
+        key = self.cache_key(params)
+        version = self._sync_version()
+        headers = self._validators(version, key) \
+            if scope["method"] == "GET" else {}
+
+        if headers and self._not_modified(scope, headers):
+            rejection = await self._guard(scope, receive)
+            response = rejection or Response(status_code=304, headers=headers)
+            await response(scope, receive, send)
+            return
+
+        await self._serve(scope, self._replay(body, receive), send, key,
+                          headers)
+
+    @staticmethod
+    def cache_key(params: Dict[str, Any]) -> Tuple[str, str, Optional[str]]:
+        variables = _json_param(params.get("variables")) or {}
+        return (sha256(params["query"]),
+                json.dumps(variables, sort_keys=True, separators=(',', ':')),
+                params.get("operationName"))
+
+    def _sync_version(self) -> str:
+        version = self.version()
+        if version != self._cache_version:
+            self.responses.clear()
+            self._cache_version = version
+        return version
+
+    def _validators(self, version: str, key: Hashable) -> Dict[str, str]:
+        digest = sha256(json.dumps(key))[:16]
+        headers = {
+            "etag": f'"{version}-{digest}"',
+            "cache-control": f"public, max-age={self.max_age}",
+        }
+        built_at = self.last_modified() if self.last_modified else None
+        if built_at is not None:
+            headers["last-modified"] = format_datetime(
+                built_at.astimezone(timezone.utc), usegmt=True)
+        return headers
+
+    @staticmethod
+    def _not_modified(scope: Scope, headers: Dict[str, str]) -> bool:
+        request_headers = dict(scope["headers"])
+        if_none_match = request_headers.get(b"if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix('W/')
+                    for tag in if_none_match.decode().split(',')]
+            return '*' in tags or headers["etag"] in tags
+
+        if_modified_since = request_headers.get(b"if-modified-since")
+        if if_modified_since is None or "last-modified" not in headers:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since.decode())
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["last-modified"]) <= since
+
+    async def _guard(self, scope: Scope, receive: Receive
+                     ) -> Optional[Response]:
+        if self.guard is None:
+            return None
+        return await self.guard(Request(scope, receive))
+
+    async def _serve(self, scope: Scope, receive: Receive, send: Send,
+                     key: Hashable, headers: Dict[str, str]):
+        body = self.responses.get(key)
+        if body is not None:
+            rejection = await self._guard(scope, receive)
+            if rejection is not None:
+                await rejection(scope, receive, send)
+                return
+            response = Response(body, media_type="application/json",
+                                headers={**headers, "x-cache": "HIT"})
+            await response(scope, receive, send)
+            return
+
+        version = self._cache_version
+        start: Dict[str, Any] = {}
+        chunks: list[bytes] = []
+
+        async def capture(message: Message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b''))
+            if message.get("more_body", False):
+                return
+
+            content = b''.join(chunks)
+            extra = [(b"x-cache", b"MISS")]
+            if start["status"] == 200 and self._cacheable(content):
+                extra += [(name.encode(), value.encode())
+                          for name, value in headers.items()]
+                if version == self._cache_version:
+                    self.responses.set(key, content)
+            start["headers"] = list(start.get("headers", [])) + extra
+            await send(start)
+            await send({"type": "http.response.body", "body": content})
+
+        await self.app(scope, receive, capture)
+
+    @staticmethod
+    def _cacheable(content: bytes) -> bool:
+        try:
+            result = json.loads(content)
+        except ValueError:
+            return False
+        return isinstance(result, dict) and not result.get("errors")
+
+    def _resolve_document(self, params: Dict[str, Any]
+                          ) -> Tuple[Optional[str], Optional[Response]]:
+        extensions = _json_param(params.get("extensions")) or {}
+        persisted = extensions.get("persistedQuery") \
+            if isinstance(extensions, dict) else None
+        query = params.get("query")
+        if not isinstance(persisted, dict) or "sha256Hash" not in persisted:
+            return query, None
+
+        digest = persisted["sha256Hash"]
+        if query:
+            if sha256(query) != digest:
+                return None, JSONResponse(
+                    status_code=400,
+                    content={"errors": [{"message": "provided sha does not match query"}]})
+            self.documents.set(digest, query)
+            return query, None
+
+        query = self.documents.get(digest)
+        if query is None:
+            return None, JSONResponse(content=PERSISTED_QUERY_NOT_FOUND)
+        return query, None
+
+    @staticmethod
+    async def _read_body(receive: Receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b''))
+            if not message.get("more_body", False):
+                return b''.join(chunks)
+
+    @staticmethod
+    def _post_params(scope: Scope, body: bytes) -> Optional[Dict[str, Any]]:
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"application/json"):
+            return None
+        try:
+            params = json.loads(body)
+        except ValueError:
+            return None
+        return params if isinstance(params, dict) else None
+
+    @staticmethod
+    def _rewrite(scope: Scope, params: Dict[str, Any]) -> Tuple[Scope, bytes]:
+        scope = dict(scope)
+        if scope["method"] == "GET":
+            scope["query_string"] = urlencode(params).encode()
+            return scope, b''
+
+        body = json.dumps(params).encode()
+        scope["headers"] = [
+            (name, value) for name, value in scope["headers"]
+            if name != b"content-length"
+        ] + [(b"content-length", str(len(body)).encode())]
+        return scope, body
+
+    @staticmethod
+    def _replay(body: bytes, receive: Receive) -> Receive:
+        sent = False
+
+        async def replay() -> Message:
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return replay
@@ -0,0 +1,88 @@
+from cache import sha256
+
+QUERY = "{ income(area: \"Helsinki\") { value } }"
+
+
+def test_persisted_query_is_registered_once(server):
+    client, _ = server
+    extensions = {"persistedQuery": {"version": 1, "sha256Hash": sha256(QUERY)}}
+
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.json()["errors"][0]["message"] == "PersistedQueryNotFound"
+
+    client.post("/graphql", json={"query": QUERY, "extensions": extensions})
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.status_code == 200 and response.headers["x-cache"] == "HIT"
+
+
+def test_mismatching_persisted_hash_is_rejected(server):
+    client, _ = server
+    extensions = {"persistedQuery": {"version": 1, "sha256Hash": "0" * 64}}
+    response = client.post("/graphql", json={"query": QUERY,
+                                             "extensions": extensions})
+    assert response.status_code == 400
+
+
+def test_matching_if_none_match_is_not_modified(server):
+    client, state = server
+    response = client.get("/graphql", params={"query": QUERY})
+    etag = response.headers["etag"]
+    assert response.status_code == 200 and response.headers["x-cache"] == "MISS"
+
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert state["calls"] == 1
+
+
+def test_weak_and_listed_tags_match(server):
+    client, _ = server
+    etag = client.get("/graphql", params={"query": QUERY}).headers["etag"]
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-None-Match": f'"other", W/{etag}'})
+    assert response.status_code == 304
+
+
+def test_other_tag_or_version_is_served(server):
+    client, state = server
+    etag = client.get("/graphql", params={"query": QUERY}).headers["etag"]
+
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-None-Match": '"v0-stale"'})
+    assert response.status_code == 200 and response.headers["x-cache"] == "HIT"
+
+    state["version"] = "v2"
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json() == {"data": {"calls": 2}}
+
+
+def test_if_modified_since(server):
+    client, _ = server
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-Modified-Since":
+                                   "Sun, 01 Dec 2024 00:00:00 GMT"})
+    assert response.status_code == 304
+
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-Modified-Since":
+                                   "Sat, 30 Nov 2024 00:00:00 GMT"})
+    assert response.status_code == 200
+
+
+def test_not_modified_still_runs_the_guard(server):
+    client, state = server
+    etag = client.get("/graphql", params={"query": QUERY}).headers["etag"]
+    state["rejected"] = True
+    response = client.get("/graphql", params={"query": QUERY},
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 429
+
+
+def test_post_responses_carry_no_validators(server):
+    client, _ = server
+    response = client.post("/graphql", json={"query": QUERY})
+    assert response.status_code == 200 and "etag" not in response.headers
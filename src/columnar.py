@@ -0,0 +1,335 @@
+"""
+
+Module for the columnar store of the time-series tables
+
+Every table is one Arrow IPC file with dictionary encoded text columns,
+written by the fetchers next to the database and memory mapped by readers,
+scans only page in the columns they touch.
+
+"""
+
+
+import os
+import re
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+COLUMNAR_DIR = os.path.join(
+    os.getenv("ODFLOW_DB_DIR", os.path.join(os.path.dirname(__file__), '..', 'db')),
+    'columnar')
+
+COLUMNAR_TABLES = ('crime_rate', 'employment_rate', 'traffic_accidents')
+
+
+PERIOD_PATTERN = re.compile(r'(\d{4})(?:(?:M|-)(\d{1,2})|Q([1-4]))?')
+
+
+def parse_period(timeframe: str) -> Tuple[int, int]:
+    """
+
+    Args:
+        timeframe (str): PxWeb time value or range bound, `2023`, `2023Q2`,
+        `2023M05` or `2023-05`
+
+    Returns:
+        Tuple[int, int]: First and last month covered, as months since year 0
+
+    """
+    match = PERIOD_PATTERN.fullmatch(timeframe.strip().upper())
+    if match is None:
+        raise ValueError(f"Invalid period {timeframe!r}, expected e.g. 2023, "
+                         "2023Q2 or 2023M05")
+
+    year, month, quarter = match.groups()
+    start = int(year) * 12
+    if month is not None:
+        if not 1 <= int(month) <= 12:
+            raise ValueError(f"Invalid month in period {timeframe!r}")
+        return start + int(month) - 1, start + int(month) - 1
+    if quarter is not None:
+        first = start + (int(quarter) - 1) * 3
+        return first, first + 2
+    return start, start + 11
+
+
+def period_label(period: int, months: int) -> str:
+    """
+
+    Args:
+        period (int): First month of the period, as months since year 0
+        months (int): Length of the period, 1, 3 or 12
+
+    Returns:
+        str: Label in the PxWeb format, `2023M05`, `2023Q2` or `2023`
+
+    """
+    year, month = divmod(period, 12)
+    if months == 12:
+        return str(year)
+    if months == 3:
+        return f"{year}Q{month // 3 + 1}"
+    return f"{year}M{month + 1:02d}"
+
+
+def table_path(name: str, directory: str = COLUMNAR_DIR) -> str:
+    return os.path.join(directory, f"{name}.arrow")
+
+
+def read_table(name: str, directory: str = COLUMNAR_DIR) -> Optional[pa.Table]:
+    """
+
+    Args:
+        name (str): Table name, e.g. `crime_rate`
+        directory (str): Directory of the columnar store
+
+    Returns:
+        Optional[pa.Table]: Memory mapped table, None if it was not written
+
+    """
+    path = table_path(name, directory)
+    if not os.path.exists(path):
+        return None
+    # the table keeps the mapping alive, a file replaced later stays readable
+    # through the old mapping
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+def _grouped(table: pa.Table, key: pa.ChunkedArray, aggregation: str
+             ) -> Iterator[Tuple]:
+    grouped = pa.table({
+        'area_code': pc.cast(table['area_code'], pa.string()),
+        'area': pc.cast(table['area'], pa.string()),
+        'key': key,
+        'value': table['value'],
+    }).group_by(['area_code', 'key'], use_threads=False).aggregate(
+        [('area', 'first'), ('value', aggregation)])
+    grouped = grouped.filter(pc.is_valid(grouped['area_code'])).sort_by(
+        [('area_code', 'ascending'), ('key', 'ascending')])
+
+    return zip(grouped['area_code'].to_pylist(), grouped['area_first'].to_pylist(),
+               grouped['key'].to_pylist(),
+               grouped[f'value_{aggregation}'].to_pylist())
+
+
+def yearly_average(table: pa.Table) -> Iterator[Tuple]:
+    """
+
+    Returns:
+        Iterator[Tuple]: (area code, area, year, average value) by area code
+        and year
+
+    """
+    year = pc.utf8_slice_codeunits(pc.cast(table['timeframe'], pa.string()), 0, 4)
+    return _grouped(table, year, 'mean')
+
+
+def sum_by_timeframe(table: pa.Table) -> Iterator[Tuple]:
+    """
+
+    Returns:
+        Iterator[Tuple]: (area code, area, timeframe, total) by area code and
+        timeframe
+
+    """
+    return _grouped(table, pc.cast(table['timeframe'], pa.string()), 'sum')
+
+
+def sum_by_description(table: pa.Table) -> Iterator[Tuple]:
+    """
+
+    Returns:
+        Iterator[Tuple]: (area code, area, description, total) by area code
+        and description
+
+    """
+    return _grouped(table, pc.cast(table['description'], pa.string()), 'sum')
+
+
+def _to_numpy(column: Union[pa.Array, pa.ChunkedArray]) -> np.ndarray:
+    """
+
+    Args:
+        column (Union[pa.Array, pa.ChunkedArray]): Integer or floating point
+        column
+
+    Returns:
+        np.ndarray: Values read from the Arrow buffers, nulls as NaN. Arrow's
+        own conversion imports pandas, which the API processes do not need
+
+    """
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) \
+        else column
+    kind = 'f' if pa.types.is_floating(array.type) else 'i'
+    dtype = np.dtype(f"{kind}{array.type.bit_width // 8}")
+    values = np.frombuffer(array.buffers()[1], dtype=dtype, count=len(array),
+                           offset=array.offset * dtype.itemsize)
+    if array.null_count:
+        valid = np.unpackbits(np.frombuffer(array.buffers()[0], dtype=np.uint8),
+                              bitorder='little')[array.offset:array.offset + len(array)]
+        values = np.where(valid.astype(bool), values, np.nan)
+    return values
+
+
+def _dictionary_codes(column: Union[pa.DictionaryArray, pa.ChunkedArray]
+                      ) -> Tuple[np.ndarray, list]:
+    """
+
+    Returns:
+        Tuple[np.ndarray, list]: Dictionary index of every row and the
+        dictionary of a dictionary encoded text column
+
+    """
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) \
+        else column
+    return _to_numpy(array.indices), array.dictionary.to_pylist()
+
+
+class SeriesTable:
+    """
+    Time-series table sorted by area code and period, with the row range of
+    every area, range queries are two binary searches within that range
+
+    Attributes:
+        index (Dict[str, Tuple[int, int]]): Area code to its first and last
+        row + 1
+    """
+
+    def __init__(self, table: pa.Table):
+        table = table.unify_dictionaries()
+        self.period = _to_numpy(table['period'])
+        self.value = _to_numpy(table['value'])
+        self.timeframe = table['timeframe'].combine_chunks()
+        self.description = table['description'].combine_chunks()
+
+        indices, dictionary = _dictionary_codes(table['area_code'])
+        codes = np.asarray(dictionary, dtype=object)[indices]
+        bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        starts = np.concatenate(([0], bounds)) if len(codes) else bounds
+        ends = np.concatenate((bounds, [len(codes)])) if len(codes) else bounds
+        self.index = {codes[start]: (int(start), int(end))
+                      for start, end in zip(starts, ends)}
+
+    def rows(self, code: str, start: Optional[int] = None,
+             end: Optional[int] = None) -> slice:
+        """
+
+        Args:
+            code (str): Area code
+            start (Optional[int]): First month, as months since year 0
+            end (Optional[int]): Last month, as months since year 0
+
+        Returns:
+            slice: Rows of the area whose period starts within the range
+
+        """
+        first, last = self.index.get(code, (0, 0))
+        periods = self.period[first:last]
+        low = first if start is None else \
+            first + int(np.searchsorted(periods, start, 'left'))
+        high = last if end is None else \
+            first + int(np.searchsorted(periods, end, 'right'))
+        return slice(low, max(low, high))
+
+    def records(self, rows: slice) -> List[Tuple[str, str, float]]:
+        """
+
+        Returns:
+            List[Tuple[str, str, float]]: (timeframe, description, value) of
+            the rows
+
+        """
+        return list(zip(self.timeframe[rows].to_pylist(),
+                        self.description[rows].to_pylist(),
+                        self.value[rows].tolist()))
+
+    def aggregate(self, rows: slice, months: Optional[int], how: str,
+                  by_description: bool = False
+                  ) -> List[Tuple[Optional[str], Optional[str], float]]:
+        """
+
+        Args:
+            rows (slice): Rows to aggregate
+            months (Optional[int]): Bucket length, 1, 3 or 12, None for one
+            bucket over all rows
+            how (str): `sum` or `mean`
+            by_description (bool): Aggregate every description separately
+
+        Returns:
+            List[Tuple[Optional[str], Optional[str], float]]: (period label,
+            description, value) by period and description, labels are None
+            when not grouped by them
+
+        """
+        periods = self.period[rows]
+        values = self.value[rows]
+        valid = np.arange(len(values))
+        if values.dtype.kind == 'f':
+            # missing values are skipped like SQL aggregates do
+            valid = np.flatnonzero(~np.isnan(values))
+            periods, values = periods[valid], values[valid]
+        if not len(values):
+            return []
+
+        buckets = periods // months if months else np.zeros(len(values), np.int64)
+        if by_description:
+            codes, names = _dictionary_codes(self.description[rows])
+            codes = codes[valid]
+        else:
+            codes = np.zeros(len(values), np.int64)
+            names = [None]
+
+        keys = np.stack((buckets, codes), axis=1)
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        totals = np.zeros(len(groups), dtype=values.dtype)
+        np.add.at(totals, inverse, values)
+        if how == 'mean':
+            totals = totals / np.bincount(inverse)
+
+        return [(period_label(int(bucket) * months, months) if months else None,
+                 names[int(code)], total)
+                for (bucket, code), total in zip(groups, totals.tolist())]
+
+
+class SeriesStore:
+    """
+    Memory mapped time-series tables of one refresh
+
+    Attributes:
+        tables (Dict[str, SeriesTable]): Table name to table
+    """
+
+    def __init__(self, tables: Dict[str, SeriesTable]):
+        self.tables = tables
+
+    @classmethod
+    def load(cls, directory: str = COLUMNAR_DIR) -> Optional['SeriesStore']:
+        """
+
+        Returns:
+            Optional[SeriesStore]: Store of the tables written with periods,
+            None if there are none
+
+        """
+        tables = {}
+        for name in COLUMNAR_TABLES:
+            table = read_table(name, directory)
+            if table is not None and 'period' in table.column_names:
+                tables[name] = SeriesTable(table)
+        return cls(tables) if tables else None
+
+    def table(self, name: str) -> SeriesTable:
+        if name not in self.tables:
+            raise ValueError(f"No time-series data available for {name}")
+        return self.tables[name]
+
+
+# snapshot section to the table and aggregation computing it
+SECTION_AGGREGATES: Dict[str, Tuple[str, Callable[[pa.Table], Iterator[Tuple]]]] = {
+    "unemployment_rate": ("employment_rate", yearly_average),
+    "traffic_accidents_sum": ("traffic_accidents", sum_by_timeframe),
+    "crimes": ("crime_rate", sum_by_description),
+}
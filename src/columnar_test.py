@@ -0,0 +1,174 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from columnar import (SECTION_AGGREGATES, SeriesTable, parse_period,
+                      period_label, read_table, table_path)
+from fetchers.columnar_store import write_columnar
+from fetchers.snapshot_builder import SECTION_QUERIES, _section_records
+from models import create_table
+
+CODES = ["SSS", "KU049", "KU091", "KU092"]
+MONTHS = [f"{year}M{month:02d}" for year in (2022, 2023, 2024)
+          for month in range(1, 13)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    rng = np.random.default_rng(16)
+    conn = sqlite3.connect(str(tmp_path / "data.sqlite3"))
+    fetched_at = datetime(2024, 12, 1)
+    for table in ("crime_rate", "employment_rate", "traffic_accidents"):
+        create_table(conn, table)
+
+    # rows arrive in PxWeb order, not sorted by area and period
+    for month in MONTHS:
+        for code in CODES:
+            for description in ("Robbery", "Sexual crimes"):
+                conn.execute(
+                    "INSERT INTO crime_rate (area, area_code, timeframe, "
+                    "description, value, last_updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    (f"Area {code}", code, month, description,
+                     int(rng.integers(0, 50)), fetched_at))
+            value = None if (code, month) == ("KU091", "2023M06") \
+                else float(rng.integers(100, 5000))
+            conn.execute(
+                "INSERT INTO employment_rate (area, area_code, timeframe, "
+                "description, value, last_updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (f"Area {code}", code, month, "TYOTOSUUS", value, fetched_at))
+    for year in ("2021", "2022", "2023"):
+        for code in CODES[1:]:
+            for description in ("kuolonn", "loukonn"):
+                conn.execute(
+                    "INSERT INTO traffic_accidents (area, area_code, timeframe, "
+                    "description, value, last_updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    (f"Area {code}", code, year, description,
+                     int(rng.integers(0, 20)), fetched_at))
+    conn.commit()
+    yield conn, str(tmp_path / "data.sqlite3"), str(tmp_path / "columnar")
+    conn.close()
+
+
+def test_aggregates_match_the_sql_sections(db):
+    conn, db_name, directory = db
+    assert write_columnar(db_name, directory) == 3
+
+    queries = {section: sql for section, _, sql in SECTION_QUERIES}
+    for section, (table, _) in SECTION_AGGREGATES.items():
+        columnar = list(_section_records(conn, section, table, queries[section],
+                                         directory))
+        sql = list(_section_records(conn, section, table, queries[section],
+                                    None))
+        assert [row[:3] for row in columnar] == [row[:3] for row in sql]
+        assert [row[3] for row in columnar] == pytest.approx(
+            [row[3] for row in sql])
+
+
+def test_missing_or_empty_tables_are_removed(db):
+    conn, db_name, directory = db
+    write_columnar(db_name, directory)
+
+    conn.execute("DROP TABLE traffic_accidents")
+    conn.execute("DELETE FROM employment_rate")
+    conn.commit()
+
+    assert write_columnar(db_name, directory) == 1
+    assert os.path.exists(table_path("crime_rate", directory))
+    assert not os.path.exists(table_path("employment_rate", directory))
+    assert not os.path.exists(table_path("traffic_accidents", directory))
+
+
+@pytest.mark.parametrize("timeframe, months", [
+    ("2023", (2023 * 12, 2023 * 12 + 11)),
+    ("2023Q2", (2023 * 12 + 3, 2023 * 12 + 5)),
+    ("2023M05", (2023 * 12 + 4, 2023 * 12 + 4)),
+    ("2023-05", (2023 * 12 + 4, 2023 * 12 + 4)),
+    (" 2023m5 ", (2023 * 12 + 4, 2023 * 12 + 4)),
+])
+def test_parse_period(timeframe, months):
+    assert parse_period(timeframe) == months
+
+
+@pytest.mark.parametrize("timeframe", ["23", "2023M13", "2023M00", "2023Q5",
+                                       "2023-5-1", "May 2023"])
+def test_parse_period_rejects_invalid_periods(timeframe):
+    with pytest.raises(ValueError):
+        parse_period(timeframe)
+
+
+@pytest.mark.parametrize("label", ["2023", "2023Q4", "2023M01", "2024M12"])
+def test_period_label_round_trip(label):
+    first, last = parse_period(label)
+    assert period_label(first, last - first + 1) == label
+
+
+@pytest.fixture
+def crimes(db):
+    conn, db_name, directory = db
+    write_columnar(db_name, directory)
+    return conn, SeriesTable(read_table("crime_rate", directory))
+
+
+@pytest.mark.parametrize("start, end", [
+    (None, None), ("2023", None), (None, "2022Q3"), ("2023M03", "2024M02"),
+    ("2030", None), (None, "2010")])
+def test_rows_cover_the_range_of_the_area(crimes, start, end):
+    conn, table = crimes
+    first = parse_period(start)[0] if start else None
+    last = parse_period(end)[1] if end else None
+
+    records = table.records(table.rows("KU091", first, last))
+
+    expected = [
+        (timeframe, description, float(value))
+        for timeframe, description, value in conn.execute(
+            "SELECT timeframe, description, value FROM crime_rate "
+            "WHERE area_code = 'KU091' ORDER BY timeframe, rowid")
+        if (first is None or parse_period(timeframe)[0] >= first)
+        and (last is None or parse_period(timeframe)[0] <= last)]
+    assert records == expected
+
+
+def test_rows_of_an_unknown_area_are_empty(crimes):
+    _, table = crimes
+    assert table.records(table.rows("KU999")) == []
+
+
+@pytest.mark.parametrize("months", [12, 3, 1])
+def test_aggregate_sums_buckets_by_description(crimes, months):
+    conn, table = crimes
+    rows = table.rows("KU049", *parse_period("2023"))
+
+    totals = table.aggregate(rows, months, "sum", by_description=True)
+
+    expected = {}
+    for timeframe, description, value in conn.execute(
+            "SELECT timeframe, description, value FROM crime_rate "
+            "WHERE area_code = 'KU049' AND timeframe LIKE '2023%'"):
+        bucket = parse_period(timeframe)[0] // months * months
+        key = (period_label(bucket, months), description)
+        expected[key] = expected.get(key, 0) + value
+    assert {(period, description): total
+            for period, description, total in totals} == expected
+    assert len(totals) == 2 * 12 // months
+
+
+def test_aggregate_mean_skips_missing_values(db):
+    conn, db_name, directory = db
+    write_columnar(db_name, directory)
+    table = SeriesTable(read_table("employment_rate", directory))
+
+    means = table.aggregate(table.rows("KU091"), 12, "mean")
+    overall = table.aggregate(table.rows("KU091"), None, "mean")
+
+    expected = conn.execute(
+        "SELECT substr(timeframe, 1, 4), AVG(value) FROM employment_rate "
+        "WHERE area_code = 'KU091' GROUP BY 1 ORDER BY 1").fetchall()
+    assert [(period, value) for period, _, value in means] == \
+        [(year, pytest.approx(value)) for year, value in expected]
+    assert overall == [(None, None, pytest.approx(conn.execute(
+        "SELECT AVG(value) FROM employment_rate "
+        "WHERE area_code = 'KU091'").fetchone()[0]))]
@@ -0,0 +1,70 @@
+import os
+from datetime import datetime, timezone
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import ratelimit
+from cache import GraphQLCacheMiddleware
+from fetchers.fetcher import BASE_DIR, Fetcher
+from fetchers.registry import FETCHERS
+
+
+@pytest.fixture
+def make_fetcher(tmp_path):
+    """
+    Builds the registered fetcher of a name writing into a temporary database
+    """
+
+    def make(name: str, api_url: str = "http://pxweb.invalid/table.px",
+             **overrides) -> Fetcher:
+        fields = dict(FETCHERS[name], db_name=str(tmp_path / "data.sqlite3"))
+        fields.pop('table')
+        config = fields.pop('config')
+        fields.update(overrides)
+        return Fetcher(api_url=api_url,
+                       query_parameters_file=os.path.join(BASE_DIR, "config",
+                                                          config),
+                       **fields)
+
+    return make
+
+
+@pytest.fixture
+def server():
+    """
+    Counting GraphQL endpoint behind the cache middleware, the state sets the
+    snapshot version and whether the guard rejects requests
+    """
+    state = {"version": "v1", "calls": 0, "rejected": False}
+
+    async def graphql(request):
+        state["calls"] += 1
+        return JSONResponse({"data": {"calls": state["calls"]}})
+
+    async def guard(request):
+        if state["rejected"]:
+            return JSONResponse({"errors": [{"message": "limited"}]},
+                                status_code=429)
+        return None
+
+    app = GraphQLCacheMiddleware(
+        Starlette(routes=[Route("/graphql", graphql, methods=["GET", "POST"])]),
+        path="/graphql",
+        version=lambda: state["version"],
+        last_modified=lambda: datetime(2024, 12, 1, tzinfo=timezone.utc),
+        guard=guard)
+    return TestClient(app), state
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Frozen time of the rate limiter, tests move it by changing clock[0]
+    """
+    now = [1_000_020.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    return now
@@ -0,0 +1,158 @@
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+
+def frame(fetcher, values: dict, fetched_at: datetime) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(None, f"Area {code}", code, description, value, fetched_at)
+         for (code, description), value in values.items()],
+        columns=fetcher.columns)
+
+
+def stored(fetcher) -> dict:
+    conn = sqlite3.connect(fetcher.db_name)
+    try:
+        return {(code, description): (value, last_updated)
+                for code, description, value, last_updated in conn.execute(
+                    "SELECT area_code, description, value, last_updated "
+                    "FROM income")}
+    finally:
+        conn.close()
+
+
+def tables(fetcher) -> set:
+    conn = sqlite3.connect(fetcher.db_name)
+    try:
+        return {name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def income(make_fetcher):
+    return make_fetcher("Income fetcher")
+
+
+def test_save_batches_updates_changed_cells_only(income):
+    first, second = datetime(2024, 1, 1), datetime(2024, 2, 1)
+    assert income.save_batches([frame(income, {("KU091", "palk"): 10,
+                                               ("KU049", "palk"): 20},
+                                       first)]) == 2
+
+    changed = income.save_batches([
+        frame(income, {("KU091", "palk"): 10}, second),
+        frame(income, {("KU049", "palk"): 25, ("KU092", "palk"): 30}, second),
+    ])
+
+    assert changed == 2
+    rows = stored(income)
+    assert rows[("KU091", "palk")] == (10, str(first))
+    assert rows[("KU049", "palk")] == (25, str(second))
+    assert rows[("KU092", "palk")] == (30, str(second))
+    assert "income__staging" not in tables(income)
+
+
+@pytest.mark.parametrize("prune, kept", [(True, False), (False, True)])
+def test_save_batches_prunes_cells_missing_from_a_full_fetch(income, prune,
+                                                             kept):
+    fetched_at = datetime(2024, 1, 1)
+    income.save_batches([frame(income, {("KU091", "palk"): 10,
+                                        ("KU049", "palk"): 20}, fetched_at)])
+
+    changed = income.save_batches(
+        [frame(income, {("KU091", "palk"): 10}, fetched_at)], prune=prune)
+
+    assert changed == (0 if kept else 1)
+    assert (("KU049", "palk") in stored(income)) == kept
+
+
+def test_failed_save_keeps_the_data_and_drops_the_staging_table(income):
+    fetched_at = datetime(2024, 1, 1)
+    income.save_batches([frame(income, {("KU091", "palk"): 10}, fetched_at)])
+
+    def batches():
+        yield frame(income, {("KU091", "palk"): 99}, fetched_at)
+        raise ConnectionError("response cut off")
+
+    with pytest.raises(ConnectionError):
+        income.save_batches(batches(), prune=True)
+
+    assert stored(income) == {("KU091", "palk"): (10, str(fetched_at))}
+    assert "income__staging" not in tables(income)
+
+
+def periods(fetcher, query) -> list:
+    return next(item['selection']['values'] for item in query['query']
+                if item['code'] == fetcher.timeframe_path)
+
+
+def test_delta_query_refetches_the_latest_period_and_newer(make_fetcher):
+    crimes = make_fetcher("Crime rate fetcher")
+    configured = periods(crimes, crimes.query_parameters)
+
+    assert crimes.delta_query(None) == crimes.query_parameters
+    assert periods(crimes, crimes.delta_query(configured[-2])) == configured[-2:]
+    assert crimes.delta_query(configured[-1] + "9") is None
+    # the config query itself is not changed
+    assert periods(crimes, crimes.query_parameters) == configured
+
+
+def test_delta_query_of_a_table_without_periods_is_the_config(income):
+    assert income.delta_query("2024") == income.query_parameters
+
+
+@pytest.fixture
+def streamed_crimes(make_fetcher, monkeypatch):
+    crimes = make_fetcher("Crime rate fetcher")
+    queries = []
+
+    def fetch_batches(session=None, query=None, timings=None):
+        queries.append(query)
+        timings.update(fetch=0.0, parse=0.0)
+        return iter(())
+
+    monkeypatch.setattr(crimes, "fetch_batches", fetch_batches)
+    return crimes, queries
+
+
+def seed(fetcher, period: str, updated: str):
+    fetcher.fetched_at = datetime(2024, 1, 1)
+    fetcher.save_data(pd.DataFrame(
+        [(None, "Area KU091", "KU091", period, "Robbery", 1,
+          fetcher.fetched_at)], columns=fetcher.columns))
+    fetcher.save_state(updated)
+
+
+def test_unchanged_table_is_skipped(streamed_crimes, monkeypatch):
+    crimes, queries = streamed_crimes
+    seed(crimes, periods(crimes, crimes.query_parameters)[-1],
+         "2024-12-01T08:00:00Z")
+    monkeypatch.setattr(crimes, "remote_updated",
+                        lambda session=None: "2024-12-01T08:00:00Z")
+
+    assert crimes.fetch_parse_save()
+    assert queries == []
+
+    # a full refresh or an unknown remote state fetches again
+    assert crimes.fetch_parse_save(full=True)
+    assert queries == [crimes.query_parameters]
+    monkeypatch.setattr(crimes, "remote_updated", lambda session=None: None)
+    assert crimes.fetch_parse_save()
+    assert len(queries) == 2
+
+
+def test_updated_table_fetches_new_periods_only(streamed_crimes, monkeypatch):
+    crimes, queries = streamed_crimes
+    configured = periods(crimes, crimes.query_parameters)
+    seed(crimes, configured[-2], "2024-11-01T08:00:00Z")
+    monkeypatch.setattr(crimes, "remote_updated",
+                        lambda session=None: "2024-12-01T08:00:00Z")
+
+    assert crimes.fetch_parse_save()
+
+    assert periods(crimes, queries[0]) == configured[-2:]
+    assert crimes.load_state()['updated'] == "2024-12-01T08:00:00Z"
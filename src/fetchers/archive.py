@@ -0,0 +1,269 @@
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger("fetchers")
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def query_hash(query: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+
+def _write_json(path: str, content: Dict[str, Any]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(content, file, indent=1, default=str)
+    os.replace(tmp_path, path)
+
+
+class ArchiveEntry:
+    """
+    Response being written to the archive, compressed and hashed while it is
+    read so that streamed bodies are never held in memory
+
+    Attributes:
+        size (int): Uncompressed bytes written so far
+        failed (bool): Writing failed, the entry is discarded on commit
+    """
+
+    def __init__(self, archive: 'RawArchive', table: str, query: Dict[str, Any],
+                 meta: Dict[str, Any]):
+        self.archive = archive
+        self.table = table
+        self.query = query
+        self.meta = meta
+        self.size = 0
+        self._hash = hashlib.sha256()
+        os.makedirs(archive.objects_dir, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=archive.objects_dir,
+                                              suffix='.tmp')
+        self._file = gzip.GzipFile(fileobj=os.fdopen(fd, 'wb'), mode='wb',
+                                   compresslevel=6, mtime=0)
+        self._closed = False
+        self.failed = False
+
+    def write(self, chunk: bytes):
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def tee(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+
+        Archives the chunks while passing them on, a failing disk stops the
+        archiving but not the fetch
+
+        """
+        for chunk in chunks:
+            if not self.failed:
+                try:
+                    self.write(chunk)
+                except OSError as e:
+                    logger.warning("Archiving %s failed: %s", self.table, e)
+                    self.failed = True
+            yield chunk
+
+    def commit(self) -> Optional[str]:
+        """
+
+        Moves the body under its content hash and points the index entry of
+        the table and query at it
+
+        Returns:
+            Optional[str]: Content hash of the body, None if writing failed
+
+        """
+        if self.failed:
+            self.discard()
+            return None
+        self._close()
+        content = self._hash.hexdigest()
+        path = self.archive.object_path(content)
+        if os.path.exists(path):
+            # identical body archived before, keep a single copy
+            os.remove(self._tmp_path)
+        else:
+            os.replace(self._tmp_path, path)
+
+        key = query_hash(self.query)
+        _write_json(self.archive.index_path(self.table, key), {
+            **self.meta,
+            "table": self.table,
+            "query_hash": key,
+            "query": self.query,
+            "content": content,
+            "bytes": self.size,
+            "compressed_bytes": os.path.getsize(path),
+        })
+        return content
+
+    def discard(self):
+        self._close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def _close(self):
+        if not self._closed:
+            fileobj = self._file.fileobj
+            self._file.close()
+            fileobj.close()
+            self._closed = True
+
+
+class RawArchive:
+    """
+    Compressed raw PxWeb responses on local disk
+
+    Bodies are stored once under the sha256 of their content in `objects/`,
+    `index/<table>/<query hash>.json` holds the metadata of the latest
+    response to a query and points at its body. Directories are created with
+    the first stored response.
+
+    Attributes:
+        directory (str): Root directory of the archive
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_dir = os.path.join(directory, 'index')
+
+    def object_path(self, content: str) -> str:
+        return os.path.join(self.objects_dir, f"{content}.json.gz")
+
+    def index_path(self, table: str, key: str) -> str:
+        directory = os.path.join(self.index_dir, table)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{key}.json")
+
+    def open(self, table: str, query: Dict[str, Any], **meta) -> ArchiveEntry:
+        """
+
+        Args:
+            table (str): Table the response belongs to
+            query (Dict[str, Any]): Query that was posted
+            meta: Further metadata stored with the entry, e.g. `fetched_at`
+
+        Returns:
+            ArchiveEntry: Entry to write the body into, then commit
+
+        """
+        return ArchiveEntry(self, table, query, meta)
+
+    def store(self, table: str, query: Dict[str, Any], body: bytes,
+              **meta) -> Optional[str]:
+        entry = self.open(table, query, **meta)
+        try:
+            entry.write(body)
+            return entry.commit()
+        except BaseException:
+            entry.discard()
+            raise
+
+    def entries(self, table: str) -> List[Dict[str, Any]]:
+        """
+
+        Returns:
+            List[Dict[str, Any]]: Metadata of every archived query of the
+            table, oldest response first and the pieces of a split query in
+            their order
+
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.index_dir, table, '*.json')):
+            try:
+                with open(path) as file:
+                    entries.append(json.load(file))
+            except (OSError, ValueError) as e:
+                logger.warning("Unreadable archive entry %s: %s", path, e)
+        return sorted(entries, key=lambda entry: (str(entry.get('fetched_at')),
+                                                  entry.get('piece', 0)))
+
+    def find(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+
+        Returns:
+            Optional[Dict[str, Any]]: Metadata of the response to the query in
+            any table, None if it was never archived
+
+        """
+        key = query_hash(query)
+        for path in glob.glob(os.path.join(self.index_dir, '*', f"{key}.json")):
+            with open(path) as file:
+                return json.load(file)
+        return None
+
+    def read(self, entry: Dict[str, Any]) -> Iterator[bytes]:
+        """
+
+        Args:
+            entry (Dict[str, Any]): Metadata returned by entries() or find()
+
+        Returns:
+            Iterator[bytes]: Decompressed body in chunks
+
+        """
+        with gzip.open(self.object_path(entry['content']), 'rb') as file:
+            while chunk := file.read(READ_CHUNK_SIZE):
+                yield chunk
+
+
+    def prune(self, table: str, fetched_at: str) -> int:
+        """
+
+        Drops the index entries of the table older than a full fetch, the
+        responses of that fetch hold every cell of the table. Nothing is
+        dropped when the fetch was not archived.
+
+        Args:
+            table (str): Table that was fetched completely
+            fetched_at (str): `fetched_at` of the full fetch
+
+        Returns:
+            int: Number of dropped index entries
+
+        """
+        entries = self.entries(table)
+        if not any(entry.get('fetched_at') == fetched_at for entry in entries):
+            return 0
+
+        dropped = 0
+        for entry in entries:
+            if str(entry.get('fetched_at')) < fetched_at:
+                os.remove(self.index_path(table, entry['query_hash']))
+                dropped += 1
+        return dropped
+
+    def collect_garbage(self) -> int:
+        """
+
+        Removes the bodies no index entry points at any more, run while no
+        response is being archived
+
+        Returns:
+            int: Number of removed bodies
+
+        """
+        referenced = set()
+        for path in glob.glob(os.path.join(self.index_dir, '*', '*.json')):
+            try:
+                with open(path) as file:
+                    referenced.add(json.load(file)['content'])
+            except (OSError, ValueError, KeyError) as e:
+                # keep every body while an entry cannot be read
+                logger.warning("Unreadable archive entry %s: %s", path, e)
+                return 0
+
+        removed = 0
+        for path in glob.glob(os.path.join(self.objects_dir, '*.json.gz')):
+            if os.path.basename(path)[:-len('.json.gz')] not in referenced:
+                os.remove(path)
+                removed += 1
+        return removed
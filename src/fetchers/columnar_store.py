@@ -0,0 +1,127 @@
+import logging
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from columnar import COLUMNAR_TABLES, parse_period, table_path
+from fetchers.safety_rating import code_column, existing_tables
+
+logger = logging.getLogger("fetchers")
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    """
+
+    Args:
+        df (pd.DataFrame): Rows of a table without its id column
+
+    Returns:
+        pa.Table: Table with dictionary encoded text columns and an integer
+        value column when every value is integral, as stored by the fetchers
+
+    """
+    columns = {}
+    for name in df.columns:
+        if name == 'value':
+            values = pd.to_numeric(df[name]).to_numpy(dtype=np.float64)
+            finite = values[~np.isnan(values)]
+            if len(finite) == len(values) and np.all(finite == np.round(finite)):
+                values = values.astype(np.int64)
+            columns[name] = pa.array(values, from_pandas=True)
+        elif name == 'last_updated':
+            columns[name] = pa.array(pd.to_datetime(df[name]))
+        elif name == 'period':
+            columns[name] = pa.array(df[name], type=pa.int32())
+        else:
+            columns[name] = pa.array(df[name], type=pa.string()).dictionary_encode()
+    return pa.table(columns)
+
+
+def _with_periods(df: pd.DataFrame) -> pd.DataFrame:
+    """
+
+    Args:
+        df (pd.DataFrame): Rows of a time-series table
+
+    Returns:
+        pd.DataFrame: Rows with the first month of their timeframe as
+        `period`, sorted by area code and period so that range queries of an
+        area read one contiguous run
+
+    """
+    starts = {}
+    for timeframe in df['timeframe'].dropna().unique():
+        try:
+            starts[timeframe] = parse_period(timeframe)[0]
+        except ValueError:
+            logger.warning("Unparsed timeframe %s", timeframe)
+    df['period'] = df['timeframe'].map(starts).fillna(-1).astype(np.int32)
+    return df.sort_values(['area_code', 'period'], kind='stable',
+                          ignore_index=True)
+
+
+def _remove_stale(path: str, table: str):
+    # a skipped table must not keep serving the data of an earlier refresh
+    try:
+        os.remove(path)
+        logger.info("Columnar %s removed, no data", table)
+    except FileNotFoundError:
+        pass
+
+
+def write_columnar(db_name: str, directory: str,
+                   tables: tuple[str, ...] = COLUMNAR_TABLES) -> int:
+    """
+
+    Writes one Arrow IPC file per table, each replaced atomically. Files of
+    tables that are missing or empty are removed.
+
+    Args:
+        db_name (str): Path of the sqlite database filled by the fetchers
+        directory (str): Directory of the columnar store
+        tables (tuple[str, ...]): Tables to write
+
+    Returns:
+        int: Number of written tables
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    written = 0
+    conn = sqlite3.connect(db_name)
+    try:
+        existing = existing_tables(conn)
+        for table in tables:
+            path = table_path(table, directory)
+            if table not in existing:
+                _remove_stale(path, table)
+                continue
+
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')
+                       if row[1] != 'id']
+            selected = ', '.join(
+                ['"' + c + '"' for c in columns if c != 'area_code']
+                + [f'{code_column(conn, table)} AS area_code'])
+            df = pd.read_sql_query(f'SELECT {selected} FROM "{table}" ORDER BY rowid',
+                                   conn)
+            if df.empty:
+                _remove_stale(path, table)
+                continue
+            if 'timeframe' in df.columns:
+                df = _with_periods(df)
+
+            arrow_table = _to_arrow(df)
+            tmp_path = f"{path}.tmp"
+            with pa.OSFile(tmp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+                    writer.write_table(arrow_table)
+            os.replace(tmp_path, path)
+
+            logger.info("[✓] Columnar %s written, %s rows", table,
+                        arrow_table.num_rows)
+            written += 1
+    finally:
+        conn.close()
+    return written
@@ -1,23 +1,185 @@
+import copy
+import fcntl
+import hashlib
+import itertools
 import json
+import math
 import os
+import random
 import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from itertools import product
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Iterator, List, Optional
 
 import logging
+import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from models import Base, create_table
+from fetchers.archive import ArchiveEntry, RawArchive, query_hash
+from fetchers.columnar_store import write_columnar
+from fetchers.jsonstat import JsonStatStream
+from fetchers.registry import load_fetchers
+from fetchers.safety_rating import write_safety_ratings
+from fetchers.snapshot_builder import write_snapshot
 
 logger = logging.getLogger("fetchers")
 
+STATE_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS fetch_state ("
+                   "table_name TEXT PRIMARY KEY, updated TEXT, signature TEXT, "
+                   "fetched_at TIMESTAMP)")
+
+# sqlite allows a single writer, concurrent fetchers take turns saving
+_db_write_lock = threading.Lock()
+
+
+def _category_column(category: Dict[str, Any], codes: np.ndarray,
+                     use_labels: bool = True):
+    """
+
+    Args:
+        category (Dict[str, Any]): JSON-stat `category` object of a dimension
+        codes (np.ndarray): Category position of every cell
+        use_labels (bool): Return the category labels instead of the PxWeb
+        value codes (e.g. `Helsinki` instead of `KU091`)
+
+    Returns:
+        Categorical column holding the label or code of every cell
+
+    """
+    labels = category['label']
+    index = category.get('index')
+    if isinstance(index, dict):
+        order = sorted(index, key=index.get)
+    elif isinstance(index, list):
+        order = index
+    else:
+        order = list(labels)
+    categories = [labels.get(code, code) for code in order] if use_labels \
+        else list(order)
+
+    if len(set(categories)) == len(categories):
+        return pd.Categorical.from_codes(codes, categories=categories)
+    return np.asarray(categories, dtype=object)[codes]
+
+
+def query_cells(query: Dict[str, Any]) -> Optional[int]:
+    """
+
+    Args:
+        query (Dict[str, Any]): PxWeb query
+
+    Returns:
+        Optional[int]: Number of cells the query selects, None when a
+        selection is not a plain list of values and the size is unknown
+
+    """
+    cells = 1
+    for item in query['query']:
+        selection = item['selection']
+        if selection['filter'] != 'item':
+            return None
+        cells *= len(selection['values'])
+    return cells
+
+
+def split_query(query: Dict[str, Any], max_cells: int) -> List[Dict[str, Any]]:
+    """
+
+    Partitions the query along its largest dimension until every piece selects
+    at most `max_cells` cells, splitting further dimensions when one value of
+    the largest is still too big
+
+    Args:
+        query (Dict[str, Any]): PxWeb query
+        max_cells (int): Cell limit of one request
+
+    Returns:
+        List[Dict[str, Any]]: Queries selecting disjoint parts of the cube,
+        the query itself when it fits or its size is unknown
+
+    """
+    cells = query_cells(query)
+    if cells is None or cells <= max_cells:
+        return [query]
+
+    largest = max(query['query'], key=lambda item: len(item['selection']['values']))
+    values = largest['selection']['values']
+    if len(values) < 2:
+        return [query]
+
+    parts = min(len(values), math.ceil(cells / max_cells))
+    size = math.ceil(len(values) / parts)
+    pieces = []
+    for start in range(0, len(values), size):
+        piece = copy.deepcopy(query)
+        for item in piece['query']:
+            if item['code'] == largest['code']:
+                item['selection']['values'] = values[start:start + size]
+        pieces.extend(split_query(piece, max_cells))
+    return pieces
+
+
+def _retry_delay(attempt: int, error: requests.exceptions.RequestException
+                 ) -> Optional[float]:
+    """
+
+    Returns:
+        Optional[float]: Seconds to wait before the next attempt, None if the
+        error is not worth retrying
+
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.exceptions.HTTPError):
+        if response is None or (response.status_code != 429
+                                and response.status_code < 500):
+            return None
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return float(retry_after)
+    elif not isinstance(error, (requests.exceptions.ConnectionError,
+                                requests.exceptions.Timeout,
+                                requests.exceptions.ChunkedEncodingError)):
+        return None
+    backoff = RETRY_BACKOFF * 2 ** attempt
+    return backoff + random.uniform(0, backoff)
+
+
+def create_session(max_connections: int) -> requests.Session:
+    """
+
+    Args:
+        max_connections (int): Maximum number of open connections per host
+
+    Returns:
+        requests.Session: Session with a keep-alive pool shared by all fetchers,
+        requests block while the per-host limit is reached
+
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=max_connections,
+                          pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 class Fetcher:
 
     def __init__(self, api_url: str, query_parameters_file: str, db_name: str,
                  table_name: str, columns: list[str], area_path: str,
                  description_path: str, timeframe_path: str, age_path: str,
-                 combinations_order: list[str]):
+                 combinations_order: list[str], stream: bool = False,
+                 archive: Optional[RawArchive] = None):
 
         self.api_url = api_url
         self.query_parameters_file = query_parameters_file
@@ -29,6 +191,10 @@ class Fetcher:
         self.timeframe_path = timeframe_path
         self.age_path = age_path
         self.combinations_order = combinations_order
+        self.stream = stream
+        self.archive = archive
+        # when the data being decoded was requested, stored as last_updated
+        self.fetched_at: Optional[datetime] = None
 
         with open(self.query_parameters_file, 'r') as file:
             query_data = json.load(file)
@@ -36,18 +202,109 @@ class Fetcher:
 
 
 
-    def fetch_data(self) -> Dict[str, Any]:
+    def fetch_data(self,
+                   session: Optional[requests.Session] = None,
+                   query: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
 
+        Args:
+            session (requests.Session): Shared session, a one-off connection
+            is used when omitted
+            query (Dict[str, Any]): PxWeb query, defaults to the config query
+
         Returns: Dictionary with the json formatted data
 
         """
         logger.info("[-] Fetching data for %s", self.table_name)
-        response = requests.post(url=self.api_url,
-                                 json=self.query_parameters,
-                                 timeout=5)
-        response.raise_for_status()
-        return response.json()
+        http = session if session is not None else requests
+        self.fetched_at = datetime.now()
+        return self.fetch_json(http, query or self.query_parameters)
+
+
+
+    def fetch_json(self, http: Any, query: Dict[str, Any],
+                   piece: Optional[int] = None) -> Dict[str, Any]:
+        """
+
+        Posts the query and archives the raw response before decoding it
+
+        Args:
+            http (Any): Session or the requests module
+            query (Dict[str, Any]): PxWeb query
+            piece (int): Position of the query among the pieces of a split
+            query, kept with the archived response to replay them in order
+
+        Returns:
+            Dict[str, Any]: Json formatted data
+
+        """
+        body = self.post(http, query).content
+        entry = self.archive_entry(query, piece)
+        if entry is not None:
+            for _ in entry.tee([body]):
+                pass
+            entry.commit()
+        return json.loads(body)
+
+
+
+    def archive_entry(self, query: Dict[str, Any],
+                      piece: Optional[int] = None) -> Optional[ArchiveEntry]:
+        """
+
+        Args:
+            query (Dict[str, Any]): Query whose response is about to be read
+            piece (int): Position of the query in a split query
+
+        Returns:
+            Optional[ArchiveEntry]: Entry to write the raw response into, None
+            when responses are not archived
+
+        """
+        if self.archive is None or not ARCHIVE_RESPONSES:
+            return None
+        try:
+            return self.archive.open(
+                self.table_name, query,
+                fetched_at=self.fetched_at.isoformat(),
+                piece=piece or 0,
+                api_url=self.api_url,
+                config=query_hash(self.query_parameters))
+        except OSError as e:
+            logger.warning("Archiving %s failed: %s", self.table_name, e)
+            return None
+
+
+
+    def post(self, http: Any, query: Dict[str, Any],
+             stream: bool = False) -> requests.Response:
+        """
+
+        Posts the query, retrying connection errors, timeouts, 429 and 5xx
+        responses with exponential backoff or the delay PxWeb asks for
+
+        Args:
+            http (Any): Session or the requests module
+            query (Dict[str, Any]): PxWeb query
+            stream (bool): Leave the body unread
+
+        Returns:
+            requests.Response: Successful response
+
+        """
+        for attempt in range(FETCH_RETRIES + 1):
+            try:
+                response = http.post(url=self.api_url, json=query, timeout=5,
+                                     stream=stream)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.RequestException as e:
+                delay = _retry_delay(attempt, e)
+                if delay is None or attempt == FETCH_RETRIES:
+                    raise
+                logger.warning("Request for %s failed (%s), retrying in %.1fs",
+                               self.table_name, e, delay)
+                time.sleep(delay)
 
 
 
@@ -63,223 +320,818 @@ class Fetcher:
         """
 
         logger.info(f"[-] Parsing data for {self.table_name}")
-        dimensions = {
-            'area':
-                list(data['dimension'][self.area_path]['category']['label'].
-                     values()) if self.area_path in data['dimension'] else [],
-            'description':
-                list(data['dimension'][self.description_path]['category']
-                     ['label'].values())
-                if self.description_path in data['dimension'] else [],
-            'timeframe':
-                list(data['dimension'][self.timeframe_path]['category']
-                     ['label'].values()) if self.timeframe_path != '' and
-                self.timeframe_path in data['dimension'] else [],
-            'age':
-                list(data['dimension'][self.age_path]['category']
-                     ['label'].values()) if self.age_path != '' and
-                self.age_path in data['dimension'] else []
+        df = self.decode_values(data, data['value'])
+
+        logger.info("[✓] Successfully parsed %s records in %s", len(df),
+                    self.db_name)
+        return df
+
+
+
+    def dimension_paths(self) -> Dict[str, str]:
+        """
+
+        Returns:
+            Dict[str, str]: Column name to JSON-stat dimension code, for the
+            columns taken from the cube dimensions
+
+        """
+        paths = {
+            'area': self.area_path,
+            'description': self.description_path,
+            'timeframe': self.timeframe_path,
+            'age': self.age_path,
+        }
+        return {
+            column: paths[column] for column in self.combinations_order
+            if paths[column] != ''
         }
 
-        param_lists = [dimensions[param] for param in self.combinations_order]
-        values = data['value']
 
-        records = []
-        for idx, combo in enumerate(product(*param_lists)):
 
-            if idx >= len(values):
-                break
+    def decode_values(self, data: Dict[str, Any], values: list,
+                      offset: int = 0) -> pd.DataFrame:
+        """
 
-            param_values = dict(zip(self.combinations_order, combo))
-            record = [idx]
+        Builds the dimension columns from the JSON-stat `id`/`size` metadata
+        with integer arithmetic instead of walking every combination
 
-            for c in self.columns[1:-2]:
+        Args:
+            data (Dict[str, Any]): Json formatted data, only the dimension
+            metadata is read
+            values (list): Cell values in JSON-stat row-major order
+            offset (int): Position of the first value in the whole cube
 
-                record.append(param_values.get(c))
+        Returns:
+            pd.DataFrame: Dataframe containing the parsed data
+
+        """
+        dimension = data['dimension']
+        paths = self.dimension_paths()
+        if 'id' in data and 'size' in data:
+            ids, sizes = data['id'], data['size']
+        else:
+            ids = [paths[c] for c in self.combinations_order if c in paths]
+            sizes = [len(dimension[p]['category']['label']) for p in ids]
 
-            record.append(values[idx])
-            record.append(LAST_UPDATED_TIME)
-            records.append(tuple(record))
+        positions = np.arange(offset, offset + len(values), dtype=np.int64)
+        strides = np.cumprod([1] + sizes[:0:-1])[::-1]
 
-        logger.info("[✓] Successfully parsed %s records in %s", len(records),
-                    self.db_name)
-        return pd.DataFrame(records, columns=self.columns)
+        columns: Dict[str, Any] = {'id': positions}
+        for column in self.columns[1:-2]:
+            # area_code holds the value codes of the area dimension
+            path = paths.get('area' if column == 'area_code' else column)
+            if path is None or path not in ids:
+                columns[column] = None
+                continue
 
+            k = ids.index(path)
+            codes = (positions // strides[k]) % sizes[k]
+            columns[column] = _category_column(dimension[path]['category'],
+                                               codes,
+                                               use_labels=column != 'area_code')
 
+        value = np.asarray(values, dtype=np.float64)
+        if not np.isnan(value).any() and np.array_equal(value, np.floor(value)):
+            value = value.astype(np.int64)
+        columns['value'] = value
+        columns['last_updated'] = self.fetched_at or datetime.now()
 
-    def save_data(self, df: pd.DataFrame):
+        return pd.DataFrame(columns, columns=self.columns, copy=False)
+
+
+
+    def fetch_batches(self, session: Optional[requests.Session] = None,
+                      query: Optional[Dict[str, Any]] = None,
+                      timings: Optional[Dict[str, float]] = None
+                      ) -> Iterator[pd.DataFrame]:
+        """
+
+        Streams the response and decodes its values in batches, the whole
+        document is never held in memory
+
+        Args:
+            session (requests.Session): Shared session, a one-off connection
+            is used when omitted
+            query (Dict[str, Any]): PxWeb query, defaults to the config query
+            timings (Dict[str, float]): Receives the seconds spent reading
+            the response as `fetch` and decoding it as `parse`
+
+        Returns:
+            Iterator[pd.DataFrame]: Dataframes of consecutive cube slices
+
+        """
+        logger.info("[-] Streaming data for %s", self.table_name)
+        timings = timings if timings is not None else {}
+        timings.setdefault('fetch', 0.0)
+        timings.setdefault('parse', 0.0)
+        http = session if session is not None else requests
+        started = time.perf_counter()
+        self.fetched_at = datetime.now()
+        query = query or self.query_parameters
+        with self.post(http, query, stream=True) as response:
+            chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+            entry = self.archive_entry(query)
+            if entry is not None:
+                chunks = entry.tee(chunks)
+            reader = JsonStatStream(chunks, batch_size=STREAM_BATCH_SIZE)
+            try:
+                for header, offset, values in reader.batches():
+                    parsing = time.perf_counter()
+                    timings['fetch'] += parsing - started
+                    df = self.decode_values(header, values, offset)
+                    timings['parse'] += time.perf_counter() - parsing
+                    yield df
+                    # time spent by the consumer saving the batch is not ours
+                    started = time.perf_counter()
+            except BaseException:
+                if entry is not None:
+                    entry.discard()
+                raise
+            if entry is not None:
+                entry.commit()
+
+
+
+    def fetch_pieces(self, pieces: List[Dict[str, Any]],
+                     session: Optional[requests.Session] = None,
+                     timings: Optional[Dict[str, float]] = None
+                     ) -> Iterator[pd.DataFrame]:
+        """
+
+        Downloads the pieces of a split query in parallel, each with retries,
+        and decodes them in order as they arrive. At most as many responses as
+        there are connections are held in memory.
+
+        Args:
+            pieces (List[Dict[str, Any]]): Queries from split_query
+            session (requests.Session): Shared session, its pool bounds the
+            parallel requests together with MAX_CONNECTIONS
+            timings (Dict[str, float]): Receives the seconds spent waiting for
+            responses as `fetch` and decoding them as `parse`
+
+        Returns:
+            Iterator[pd.DataFrame]: Dataframe of every piece
+
+        """
+        logger.info("[-] Fetching %s in %s pieces", self.table_name, len(pieces))
+        timings = timings if timings is not None else {}
+        timings.setdefault('fetch', 0.0)
+        timings.setdefault('parse', 0.0)
+        http = session if session is not None else requests
+        # every piece belongs to the same fetch
+        self.fetched_at = datetime.now()
+        workers = max(1, min(len(pieces), MAX_CONNECTIONS))
+        queue = enumerate(pieces)
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix=f"{self.table_name}-piece") \
+                as executor:
+            pending = deque(executor.submit(self.fetch_json, http, query, piece)
+                            for piece, query in itertools.islice(queue, workers))
+            try:
+                started = time.perf_counter()
+                while pending:
+                    data = pending.popleft().result()
+                    piece, query = next(queue, (None, None))
+                    if query is not None:
+                        pending.append(executor.submit(self.fetch_json, http,
+                                                       query, piece))
+                    parsing = time.perf_counter()
+                    timings['fetch'] += parsing - started
+                    df = self.decode_values(data, data['value'])
+                    del data
+                    timings['parse'] += time.perf_counter() - parsing
+                    yield df
+                    started = time.perf_counter()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+
+    def save_data(self, df: pd.DataFrame, prune: bool = False):
         """
 
         Args:
             df (pd.DataFrame): Dataframe to be saved
+            prune (bool): Delete the stored cells missing from the dataframe
+
+        Returns:
+            None: This function does not return a value
+
+        """
+        self.save_batches([df], prune=prune)
+
+
+
+    def key_columns(self) -> list[str]:
+        """
+
+        Returns:
+            list[str]: Columns identifying a cell, (area, timeframe,
+            description, age) limited to the columns of the table
+
+        """
+        return [c for c in self.columns if c in ('area', 'timeframe',
+                                                 'description', 'age')]
+
+
+
+    def ensure_table(self, conn: sqlite3.Connection):
+        """
+
+        Creates the target table with its unique cell key and covering indexes
+        from the model of the table, tables left by the former
+        `to_sql(if_exists='replace')` layout are recreated
+
+        Args:
+            conn (sqlite3.Connection): Open connection inside the write
+            transaction
 
         Returns:
             None: This function does not return a value
 
         """
+        table = self.table_name
+        model = Base.metadata.tables[table]
+        info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        layout = [column[1] for column in info]
+        has_primary_key = any(column[1] == 'id' and column[5] for column in info)
+        if info and (layout != [c.name for c in model.columns]
+                     or not has_primary_key):
+            logger.info("Recreating %s with the keyed layout", table)
+            conn.execute(f'DROP TABLE "{table}"')
+        create_table(conn, table)
+
+
+
+    def save_batches(self, batches: Iterable[pd.DataFrame],
+                     prune: bool = False) -> int:
+        """
+
+        Writes the batches into a staging table, then inserts new cells and
+        updates changed ones in a single transaction. Unchanged rows are not
+        touched and readers see the previous data until the commit.
+
+        Args:
+            batches (Iterable[pd.DataFrame]): Dataframes to be saved
+            prune (bool): The batches hold the whole config query, stored
+            cells missing from them were dropped from the query and are
+            deleted. Delta fetches keep the cells of earlier periods.
+
+        Returns:
+            int: Number of inserted, updated or deleted rows
+
+        """
+        table = self.table_name
+        staging = f"{table}__staging"
+        keys = self.key_columns()
+        columns = ', '.join(self.columns[1:])
+        received = 0
         try:
             conn = sqlite3.connect(self.db_name)
-            df.to_sql(self.table_name, conn, if_exists='replace', index=False)
+            try:
+                for df in batches:
+                    with _db_write_lock:
+                        df.to_sql(staging, conn, index=False,
+                                  if_exists='replace' if received == 0 else 'append')
+                        conn.commit()
+                    received += len(df)
 
-            conn.commit()
-            conn.close()
-        except sqlite3.Error as e:
-            logger.error("Data db saving error for %s", self.table_name)
+                if received == 0:
+                    logger.warning("No rows received for %s", table)
+                    return 0
+
+                with _db_write_lock:
+                    conn.execute("BEGIN")
+                    self.ensure_table(conn)
+                    before = conn.total_changes
+                    conn.execute(
+                        f'INSERT INTO "{table}" ({columns}) '
+                        f'SELECT {columns} FROM "{staging}" WHERE true '
+                        f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET '
+                        f'value = excluded.value, '
+                        f'last_updated = excluded.last_updated '
+                        f'WHERE "{table}".value IS NOT excluded.value')
+                    if prune:
+                        # the join finds the kept rows through the unique
+                        # cell index, the staging table has no index
+                        match = ' AND '.join(f't.{k} = s.{k}' for k in keys)
+                        conn.execute(
+                            f'DELETE FROM "{table}" WHERE id NOT IN ('
+                            f'SELECT t.id FROM "{staging}" s '
+                            f'JOIN "{table}" t ON {match})')
+                    changed = conn.total_changes - before
+                    conn.execute(f'DROP TABLE "{staging}"')
+                    conn.commit()
+            finally:
+                try:
+                    # a failed save rolls back and leaves no staging table
+                    with _db_write_lock:
+                        conn.rollback()
+                        conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+                        conn.commit()
+                finally:
+                    conn.close()
+        except sqlite3.Error:
+            logger.error("Data db saving error for %s", table)
             raise
 
-        except Exception as e:
-            logger.error("Error saving data for %s", self.table_name)
+        except Exception:
+            logger.error("Error saving data for %s", table)
             raise
 
+        logger.info("[✓] %s of %s received rows changed in %s", changed,
+                    received, table)
+        metrics.FETCHER_ROWS.labels(table, 'received').set(received)
+        metrics.FETCHER_ROWS.labels(table, 'changed').set(changed)
+        return changed
+
+
+
+    def remote_updated(self,
+                       session: Optional[requests.Session] = None) -> Optional[str]:
+        """
+
+        Reads the last update time of the table from the PxWeb folder listing
+
+        Args:
+            session (requests.Session): Shared session
+
+        Returns:
+            Optional[str]: `updated` timestamp, None if it could not be read
+
+        """
+        folder, table_id = self.api_url.rsplit('/', 1)
+        http = session if session is not None else requests
+        try:
+            response = http.get(url=f"{folder}/", timeout=5)
+            response.raise_for_status()
+            for entry in response.json():
+                if entry.get('id') == table_id:
+                    return entry.get('updated')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning("Could not read metadata of %s: %s", self.table_name, e)
+        return None
+
+
+
+    def signature(self) -> str:
+        """
+
+        Returns:
+            str: Hash of the query and table layout, stored data can only be
+            extended with delta queries while it stays the same
+
+        """
+        content = json.dumps([self.columns, self.query_parameters], sort_keys=True)
+        return hashlib.sha1(content.encode()).hexdigest()
+
 
 
-    def fetch_parse_save(self) -> bool:
+    def load_state(self) -> Optional[Dict[str, Any]]:
         """
 
+        Returns:
+            Optional[Dict[str, Any]]: Stored fetch state of the table, None
+            before the first successful fetch
+
+        """
+        conn = sqlite3.connect(self.db_name)
+        try:
+            conn.execute(STATE_TABLE_SQL)
+            row = conn.execute(
+                "SELECT updated, signature FROM fetch_state WHERE table_name = ?",
+                (self.table_name,)).fetchone()
+            if row is None:
+                return None
+
+            latest = None
+            if self.timeframe_path != '':
+                latest = conn.execute(
+                    f'SELECT MAX(timeframe) FROM "{self.table_name}"').fetchone()[0]
+            return {'updated': row[0], 'signature': row[1], 'latest': latest}
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
+
+
+
+    def save_state(self, updated: Optional[str]):
+        """
+
+        Args:
+            updated (Optional[str]): PxWeb `updated` timestamp of the fetched data
+
+        Returns:
+            None: This function does not return a value
+
+        """
+        with _db_write_lock:
+            conn = sqlite3.connect(self.db_name)
+            try:
+                conn.execute(STATE_TABLE_SQL)
+                conn.execute(
+                    "INSERT OR REPLACE INTO fetch_state "
+                    "(table_name, updated, signature, fetched_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (self.table_name, updated, self.signature(), datetime.now()))
+                conn.commit()
+            finally:
+                conn.close()
+
+
+
+    def delta_query(self, latest: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+
+        Args:
+            latest (Optional[str]): Latest period already stored
+
+        Returns:
+            Optional[Dict[str, Any]]: Config query limited to the latest stored
+            period and newer ones (the latest period is fetched again because
+            it can still be revised), None if there is nothing to fetch
+
+        """
+        if self.timeframe_path == '' or latest is None:
+            return self.query_parameters
+
+        query = copy.deepcopy(self.query_parameters)
+        for item in query['query']:
+            selection = item['selection']
+            if item['code'] == self.timeframe_path and selection['filter'] == 'item':
+                selection['values'] = [v for v in selection['values'] if v >= latest]
+                if not selection['values']:
+                    return None
+        return query
+
+
+
+    def replay(self) -> bool:
+        """
+
+        Rebuilds the table from the archived responses to its current config
+        query, oldest first so that later responses overwrite earlier ones,
+        without any request
+
+        Returns:
+            bool: True if success, False if nothing is archived
+
+        """
+        archived = self.archive.entries(self.table_name) \
+            if self.archive is not None else []
+        config = query_hash(self.query_parameters)
+        entries = [entry for entry in archived if entry.get('config') == config]
+        if len(entries) < len(archived):
+            logger.info("[=] %s archived responses of %s belong to an older "
+                        "config, skipped", len(archived) - len(entries),
+                        self.table_name)
+        if not entries:
+            logger.warning("No archived responses of %s", self.table_name)
+            return False
+
+        for entry in entries:
+            self.fetched_at = datetime.fromisoformat(entry['fetched_at'])
+            reader = JsonStatStream(self.archive.read(entry),
+                                    batch_size=STREAM_BATCH_SIZE)
+            self.save_batches(self.decode_values(header, values, offset)
+                              for header, offset, values in reader.batches())
+
+        # unknown remote state, the next live refresh fetches new periods
+        self.save_state(None)
+        logger.info("[✓] Replayed %s archived responses of %s", len(entries),
+                    self.table_name)
+        return True
+
+
+
+    def fetch_parse_save(self,
+                         session: Optional[requests.Session] = None,
+                         full: bool = False) -> bool:
+        """
+
+        Skips tables PxWeb reports as unchanged since the last fetch and only
+        requests new periods of time-dimensioned tables. Queries over the
+        PxWeb cell limit are split and fetched in parallel pieces.
+
+        Args:
+            session (requests.Session): Shared session passed to fetch_data
+            full (bool): Fetch the whole config query regardless of stored data
+
         Returns:
             bool: True if success, False if failed
 
         """
         try:
-            data = self.fetch_data()
-            df = self.parse_data(data=data)
-            self.save_data(df=df)
+            updated = self.remote_updated(session=session)
+            state = None if full else self.load_state()
+            incremental = state is not None and state['signature'] == self.signature()
+
+            if incremental and updated is not None and updated == state['updated']:
+                logger.info("[=] %s unchanged since %s, skipped", self.table_name,
+                            updated)
+                metrics.FETCHER_LAST_SUCCESS.labels(self.table_name).set_to_current_time()
+                return True
+
+            query = self.delta_query(state['latest']) if incremental \
+                else self.query_parameters
+            timings: Dict[str, float] = {}
+            pieces = split_query(query, MAX_CELLS) if query is not None else []
+            if query is None:
+                logger.info("[=] No new periods for %s", self.table_name)
+            elif len(pieces) > 1:
+                started = time.perf_counter()
+                self.save_batches(self.fetch_pieces(pieces, session=session,
+                                                    timings=timings),
+                                  prune=not incremental)
+                timings['save'] = time.perf_counter() - started \
+                    - timings['fetch'] - timings['parse']
+            elif self.stream:
+                started = time.perf_counter()
+                self.save_batches(self.fetch_batches(session=session, query=query,
+                                                     timings=timings),
+                                  prune=not incremental)
+                timings['save'] = time.perf_counter() - started \
+                    - timings['fetch'] - timings['parse']
+            else:
+                started = time.perf_counter()
+                data = self.fetch_data(session=session, query=query)
+                timings['fetch'] = time.perf_counter() - started
+                df = self.parse_data(data=data)
+                timings['parse'] = time.perf_counter() - started - timings['fetch']
+                self.save_data(df=df, prune=not incremental)
+                timings['save'] = time.perf_counter() - started \
+                    - timings['fetch'] - timings['parse']
+
+            self.save_state(updated)
+            if not incremental and self.archive is not None and ARCHIVE_RESPONSES:
+                # the full fetch supersedes every earlier response of the table
+                try:
+                    self.archive.prune(self.table_name,
+                                       self.fetched_at.isoformat())
+                except OSError as e:
+                    logger.warning("Pruning the archive of %s failed: %s",
+                                   self.table_name, e)
+            for stage, seconds in timings.items():
+                metrics.FETCHER_STAGE_DURATION.labels(self.table_name, stage).set(seconds)
+            metrics.FETCHER_LAST_SUCCESS.labels(self.table_name).set_to_current_time()
             logger.info("[✓] Fetched, parsed and saved for %s", self.table_name)
             return True
 
         except requests.exceptions.RequestException as e:
-            logger.error("Error")
+            logger.error("Request for %s failed: %s", self.table_name, e)
+            metrics.FETCHER_FAILURES.labels(self.table_name).inc()
             return False
 
         except Exception as e:
-            logger.error("Error")
+            logger.error("Fetching %s failed: %s", self.table_name, e)
+            metrics.FETCHER_FAILURES.labels(self.table_name).inc()
             return False
 
 
 BASE_DIR = os.path.dirname(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-LAST_UPDATED_TIME = datetime.now()
-
-crime_rate_fetcher = Fetcher(
-    api_url=
-    'https://pxdata.stat.fi:443/PxWeb/api/v1/en/StatFin/rpk/statfin_rpk_pxt_13it.px',
-    query_parameters_file=os.path.join(BASE_DIR, "config", "crime_rate.json"),
-    db_name=os.path.join(BASE_DIR, "db", "combined_db.sqlite3"),
-    table_name='crime_rate',
-    area_path='Kunta',
-    description_path='Rikosryhmä ja teonkuvauksen tarkenne',
-    timeframe_path='Kuukausi',
-    age_path='',
-    combinations_order=['timeframe', 'area', 'description'],
-    columns=['id', 'area', 'timeframe', 'description', 'value', 'last_updated'],
-)
-
-demographics_fetcher = Fetcher(
-    api_url=
-    'https://pxdata.stat.fi:443/PxWeb/api/v1/en/StatFin/vaerak/statfin_vaerak_pxt_11ra.px',
-    query_parameters_file=os.path.join(BASE_DIR, "config", "demographics.json"),
-    db_name=os.path.join(BASE_DIR, "db", "combined_db.sqlite3"),
-    table_name='demographics',
-    area_path='Alue',
-    description_path='Tiedot',
-    timeframe_path='',
-    age_path='',
-    combinations_order=['area', 'description'],
-    columns=['id', 'area', 'description', 'value', 'last_updated'],
-)
-
-education_fetcher = Fetcher(
-    api_url=
-    'https://pxdata.stat.fi:443/PxWeb/api/v1/en/StatFin/vkour/statfin_vkour_pxt_12bq.px',
-    query_parameters_file=os.path.join(BASE_DIR, "config", "education.json"),
-    db_name=os.path.join(BASE_DIR, "db", "combined_db.sqlite3"),
-    table_name='education',
-    area_path='Alue',
-    description_path='Koulutusaste',
-    timeframe_path='',
-    age_path='Ikä',
-    combinations_order=['area', 'age', 'description'],
-    columns=['id', 'area', 'age', 'description', 'value', 'last_updated'],
-)
-
-unemployment_fetcher = Fetcher(
-    api_url=
-    'https://pxdata.stat.fi:443/PxWeb/api/v1/en/StatFin/tyonv/statfin_tyonv_pxt_12r5.px',
-    query_parameters_file=os.path.join(BASE_DIR, "config",
-                                       "employment_rate.json"),
-    db_name=os.path.join(BASE_DIR, "db", "combined_db.sqlite3"),
-    table_name='employment_rate',
-    area_path='Alue',
-    description_path='Tiedot',
-    timeframe_path='Kuukausi',
-    age_path='',
-    combinations_order=['area', 'timeframe', 'description'],
-    columns=['id', 'area', 'timeframe', 'description', 'value', 'last_updated'],
-)
-
-income_fetcher = Fetcher(
-    api_url=
-    'https://pxdata.stat.fi:443/PxWeb/api/v1/en/StatFin/tjt/statfin_tjt_pxt_118w.px',
-    query_parameters_file=os.path.join(BASE_DIR, "config", "income.json"),
-    db_name=os.path.join(BASE_DIR, "db", "combined_db.sqlite3"),
-    table_name='income',
-    area_path='Alue',
-    description_path='Tiedot',
-    timeframe_path='',
-    age_path='',
-    combinations_order=['description', 'area'],
-    columns=['id', 'area', 'description', 'value', 'last_updated'],
-)
-
-traffic_fetchers = Fetcher(
-    api_url=
-    'https://pxdata.stat.fi:443/PxWeb/api/v1/en/StatFin/ton/statfin_ton_pxt_12qh.px',
-    query_parameters_file=os.path.join(BASE_DIR, "config",
-                                       "traffic_accidents.json"),
-    db_name=os.path.join(BASE_DIR, "db", "combined_db.sqlite3"),
-    table_name='traffic_accidents',
-    area_path='Alue',
-    description_path='Tiedot',
-    timeframe_path='Vuosi',
-    age_path='',
-    combinations_order=['area', 'timeframe', 'description'],
-    columns=['id', 'area', 'timeframe', 'description', 'value', 'last_updated'],
-)
-
-
-def run_all_fetchers():
+DB_DIR = os.getenv("ODFLOW_DB_DIR", os.path.join(BASE_DIR, "db"))
+DB_NAME = os.path.join(DB_DIR, "combined_db.sqlite3")
+SNAPSHOT_PATH = os.path.join(DB_DIR, "snapshot.pickle")
+COLUMNAR_DIR = os.path.join(DB_DIR, "columnar")
+REFRESH_LOCK_PATH = os.path.join(DB_DIR, "refresh.lock")
+ARCHIVE_DIR = os.getenv("FETCHER_ARCHIVE_DIR", os.path.join(DB_DIR, "archive"))
+ARCHIVE_RESPONSES = os.getenv("FETCHER_ARCHIVE", "1") == "1"
+PXWEB_BASE_URL = os.getenv("PXWEB_BASE_URL", "https://pxdata.stat.fi:443")
+MAX_CONNECTIONS = int(os.getenv("FETCHER_MAX_CONNECTIONS", "4"))
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_BATCH_SIZE = int(os.getenv("FETCHER_STREAM_BATCH_SIZE", "50000"))
+# cells PxWeb returns for one query, larger queries are split
+MAX_CELLS = int(os.getenv("PXWEB_MAX_CELLS", "100000"))
+FETCH_RETRIES = int(os.getenv("FETCHER_RETRIES", "3"))
+RETRY_BACKOFF = float(os.getenv("FETCHER_RETRY_BACKOFF", "1"))
+
+def prepare_build(db_name: str, empty: bool = False) -> str:
     """
 
+    Copies the live database next to itself, the fetchers write into the copy
+    while readers keep using the live file
+
+    Args:
+        db_name (str): Path of the live database
+        empty (bool): Start from an empty database instead of a copy
+
     Returns:
-        None: This function does not return a value
+        str: Path of the build database
 
     """
-    fetchers = [("Crime rate fetcher", crime_rate_fetcher),
-                ("Demographics fetcher", demographics_fetcher),
-                ("Education fetcher", education_fetcher),
-                ("Income fetcher", income_fetcher),
-                ("Unemployment fetcher", unemployment_fetcher),
-                ("Traffic accidents fetcher", traffic_fetchers)]
-
-    res = {}
-    for name, fetcher in fetchers:
+    # unique per run, a leftover of a crashed run is never written again
+    fd, build_name = tempfile.mkstemp(dir=os.path.dirname(db_name),
+                                      prefix=f"{os.path.basename(db_name)}.",
+                                      suffix=".build")
+    os.close(fd)
+
+    try:
+        target = sqlite3.connect(build_name)
         try:
-            success = fetcher.fetch_parse_save()
-            res[name] = success
+            if not empty and os.path.exists(db_name):
+                source = sqlite3.connect(db_name)
+                try:
+                    source.backup(target)
+                finally:
+                    source.close()
+        finally:
+            target.close()
+    except BaseException:
+        os.remove(build_name)
+        raise
+    return build_name
 
-            if success:
-                logger.info("[✓] Fetcher %s completed successfully\n\n", name)
-            else:
-                logger.warning("Fetcher %s failed", name)
 
-        except Exception as e:
-            res[name] = False
-            print("Error")
+def analyze(db_name: str):
+    """
+
+    Collects the table and index statistics of a loaded database, so that the
+    planner picks the covering indexes for the grouping queries of the
+    snapshot
+
+    Args:
+        db_name (str): Path of the sqlite database
+
+    """
+    conn = sqlite3.connect(db_name)
+    try:
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def publish_build(build_name: str, db_name: str, snapshot_path: str,
+                  columnar_dir: str):
+    """
+
+    Scores the safety ratings, analyzes the build database and writes its
+    columnar store and snapshot, then renames the build over the live database, every
+    file is replaced atomically
+
+    Args:
+        build_name (str): Path of the build database
+        db_name (str): Path of the live database
+        snapshot_path (str): Destination of the snapshot file
+        columnar_dir (str): Directory of the columnar store
+
+    """
+    write_safety_ratings(build_name)
+    analyze(build_name)
+    write_columnar(build_name, columnar_dir)
+    write_snapshot(build_name, snapshot_path, columnar_dir)
+    with open(build_name, 'rb+') as file:
+        os.fsync(file.fileno())
+    os.replace(build_name, db_name)
+
+
+@contextmanager
+def refresh_lock(path: str = REFRESH_LOCK_PATH) -> Iterator[None]:
+    """
+
+    Serialises refreshes across every process sharing the data directory,
+    API workers and the refresh worker alike. A refresh started while another
+    one runs waits for it.
+
+    Args:
+        path (str): Lock file next to the live database
+
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def run_fetcher(name: str, fetcher: Fetcher,
+                session: Optional[requests.Session] = None,
+                full: bool = False, db_name: Optional[str] = None,
+                replay: bool = False) -> bool:
+    """
+
+    Args:
+        name (str): Name of the fetcher used in the logs
+        fetcher (Fetcher): Fetcher to run
+        session (requests.Session): Shared session
+        full (bool): Fetch the whole config query regardless of stored data
+        db_name (str): Database to write instead of the fetcher's own
+        replay (bool): Rebuild from the archived responses instead of fetching
+
+    Returns:
+        bool: True if success, False if failed
+
+    """
+    try:
+        if db_name is not None and db_name != fetcher.db_name:
+            fetcher = copy.copy(fetcher)
+            fetcher.db_name = db_name
+        if replay:
+            success = fetcher.replay()
+        else:
+            success = fetcher.fetch_parse_save(session=session, full=full)
+
+        if success:
+            logger.info("[✓] Fetcher %s completed successfully\n\n", name)
+        else:
+            logger.warning("Fetcher %s failed", name)
+        return success
+
+    except Exception as e:
+        logger.error("Fetcher %s raised %s", name, e)
+        return False
+
+
+def run_all_fetchers(concurrent: bool = True,
+                     max_connections: int = MAX_CONNECTIONS,
+                     full: bool = False, replay: bool = False):
+    """
+
+    Fetches into a copy of the live database and publishes it together with
+    a new snapshot once every fetcher has finished, one refresh at a time
+    across processes
+
+    Args:
+        concurrent (bool): Run the fetchers in parallel threads, each one parses
+        and saves while the others are still downloading
+        max_connections (int): Maximum number of parallel connections to the
+        PxWeb host
+        full (bool): Refetch every table completely instead of skipping
+        unchanged tables and fetching only new periods
+        replay (bool): Rebuild the whole database from the raw response
+        archive without any request, e.g. after a parser fix. Nothing is
+        published unless every table could be replayed
+
+    Returns:
+        None: This function does not return a value
+
+    """
+    with refresh_lock():
+        _run_all_fetchers(concurrent, max_connections, full, replay)
+
+
+def _run_all_fetchers(concurrent: bool, max_connections: int, full: bool,
+                      replay: bool):
+    fetchers = list(load_fetchers())
+
+    try:
+        build_name = prepare_build(DB_NAME, empty=replay)
+    except (sqlite3.Error, OSError):
+        logger.exception("Could not copy %s, refresh aborted", DB_NAME)
+        return
+
+    with create_session(max_connections) as session:
+        if concurrent:
+            with ThreadPoolExecutor(max_workers=len(fetchers),
+                                    thread_name_prefix="fetcher") as executor:
+                futures = {
+                    name: executor.submit(run_fetcher, name, fetcher, session,
+                                          full, build_name, replay)
+                    for name, fetcher in fetchers
+                }
+                res = {name: future.result() for name, future in futures.items()}
+        else:
+            res = {
+                name: run_fetcher(name, fetcher, session, full, build_name,
+                                  replay)
+                for name, fetcher in fetchers
+            }
 
     successful_fetchers = sum(1 for s in res.values() if s)
     p = "█" * successful_fetchers + "-" * (len(fetchers) - successful_fetchers)
     logger.info(f"\n{'-' * 50}\nAll fetchers completed. [{p}] {successful_fetchers}/{len(fetchers)} \n{'-' * 50}")
 
+    if not replay and ARCHIVE_RESPONSES:
+        for archive in {fetcher.archive for _, fetcher in fetchers} - {None}:
+            try:
+                removed = archive.collect_garbage()
+                logger.info("[✓] %s unreferenced archived responses removed",
+                            removed)
+            except OSError as e:
+                logger.warning("Cleaning the archive failed: %s", e)
+
+    # a replay starts from an empty database, publishing it with a table
+    # missing would drop that table from the live data
+    if replay and successful_fetchers < len(fetchers):
+        logger.error("Replay incomplete, %s is not published and the live "
+                     "database is kept", build_name)
+        os.remove(build_name)
+        return
+
+    try:
+        publish_build(build_name, DB_NAME, SNAPSHOT_PATH, COLUMNAR_DIR)
+    except (sqlite3.Error, OSError):
+        logger.exception("Publishing %s failed, previous snapshot is kept",
+                         build_name)
+        if os.path.exists(build_name):
+            os.remove(build_name)
+
 
 if __name__ == "__main__":
     run_all_fetchers()
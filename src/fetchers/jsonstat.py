@@ -0,0 +1,163 @@
+import codecs
+import json
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+HEADER_KEYS = ('id', 'size', 'dimension')
+
+Batch = Tuple[Dict[str, Any], int, np.ndarray]
+
+
+class JsonStatStream:
+    """
+    Incremental reader for JSON-stat2 documents
+
+    Everything except the top level `value` array is kept as text and parsed as
+    the header, the numbers of the `value` array are decoded in batches while
+    the document is still arriving.
+
+    Attributes:
+        header (Dict[str, Any]): Document without its values, available once
+        the `value` array starts if the dimension metadata precedes it
+    """
+
+    def __init__(self, chunks: Iterable[bytes], batch_size: int = 50_000):
+        self.chunks = chunks
+        self.batch_size = batch_size
+        self.header: Optional[Dict[str, Any]] = None
+
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._state = 'header'
+        self._head = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = 0
+        self._last_key: Optional[str] = None
+        self._numbers = ''
+        self._suffix: list[str] = []
+        self._pending: list[np.ndarray] = []
+        self._pending_size = 0
+        self._held: list[np.ndarray] = []
+        self._offset = 0
+
+    def batches(self) -> Iterator[Batch]:
+        """
+
+        Returns:
+            Iterator[Batch]: (header, offset, values) for every batch, offset
+            being the position of the first value in the cube
+
+        """
+        for chunk in self.chunks:
+            yield from self._feed(self._decoder.decode(chunk))
+        yield from self._feed(self._decoder.decode(b'', final=True))
+
+        if self._state != 'suffix':
+            raise ValueError("JSON-stat document has no complete value array")
+
+        self.header = json.loads(self._head + 'null' + ''.join(self._suffix))
+        yield from self._flush(final=True)
+
+    def _feed(self, text: str) -> Iterator[Batch]:
+        while text:
+            if self._state == 'header':
+                text = self._scan_header(text)
+            elif self._state == 'array':
+                text = text.lstrip()
+                if not text:
+                    return
+                if text[0] != '[':
+                    raise ValueError("JSON-stat value is not an array")
+                self._start_values()
+                text = text[1:]
+            elif self._state == 'values':
+                text = yield from self._scan_values(text)
+            else:
+                self._suffix.append(text)
+                return
+
+    def _scan_header(self, text: str) -> str:
+        """
+
+        Tracks strings and nesting of the header until the top level `value`
+        key, the header text is kept up to and including its colon
+
+        """
+        self._head += text
+        head = self._head
+        while self._pos < len(head):
+            char = head[self._pos]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = head[self._key_start:self._pos - 1]
+            elif char == '"':
+                self._in_string = True
+                self._key_start = self._pos
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+            elif char == ',':
+                self._last_key = None
+            elif char == ':' and self._depth == 1 and self._last_key == 'value':
+                rest = head[self._pos:]
+                self._head = head[:self._pos]
+                self._state = 'array'
+                return rest
+        return ''
+
+    def _start_values(self):
+        self._state = 'values'
+        partial = json.loads(self._head + 'null}')
+        if all(key in partial for key in HEADER_KEYS):
+            self.header = partial
+
+    def _scan_values(self, text: str):
+        end = text.find(']')
+        if end == -1:
+            self._numbers += text
+            cut = self._numbers.rfind(',')
+            if cut != -1:
+                self._push(self._numbers[:cut])
+                self._numbers = self._numbers[cut + 1:]
+            yield from self._flush()
+            return ''
+
+        self._push(self._numbers + text[:end])
+        self._numbers = ''
+        self._state = 'suffix'
+        yield from self._flush()
+        return text[end + 1:]
+
+    def _push(self, numbers: str):
+        if numbers.strip():
+            values = np.asarray(json.loads(f'[{numbers}]'), dtype=np.float64)
+            self._pending.append(values)
+            self._pending_size += len(values)
+
+    def _flush(self, final: bool = False) -> Iterator[Batch]:
+        if self._pending_size >= self.batch_size or (final and self._pending):
+            self._held.append(np.concatenate(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+        # values that arrive before the dimension metadata are held until the
+        # header is complete
+        if self.header is None:
+            return
+
+        for values in self._held:
+            yield self.header, self._offset, values
+            self._offset += len(values)
+        self._held = []
@@ -0,0 +1,122 @@
+"""
+
+Module for the registry of the fetchers
+
+The definitions are plain data, the Fetcher objects and the ingestion stack
+behind them (pandas, requests, the config queries) are only loaded once a
+refresh asks for them, the API processes never pay for them.
+
+"""
+
+
+import functools
+import os
+from typing import Any, Dict, Tuple
+
+# name used in the logs to the PxWeb table below StatFin and the Fetcher fields
+FETCHERS: Dict[str, Dict[str, Any]] = {
+    "Crime rate fetcher": dict(
+        table='rpk/statfin_rpk_pxt_13it.px',
+        config='crime_rate.json',
+        table_name='crime_rate',
+        area_path='Kunta',
+        description_path='Rikosryhmä ja teonkuvauksen tarkenne',
+        timeframe_path='Kuukausi',
+        age_path='',
+        combinations_order=['timeframe', 'area', 'description'],
+        stream=True,
+        columns=['id', 'area', 'area_code', 'timeframe', 'description', 'value',
+                 'last_updated'],
+    ),
+    "Demographics fetcher": dict(
+        table='vaerak/statfin_vaerak_pxt_11ra.px',
+        config='demographics.json',
+        table_name='demographics',
+        area_path='Alue',
+        description_path='Tiedot',
+        timeframe_path='',
+        age_path='',
+        combinations_order=['area', 'description'],
+        columns=['id', 'area', 'area_code', 'description', 'value',
+                 'last_updated'],
+    ),
+    "Education fetcher": dict(
+        table='vkour/statfin_vkour_pxt_12bq.px',
+        config='education.json',
+        table_name='education',
+        area_path='Alue',
+        description_path='Koulutusaste',
+        timeframe_path='',
+        age_path='Ikä',
+        combinations_order=['area', 'age', 'description'],
+        stream=True,
+        columns=['id', 'area', 'area_code', 'age', 'description', 'value',
+                 'last_updated'],
+    ),
+    "Income fetcher": dict(
+        table='tjt/statfin_tjt_pxt_118w.px',
+        config='income.json',
+        table_name='income',
+        area_path='Alue',
+        description_path='Tiedot',
+        timeframe_path='',
+        age_path='',
+        combinations_order=['description', 'area'],
+        columns=['id', 'area', 'area_code', 'description', 'value',
+                 'last_updated'],
+    ),
+    "Unemployment fetcher": dict(
+        table='tyonv/statfin_tyonv_pxt_12r5.px',
+        config='employment_rate.json',
+        table_name='employment_rate',
+        area_path='Alue',
+        description_path='Tiedot',
+        timeframe_path='Kuukausi',
+        age_path='',
+        combinations_order=['area', 'timeframe', 'description'],
+        columns=['id', 'area', 'area_code', 'timeframe', 'description', 'value',
+                 'last_updated'],
+        stream=True,
+    ),
+    "Traffic accidents fetcher": dict(
+        table='ton/statfin_ton_pxt_12qh.px',
+        config='traffic_accidents.json',
+        table_name='traffic_accidents',
+        area_path='Alue',
+        description_path='Tiedot',
+        timeframe_path='Vuosi',
+        age_path='',
+        combinations_order=['area', 'timeframe', 'description'],
+        columns=['id', 'area', 'area_code', 'timeframe', 'description', 'value',
+                 'last_updated'],
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load_fetchers() -> Tuple[Tuple[str, Any], ...]:
+    """
+
+    Imports the ingestion stack and builds every fetcher, once per process
+
+    Returns:
+        Tuple[Tuple[str, Fetcher], ...]: Name and fetcher of every registered
+        table
+
+    """
+    from fetchers.archive import RawArchive
+    from fetchers.fetcher import (ARCHIVE_DIR, BASE_DIR, DB_NAME,
+                                  PXWEB_BASE_URL, Fetcher)
+
+    archive = RawArchive(ARCHIVE_DIR)
+    fetchers = []
+    for name, definition in FETCHERS.items():
+        fields = dict(definition)
+        table, config = fields.pop('table'), fields.pop('config')
+        fetchers.append((name, Fetcher(
+            api_url=f'{PXWEB_BASE_URL}/PxWeb/api/v1/en/StatFin/{table}',
+            query_parameters_file=os.path.join(BASE_DIR, "config", config),
+            db_name=DB_NAME,
+            archive=archive,
+            **fields)))
+    return tuple(fetchers)
@@ -0,0 +1,166 @@
+import logging
+import sqlite3
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from models import create_table
+
+logger = logging.getLogger("fetchers")
+
+CRIME_WEIGHTS = {
+    "Total of thefts 28:1-3": 1.0,
+    "Robbery 31:1-2 total": 2.5,
+    "Damage to property 35:1-3 total": 1.2,
+    "Offences against life total 21:1-3,34a:1": 5.0,
+    "Sexual crimes": 4.5,
+    "Crimes against public authority and public peace": 3.0,
+    "Endangerment of traffic safety, hit-and-run 23:1,11": 2.0,
+    "Aggravated endangerment of traffic safety 23:2": 2.8,
+    "Drunken driving 23:3-4 total": 1.5,
+    "Offences involving narcotics 50:1-4": 2.3
+}
+
+POPULATION_DESCRIPTION = 'Population 31 Dec'
+
+# code of the whole country, it sums up the municipalities and is rated but
+# not ranked against them
+WHOLE_COUNTRY = 'SSS'
+
+def existing_tables(conn: sqlite3.Connection) -> set[str]:
+    """
+
+    Returns:
+        set[str]: Names of the tables in the database
+
+    """
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {name for (name,) in rows}
+
+
+def code_column(conn: sqlite3.Connection, table: str) -> str:
+    """
+
+    Returns:
+        str: The area_code column of the table, or the area label for tables
+        written before area codes were stored
+
+    """
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+    return 'area_code' if 'area_code' in columns else 'area'
+
+
+def crime_categories(descriptions: pd.Series) -> pd.Series:
+    """
+
+    Args:
+        descriptions (pd.Series): Crime descriptions
+
+    Returns:
+        pd.Series: Weighted category of every description, the first category
+        contained in the description wins, NaN if none matches
+
+    """
+    unique = pd.Series(descriptions.unique(), dtype=object)
+    categories = pd.Series(np.nan, index=unique.index, dtype=object)
+    for category in CRIME_WEIGHTS:
+        matches = categories.isna() & unique.str.contains(category, regex=False)
+        categories[matches] = category
+    return descriptions.map(dict(zip(unique, categories)))
+
+
+def compute_safety_ratings(conn: sqlite3.Connection
+                           ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+
+    Scores every area in one pass over the crime_rate and demographics tables
+
+    Args:
+        conn (sqlite3.Connection): Database filled by the fetchers
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: Ratings with one row per area that
+        has population data, ranked from the safest with no rank for the whole
+        country, and the weighted contribution of every crime category to them
+
+    """
+    crime_code = code_column(conn, 'crime_rate')
+    crimes = pd.read_sql_query(
+        f"SELECT {crime_code} AS area_code, description, SUM(value) AS crimes "
+        f"FROM crime_rate GROUP BY {crime_code}, description "
+        f"ORDER BY {crime_code}, description", conn)
+
+    demographics_code = code_column(conn, 'demographics')
+    population = pd.read_sql_query(
+        f"SELECT {demographics_code} AS area_code, area, value AS population "
+        "FROM demographics WHERE description = ? "
+        f"ORDER BY {demographics_code}", conn,
+        params=(POPULATION_DESCRIPTION,))
+    population = population.drop_duplicates('area_code')
+    population = population[population['population'].fillna(0) != 0]
+
+    crimes['category'] = crime_categories(crimes['description'])
+    crimes = crimes.dropna(subset=['category'])
+    crimes['weight'] = crimes['category'].map(CRIME_WEIGHTS)
+    crimes['weighted'] = crimes['crimes'] * crimes['weight']
+
+    contributions = crimes.merge(population[['area_code', 'population']],
+                                 on='area_code')
+    contributions['weighted_per_100k'] = \
+        contributions['weighted'] / contributions['population'] * 100_000
+
+    weighted = contributions.groupby('area_code', sort=False)['weighted'].sum()
+    ratings = population.set_index('area_code')
+    ratings['weighted_crimes_per_100k'] = \
+        weighted.reindex(ratings.index, fill_value=0) / ratings['population'] \
+        * 100_000
+    ratings['value'] = np.clip(
+        200 * np.exp(-0.0002 * ratings['weighted_crimes_per_100k']), 0,
+        99.5).round(2)
+    ranked = ratings['value'].where(ratings.index != WHOLE_COUNTRY)
+    ratings['rank'] = ranked.rank(method='min', ascending=False) \
+        .astype('Int64')
+    ratings = ratings.sort_values(['rank', 'area']).reset_index()
+
+    # descriptions of the same category add up to one contribution
+    contributions = contributions.groupby(
+        ['area_code', 'category', 'weight'], sort=False, as_index=False)[
+        ['crimes', 'weighted_per_100k']].sum()
+    return ratings, contributions
+
+
+def write_safety_ratings(db_name: str) -> int:
+    """
+
+    Replaces the safety_rating and safety_rating_contribution tables
+
+    Args:
+        db_name (str): Path of the sqlite database filled by the fetchers
+
+    Returns:
+        int: Number of rated areas
+
+    """
+    conn = sqlite3.connect(db_name)
+    try:
+        if not {'crime_rate', 'demographics'} <= existing_tables(conn):
+            logger.warning("Crime or demographics data missing, safety "
+                           "ratings not computed")
+            return 0
+
+        ratings, contributions = compute_safety_ratings(conn)
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS safety_rating")
+            conn.execute("DROP TABLE IF EXISTS safety_rating_contribution")
+            create_table(conn, 'safety_rating')
+            create_table(conn, 'safety_rating_contribution')
+            ratings.to_sql('safety_rating', conn, if_exists='append',
+                           index=False)
+            contributions.to_sql('safety_rating_contribution', conn,
+                                 if_exists='append', index=False)
+    finally:
+        conn.close()
+
+    logger.info("[✓] Safety ratings computed for %s areas", len(ratings))
+    return len(ratings)
@@ -0,0 +1,303 @@
+import hashlib
+import logging
+import math
+import os
+import pickle
+import sqlite3
+import tempfile
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from columnar import SECTION_AGGREGATES, read_table
+from snapshot import SNAPSHOT_FORMAT
+from fetchers.safety_rating import (WHOLE_COUNTRY, code_column,
+                                     compute_safety_ratings, existing_tables)
+
+logger = logging.getLogger("fetchers")
+
+# (section, table, sql), every query returns the area code and the area label
+# as its first columns. {code} is the area_code column, or the label for tables
+# written before area codes were stored.
+SECTION_QUERIES = [
+    ("demographics", "demographics",
+     "SELECT {code}, area, description, value FROM demographics ORDER BY rowid"),
+    ("unemployment_rate", "employment_rate",
+     "SELECT {code}, area, substr(timeframe, 1, 4) AS year, AVG(value) "
+     "FROM employment_rate GROUP BY {code}, year ORDER BY {code}, year"),
+    ("traffic_accidents", "traffic_accidents",
+     "SELECT {code}, area, timeframe, description, value FROM traffic_accidents "
+     "ORDER BY rowid"),
+    ("traffic_accidents_sum", "traffic_accidents",
+     "SELECT {code}, area, timeframe, SUM(value) FROM traffic_accidents "
+     "GROUP BY {code}, timeframe ORDER BY {code}, timeframe"),
+    ("education", "education",
+     "SELECT {code}, area, age, description, value FROM education "
+     "ORDER BY rowid"),
+    ("income", "income",
+     "SELECT {code}, area, description, value FROM income ORDER BY rowid"),
+    ("crimes", "crime_rate",
+     "SELECT {code}, area, description, SUM(value) FROM crime_rate "
+     "GROUP BY {code}, description ORDER BY {code}, description"),
+]
+
+SECTIONS = [section for section, _, _ in SECTION_QUERIES] + ["safety_rating"]
+
+# sections ranked across areas, every description is ranked on its own
+RANKED_SECTIONS = ("income", "demographics", "unemployment_rate", "crimes",
+                   "safety_rating")
+
+
+def _safety_ratings(conn: sqlite3.Connection, tables: set[str]
+                    ) -> Dict[str, tuple]:
+    """
+
+    Reads the ratings stored at ingest, databases without them are scored in
+    memory
+
+    Returns:
+        Dict[str, tuple]: Area code to (description, value, rank,
+        contributions) of every rated area, the whole country has no rank
+
+    """
+    if not {'crime_rate', 'demographics'} <= tables:
+        return {}
+
+    if {'safety_rating', 'safety_rating_contribution'} <= tables:
+        ratings = conn.execute(
+            "SELECT area_code, value, rank FROM safety_rating").fetchall()
+        contributions = conn.execute(
+            "SELECT area_code, category, weight, crimes, weighted_per_100k "
+            "FROM safety_rating_contribution "
+            "ORDER BY area_code, weighted_per_100k DESC").fetchall()
+    else:
+        rating_df, contribution_df = compute_safety_ratings(conn)
+        rating_df['rank'] = rating_df['rank'].astype(object) \
+            .where(rating_df['rank'].notna(), None)
+        ratings = list(rating_df[['area_code', 'value', 'rank']]
+                       .itertuples(index=False, name=None))
+        contributions = list(
+            contribution_df.sort_values(['area_code', 'weighted_per_100k'],
+                                        ascending=[True, False])
+            .itertuples(index=False, name=None))
+
+    by_area: Dict[str, list] = {}
+    for code, *contribution in contributions:
+        by_area.setdefault(code, []).append(tuple(contribution))
+
+    return {
+        code: ("Safety Rating", value, None if rank is None else int(rank),
+               tuple(by_area.get(code, ())))
+        for code, value, rank in ratings
+    }
+
+
+def _row(section: str, record: tuple) -> tuple:
+    """
+
+    Args:
+        section (str): Snapshot section the record belongs to
+        record (tuple): Raw row returned by the section query
+
+    Returns:
+        tuple: Row in the field order of the matching GraphQL schema type
+
+    """
+    if section == "unemployment_rate":
+        area, year, avg = record
+        return area, year, "average unemployment rate", round(avg, 2)
+
+    if section == "traffic_accidents_sum":
+        area, timeframe, total = record
+        return area, timeframe, "Total traffic accidents per year", total
+
+    return record
+
+
+def _section_records(conn: sqlite3.Connection, section: str, table: str,
+                     sql: str, columnar_dir: Optional[str]) -> Iterable[tuple]:
+    if columnar_dir is not None and section in SECTION_AGGREGATES:
+        arrow_table = read_table(table, columnar_dir)
+        if arrow_table is not None:
+            return SECTION_AGGREGATES[section][1](arrow_table)
+    return conn.execute(sql.format(code=code_column(conn, table)))
+
+
+def build_snapshot(db_name: str,
+                   columnar_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+
+    Args:
+        db_name (str): Path of the sqlite database filled by the fetchers
+        columnar_dir (str): Columnar store written from the same database,
+        the aggregated sections are computed from it when given
+
+    Returns:
+        Dict[str, Any]: Snapshot payload with one entry per area code, each
+        holding the area label and every section
+
+    """
+    areas: Dict[str, Dict[str, Any]] = {}
+
+    def entry(code: str, area: str) -> Dict[str, Any]:
+        if code not in areas:
+            areas[code] = {section: [] for section in SECTIONS}
+            areas[code]["area"] = area
+            areas[code]["safety_rating"] = None
+        return areas[code]
+
+    conn = sqlite3.connect(db_name)
+    try:
+        tables = existing_tables(conn)
+        for section, table, sql in SECTION_QUERIES:
+            if table not in tables:
+                logger.warning("Table %s missing, snapshot section %s is empty",
+                               table, section)
+                continue
+
+            records = _section_records(conn, section, table, sql, columnar_dir)
+            for code, *record in records:
+                if code is None:
+                    continue
+                entry(code, record[0])[section].append(
+                    _row(section, tuple(record)))
+
+        for code, rating in _safety_ratings(conn, tables).items():
+            if code in areas:
+                areas[code]["safety_rating"] = (areas[code]["area"], *rating)
+    finally:
+        conn.close()
+
+    for data in areas.values():
+        for section in SECTIONS[:-1]:
+            data[section] = tuple(data[section])
+
+    return areas
+
+
+def _ranked_values(section: str, data: Dict[str, Any],
+                   latest_year: Optional[str]) -> Iterable[tuple]:
+    """
+
+    Returns:
+        Iterable[tuple]: (description, value, timeframe) of every value of the
+        area to be ranked in the section
+
+    """
+    if section == "safety_rating":
+        if data["safety_rating"] is not None:
+            _, description, value, _, _ = data["safety_rating"]
+            yield description, value, None
+    elif section == "unemployment_rate":
+        for _, year, description, value in data[section]:
+            if year == latest_year:
+                yield description, value, year
+    else:
+        for _, description, value, *_ in data[section]:
+            yield description, value, None
+
+
+def _ranks(values: List[float]) -> List[int]:
+    # competition ranking, equal values share the rank of the first of them
+    ranks: List[int] = []
+    for position, value in enumerate(values):
+        tied = position > 0 and value == values[position - 1]
+        ranks.append(ranks[-1] if tied else position + 1)
+    return ranks
+
+
+def build_rankings(areas: Dict[str, Dict[str, Any]]
+                   ) -> Dict[str, Dict[str, Tuple[tuple, tuple]]]:
+    """
+
+    Sorts every ranked value across the areas once per refresh, a top-N
+    query only slices the result
+
+    Unemployment is ranked on the average of the latest year in the data.
+
+    Args:
+        areas (Dict[str, Dict[str, Any]]): Areas built by build_snapshot
+
+    Returns:
+        Dict[str, Dict[str, Tuple[tuple, tuple]]]: Section to description to
+        the (rank, area code, area, value, timeframe) rows of every area in
+        descending and in ascending order of value
+
+    """
+    years = [row[1] for data in areas.values()
+             for row in data["unemployment_rate"]]
+    latest_year = max(years) if years else None
+
+    values: Dict[str, Dict[str, list]] = {
+        section: {} for section in RANKED_SECTIONS}
+    for code, data in areas.items():
+        if code == WHOLE_COUNTRY:
+            continue
+        for section in RANKED_SECTIONS:
+            for description, value, timeframe in _ranked_values(
+                    section, data, latest_year):
+                if value is None or math.isnan(value):
+                    continue
+                values[section].setdefault(description, []).append(
+                    (code, data["area"], value, timeframe))
+
+    rankings: Dict[str, Dict[str, Tuple[tuple, tuple]]] = {}
+    for section, descriptions in values.items():
+        rankings[section] = {}
+        for description, rows in descriptions.items():
+            orders = []
+            for descending in (True, False):
+                rows = sorted(rows, key=lambda row: (
+                    -row[2] if descending else row[2], row[1]))
+                ranks = _ranks([row[2] for row in rows])
+                orders.append(tuple(
+                    (rank, *row) for rank, row in zip(ranks, rows)))
+            rankings[section][description] = tuple(orders)
+    return rankings
+
+
+def write_snapshot(db_name: str, snapshot_path: str,
+                   columnar_dir: Optional[str] = None) -> str:
+    """
+
+    Builds the snapshot and publishes it with an atomic rename, readers never
+    see a partially written file
+
+    Args:
+        db_name (str): Path of the sqlite database filled by the fetchers
+        snapshot_path (str): Destination of the snapshot file
+        columnar_dir (str): Columnar store written from the same database
+
+    Returns:
+        str: Version of the written snapshot
+
+    """
+    areas = build_snapshot(db_name, columnar_dir)
+    body = pickle.dumps(areas, protocol=pickle.HIGHEST_PROTOCOL)
+    version = hashlib.blake2b(body, digest_size=8).hexdigest()
+
+    payload = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "built_at": datetime.now(),
+        "areas": areas,
+        "rankings": build_rankings(areas),
+    }
+
+    # unique per writer, API workers may rebuild a missing snapshot at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot_path),
+                                    prefix=f"{os.path.basename(snapshot_path)}.",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(payload, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logger.info("[✓] Snapshot %s written with %s areas", version, len(areas))
+    return version
@@ -0,0 +1,80 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+from fetchers.jsonstat import JsonStatStream
+
+DIMENSIONS = {
+    "Alue": {"label": "Alue", "category": {
+        "index": {"KU091": 0, "KU049": 1, "KU837": 2},
+        "label": {"KU091": "Helsinki", "KU049": "Espoo", "KU837": "Tampere"}}},
+    "Tiedot": {"label": "Tiedot", "category": {
+        "index": {"a": 0, "b": 1},
+        "label": {"a": "Väkiluku \"31.12.\"", "b": "Työttömät, %"}}},
+}
+VALUES = [653835, -1.5, None, 0, 1e-3, 2.5e6]
+
+
+def document(value_first: bool = False) -> bytes:
+    header = {"class": "dataset", "label": "Ääni [test], {x}",
+              "id": ["Alue", "Tiedot"], "size": [3, 2],
+              "dimension": DIMENSIONS}
+    body = {"value": VALUES, **header} if value_first \
+        else {**header, "value": VALUES}
+    body["extension"] = {"px": {"tableid": "test"}}
+    return json.dumps(body, ensure_ascii=False, indent=1).encode()
+
+
+def chunked(body: bytes, sizes):
+    position = 0
+    while position < len(body):
+        size = next(sizes)
+        yield body[position:position + size]
+        position += size
+
+
+def read(body: bytes, sizes, batch_size: int = 2):
+    reader = JsonStatStream(chunked(body, sizes), batch_size=batch_size)
+    batches = list(reader.batches())
+    return reader, batches
+
+
+def assert_matches(body: bytes, reader: JsonStatStream, batches: list):
+    expected = json.loads(body)
+    offsets = [offset for _, offset, _ in batches]
+    values = np.concatenate([values for _, _, values in batches])
+    assert offsets == sorted(offsets) and offsets[0] == 0
+    np.testing.assert_array_equal(
+        values, np.array(expected["value"], dtype=np.float64))
+
+    expected["value"] = None
+    assert reader.header == expected
+    for header, _, _ in batches:
+        assert header["id"] == expected["id"]
+        assert header["dimension"] == expected["dimension"]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64, 1 << 20])
+@pytest.mark.parametrize("value_first", [False, True])
+def test_fixed_chunks_match_json_loads(size, value_first):
+    body = document(value_first)
+    reader, batches = read(body, iter(lambda: size, None))
+    assert_matches(body, reader, batches)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunks_match_json_loads(seed):
+    rng = random.Random(seed)
+    body = document(value_first=seed % 2 == 1)
+    reader, batches = read(body, iter(lambda: rng.randint(1, 12), None),
+                           batch_size=rng.randint(1, 4))
+    assert_matches(body, reader, batches)
+
+
+def test_truncated_document_is_rejected():
+    body = document()
+    body = body[:body.index(b'"value"') + 12]
+    with pytest.raises(ValueError):
+        list(JsonStatStream([body]).batches())
@@ -0,0 +1,96 @@
+"""
+
+Module for electing the single process that runs scheduled refreshes
+
+"""
+
+
+import logging
+import os
+import socket
+import uuid
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# extends the lease only while this process still holds it
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderElection:
+    """
+    Lease in Redis held by at most one process across every worker and
+    container, the holder renews it with heartbeat() and others take it over
+    once it expires
+
+    Attributes:
+        key (str): Redis key of the lease
+        ttl (float): Seconds the lease lasts without a heartbeat
+        identity (str): Value identifying this process as the holder
+        is_leader (bool): Whether this process held the lease at the last
+        heartbeat
+    """
+
+    def __init__(self, client: redis.Redis, key: str, ttl: float = 30):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.identity = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.is_leader = False
+        self._renew = client.register_script(RENEW_SCRIPT)
+        self._release = client.register_script(RELEASE_SCRIPT)
+
+    def heartbeat(self) -> bool:
+        """
+
+        Renews the lease if held, tries to acquire it otherwise. Should run
+        well within the ttl, e.g. every ttl / 3 seconds
+
+        Returns:
+            bool: True if this process is the leader
+
+        """
+        ttl_ms = int(self.ttl * 1000)
+        try:
+            held = self.is_leader and bool(
+                self._renew(keys=[self.key], args=[self.identity, ttl_ms]))
+            if not held:
+                held = bool(self.client.set(self.key, self.identity, nx=True,
+                                            px=ttl_ms))
+        except redis.RedisError as e:
+            logger.warning("Leader heartbeat failed: %s", e)
+            held = False
+
+        if held != self.is_leader:
+            logger.info("%s leadership of %s", "Acquired" if held else "Lost",
+                        self.key)
+        self.is_leader = held
+        return held
+
+    def release(self):
+        """
+
+        Gives the lease up so another process can take over without waiting
+        for it to expire
+
+        """
+        if not self.is_leader:
+            return
+        try:
+            self._release(keys=[self.key], args=[self.identity])
+        except redis.RedisError as e:
+            logger.warning("Leader release failed: %s", e)
+        self.is_leader = False
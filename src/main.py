@@ -1,20 +1,22 @@
 import os
 import logging
+from contextlib import asynccontextmanager
+
 import redis
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
 from fastapi import FastAPI, Request, Depends, BackgroundTasks
 from pydantic import BaseModel
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 import strawberry
 from strawberry.fastapi import GraphQLRouter
 
-from fetchers.fetcher import run_all_fetchers
-from schema import Query
+from cache import GraphQLCacheMiddleware
+import metrics
+from ratelimit import HybridRateLimiter, RateLimited
+from schema import Query, get_context
+import snapshot
+from worker import request_refresh, start_scheduler, stop_scheduler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,22 +24,51 @@ logger = logging.getLogger(__name__)
 
 def cron_job():
     try:
+        # the ingestion stack is only imported by the process running a refresh,
+        # refreshes of other workers or the refresh worker are waited for
+        from fetchers.fetcher import run_all_fetchers
         run_all_fetchers()
+        snapshot.reload()
     except Exception as e:
         logger.error("Error %s", e)
 
 
 
-schema = strawberry.federation.Schema(query=Query)
+schema = strawberry.federation.Schema(query=Query,
+                                      extensions=[metrics.MetricsExtension])
 
 redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 redis_client = redis.from_url(redis_url)
 
-limiter = Limiter(key_func=get_remote_address,
-                  storage_uri=redis_url)
-app = FastAPI()
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# with a refresh worker running, refreshes are queued for it instead of
+# running in the API process
+REFRESH_WORKER = os.getenv("REFRESH_WORKER", "0") == "1"
+
+# decided in process, counts are reconciled with the other workers through
+# redis every sync interval
+rate_limiter = HybridRateLimiter(
+    redis_url, os.getenv("RATE_LIMIT", "60/minute"),
+    sync_interval=float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "0.5")))
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # load the snapshot before the first request instead of during it
+    await snapshot.current_async()
+    scheduler = election = None
+    if not REFRESH_WORKER:
+        # every API process schedules the refresh, the election lets only
+        # one of them run it
+        scheduler, election = start_scheduler(redis_client, cron_job)
+    try:
+        yield
+    finally:
+        if scheduler is not None:
+            stop_scheduler(scheduler, election)
+        await rate_limiter.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 update_key = 'update_key' # should be changed, will be moved to .env
@@ -54,27 +85,62 @@ async def trigger_fetch(t: TriggerUpdate, background_tasks: BackgroundTasks):
     if t.key != update_key:
         return JSONResponse(status_code=400, content={"message": "Invalid Key"})
 
-    background_tasks.add_task(cron_job)
+    if REFRESH_WORKER:
+        request_refresh(redis_client)
+    else:
+        background_tasks.add_task(cron_job)
     return {"message": "Success"}
 
 
-@limiter.limit("60/minute")
+snapshot_built = metrics.TimestampCollector(
+    "odflow_snapshot_built_timestamp_seconds",
+    "Unix time the served snapshot was built",
+    lambda: snapshot.current().built_at)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    content, content_type = metrics.render(snapshot_built)
+    return Response(content=content, media_type=content_type)
+
+
 async def check_rate_limit(request: Request):
+    if not rate_limiter.hit(get_remote_address(request)):
+        metrics.RATE_LIMIT_REJECTIONS.inc()
+        raise RateLimited(rate_limiter.retry_after())
     return True
 
 
-@app.exception_handler(RateLimitExceeded)
-async def rate_limit_exception(request: Request, exc: RateLimitExceeded):
+@app.exception_handler(RateLimited)
+async def rate_limit_exception(request: Request, exc: RateLimited):
     return JSONResponse(
         status_code=429,
+        headers={"Retry-After": str(exc.retry_after)},
         content={
             "message":
                 "Rate limit exceeded. "
-                f"Please try again in {int(exc.limit.limit.get_expiry() / 60)} mins",
+                f"Please try again in {int(rate_limiter.window / 60)} mins",
         })
 
 
+async def cached_request_guard(request: Request):
+    # cached responses skip the router and its rate limit dependency
+    try:
+        await check_rate_limit(request)
+    except RateLimited as exc:
+        return await rate_limit_exception(request, exc)
+    return None
+
+
 graphql_app = GraphQLRouter(schema=schema,
+                            context_getter=get_context,
                             dependencies=[Depends(check_rate_limit)])
 
 app.include_router(router=graphql_app, prefix='/graphql/v1/city_insights')
+app.add_middleware(GraphQLCacheMiddleware,
+                   path='/graphql/v1/city_insights',
+                   version=lambda: snapshot.current().version,
+                   last_modified=lambda: snapshot.current().built_at,
+                   guard=cached_request_guard,
+                   max_entries=int(os.getenv("GRAPHQL_CACHE_SIZE", 1024)),
+                   max_age=int(os.getenv("HTTP_CACHE_MAX_AGE", 300)))
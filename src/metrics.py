@@ -0,0 +1,201 @@
+"""
+
+Module for the Prometheus metrics of the API and the fetchers
+
+Metrics live in the process recording them, the API serves its own on
+/metrics and the refresh worker on METRICS_PORT. With several API workers,
+PROMETHEUS_MULTIPROC_DIR makes every worker write its values into that
+directory and /metrics aggregates them.
+
+"""
+
+
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from inspect import isawaitable
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               start_http_server)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from strawberry.extensions import SchemaExtension
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+FIELD_DURATION = Histogram(
+    "odflow_graphql_field_duration_seconds",
+    "Duration of the root GraphQL field resolvers",
+    ["field"], buckets=LATENCY_BUCKETS)
+FIELD_ERRORS = Counter(
+    "odflow_graphql_field_errors_total",
+    "Root GraphQL field resolvers that raised",
+    ["field"])
+
+SQL_QUERY_DURATION = Histogram(
+    "odflow_sql_query_duration_seconds",
+    "Duration of the SQL queries of the API",
+    buckets=LATENCY_BUCKETS)
+SQL_QUERIES_PER_REQUEST = Histogram(
+    "odflow_sql_queries_per_request",
+    "SQL queries run by one GraphQL operation",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100))
+SQL_DURATION_PER_REQUEST = Histogram(
+    "odflow_sql_duration_per_request_seconds",
+    "Time one GraphQL operation spent in SQL queries",
+    buckets=LATENCY_BUCKETS)
+
+RATE_LIMIT_REJECTIONS = Counter(
+    "odflow_rate_limit_rejections_total",
+    "Requests rejected by the rate limiter")
+
+FETCHER_STAGE_DURATION = Gauge(
+    "odflow_fetcher_stage_duration_seconds",
+    "Duration of the fetch, parse and save stages of the last run of a fetcher",
+    ["table", "stage"], multiprocess_mode="mostrecent")
+FETCHER_ROWS = Gauge(
+    "odflow_fetcher_rows",
+    "Rows received and rows changed by the last run of a fetcher",
+    ["table", "kind"], multiprocess_mode="mostrecent")
+FETCHER_LAST_SUCCESS = Gauge(
+    "odflow_fetcher_last_success_timestamp_seconds",
+    "Unix time of the last successful run of a fetcher",
+    ["table"], multiprocess_mode="max")
+FETCHER_FAILURES = Counter(
+    "odflow_fetcher_failures_total",
+    "Runs of a fetcher that failed",
+    ["table"])
+
+# [queries, seconds] of the GraphQL operation being executed
+_sql_usage: ContextVar[Optional[List[float]]] = ContextVar("sql_usage",
+                                                           default=None)
+
+
+class MetricsExtension(SchemaExtension):
+    """
+    Times every root field resolver and counts the SQL queries of each
+    operation, nested fields only read snapshot rows and are not timed
+    """
+
+    def on_operation(self) -> Iterator[None]:
+        usage = [0, 0.0]
+        token = _sql_usage.set(usage)
+        try:
+            yield
+        finally:
+            _sql_usage.reset(token)
+            SQL_QUERIES_PER_REQUEST.observe(usage[0])
+            SQL_DURATION_PER_REQUEST.observe(usage[1])
+
+    def resolve(self, _next: Callable, root: Any, info: Any, *args, **kwargs):
+        if info.parent_type.name != "Query":
+            return _next(root, info, *args, **kwargs)
+
+        field = info.field_name
+        started = time.perf_counter()
+        try:
+            result = _next(root, info, *args, **kwargs)
+        except Exception:
+            FIELD_ERRORS.labels(field).inc()
+            FIELD_DURATION.labels(field).observe(time.perf_counter() - started)
+            raise
+        if isawaitable(result):
+            return _timed(result, field, started)
+        FIELD_DURATION.labels(field).observe(time.perf_counter() - started)
+        return result
+
+
+async def _timed(result: Any, field: str, started: float) -> Any:
+    try:
+        return await result
+    except Exception:
+        FIELD_ERRORS.labels(field).inc()
+        raise
+    finally:
+        FIELD_DURATION.labels(field).observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine: Any):
+    """
+
+    Records the duration of every query of the engine, and adds it to the
+    usage of the GraphQL operation running it
+
+    Args:
+        engine (Engine): SQLAlchemy engine
+
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _started(conn, *_):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _finished(conn, *_):
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        SQL_QUERY_DURATION.observe(seconds)
+        usage = _sql_usage.get()
+        if usage is not None:
+            usage[0] += 1
+            usage[1] += seconds
+
+
+class TimestampCollector:
+    """
+    Gauge read when scraped, e.g. the build time of the served snapshot
+    """
+
+    def __init__(self, name: str, documentation: str,
+                 read: Callable[[], Optional[datetime]]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        value = self.read()
+        if value is not None:
+            yield GaugeMetricFamily(self.name, self.documentation,
+                                    value=value.timestamp())
+
+
+def render(*collectors: TimestampCollector) -> Tuple[bytes, str]:
+    """
+
+    Args:
+        collectors (TimestampCollector): Collectors of this process to add
+
+    Returns:
+        Tuple[bytes, str]: Metrics in the Prometheus text format and its
+        content type
+
+    """
+    registry = CollectorRegistry()
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        MultiProcessCollector(registry)
+    else:
+        registry.register(_ProcessMetrics())
+
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class _ProcessMetrics:
+    # the default registry of this process, wrapped to be combined with the
+    # collectors of a single scrape
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def serve(port: int):
+    """
+
+    Serves the metrics of this process on their own port, for processes
+    without an HTTP app such as the refresh worker
+
+    """
+    start_http_server(port)
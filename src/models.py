@@ -9,18 +9,66 @@ Module for database models, defining the structure of tables
 
 
 import os
-from sqlalchemy import Column, Integer, String, Float, create_engine
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import (Column, DateTime, Float, Index, Integer, String,
+                        create_engine, event, exc)
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+import metrics
+
+DB_path = os.path.join(
+    os.getenv("ODFLOW_DB_DIR", os.path.join(os.path.dirname(__file__), '..', 'db')),
+    'combined_db.sqlite3')
+# the API only reads, the refresh replaces the whole file instead of writing it
+DB_URL = f"sqlite:///file:{os.path.abspath(DB_path)}?mode=ro&uri=true"
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# bounded pool, callers wait for a free connection instead of opening new ones
+engine = create_engine(DB_URL,
+                       connect_args={"check_same_thread": False},
+                       pool_size=DB_POOL_SIZE,
+                       max_overflow=0,
+                       pool_timeout=30,
+                       pool_pre_ping=True)
+
+
+def _db_inode():
+    try:
+        return os.stat(DB_path).st_ino
+    except OSError:
+        return None
+
+
+@event.listens_for(engine, "connect")
+def _remember_file(_, connection_record):
+    connection_record.info["inode"] = _db_inode()
+
+
+@event.listens_for(engine, "checkout")
+def _reopen_replaced(_, connection_record, __):
+    # connections keep reading the file they opened, the pool replaces them
+    # once a refresh has published a new database
+    if connection_record.info.get("inode") != _db_inode():
+        raise exc.DisconnectionError("database file was replaced")
+
 
-DB_path = os.path.join(os.path.dirname(__file__), '..', 'db',
-                       'combined_db.sqlite3')
-DB_URL = f"sqlite:///{DB_path}"
+# connections inherited from a parent process must not be used by the child,
+# each worker opens its own
+os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
 
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+metrics.instrument_engine(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the refresh creates the data tables from this metadata, see
+# Fetcher.ensure_table
 Base = declarative_base()
 
 
@@ -33,15 +81,25 @@ class DemographicsModel(Base):
     Attributes:
         id (int): Primary key
         area (str): Area of the demographics data
+        area_code (str): PxWeb code of the area, e.g. KU091
         description (str): Type of the demographics data
         value (int): demographics data value
+        last_updated (datetime): When the value was fetched
     """
     __tablename__ = "demographics"
-
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ux_demographics_cell", "area", "description", unique=True),
+        # covers the population lookup of the safety rating, read from the index alone
+        Index("ix_demographics_population",
+              "description", "area_code", "area", "value"),
+    )
+
+    id = Column(Integer, primary_key=True)
     area = Column(String, index=True)
+    area_code = Column(String, index=True)
     description = Column(String)
     value = Column(Float)
+    last_updated = Column(DateTime)
 
 
 # Traffic accidents
@@ -52,17 +110,28 @@ class TrafficAccidents(Base):
     Attributes:
         id (int): Primary key
         area (str): Area of the traffic accidents data
+        area_code (str): PxWeb code of the area, e.g. KU091
         timeframe (str): Time period for the traffic accidents
         description (str): Type of the traffic accidents data
         value (int): Traffic accidents data value
+        last_updated (datetime): When the value was fetched
     """
     __tablename__ = "traffic_accidents"
-
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ux_traffic_accidents_cell",
+              "area", "timeframe", "description", unique=True),
+        # covers the traffic_accidents_sum grouping, read from the index alone
+        Index("ix_traffic_accidents_code_timeframe",
+              "area_code", "timeframe", "area", "value"),
+    )
+
+    id = Column(Integer, primary_key=True)
     area = Column(String, index=True)
+    area_code = Column(String, index=True)
     timeframe = Column(String)
     description = Column(String)
     value = Column(Integer)
+    last_updated = Column(DateTime)
 
 
 class EmploymentRate(Base):
@@ -72,17 +141,28 @@ class EmploymentRate(Base):
     Attributes:
         id (int): Primary key
         area (str): Area of the crime rate data
+        area_code (str): PxWeb code of the area, e.g. KU091
         timeframe (str): Time period for the employment rate
         description (str): Type of the employment rate data
         value (int): Employment data value
+        last_updated (datetime): When the value was fetched
     """
     __tablename__ = "employment_rate"
-
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ux_employment_rate_cell",
+              "area", "timeframe", "description", unique=True),
+        # covers the yearly unemployment rate grouping, read from the index alone
+        Index("ix_employment_rate_code_timeframe",
+              "area_code", "timeframe", "area", "value"),
+    )
+
+    id = Column(Integer, primary_key=True)
     area = Column(String, index=True)
+    area_code = Column(String, index=True)
     timeframe = Column(String)
     description = Column(String)
     value = Column(Float)
+    last_updated = Column(DateTime)
 
 
 class CrimeRate(Base):
@@ -92,17 +172,28 @@ class CrimeRate(Base):
     Attributes:
         id (int): Primary key
         area (str): Area of the crime rate data
+        area_code (str): PxWeb code of the area, e.g. KU091
         timeframe (str): Time period of the crime rate
         description (str): Type of the crime
         value (int): Crime data value
+        last_updated (datetime): When the value was fetched
     """
     __tablename__ = "crime_rate"
-
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ux_crime_rate_cell",
+              "area", "timeframe", "description", unique=True),
+        # covers the crimes grouping, read from the index alone
+        Index("ix_crime_rate_code_description",
+              "area_code", "description", "area", "value"),
+    )
+
+    id = Column(Integer, primary_key=True)
     area = Column(String, index=True)
+    area_code = Column(String, index=True)
     timeframe = Column(String)
     description = Column(String)
     value = Column(Integer)
+    last_updated = Column(DateTime)
 
 
 class Income(Base):
@@ -112,16 +203,23 @@ class Income(Base):
     Attributes:
         id (int): Primary key
         area (str): Area of the income data
+        area_code (str): PxWeb code of the area, e.g. KU091
         description (str): Type of the income
         value (int): Income data value
+        last_updated (datetime): When the value was fetched
     """
 
     __tablename__ = "income"
+    __table_args__ = (
+        Index("ux_income_cell", "area", "description", unique=True),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     area = Column(String, index=True)
+    area_code = Column(String, index=True)
     description = Column(String)
     value = Column(Integer)
+    last_updated = Column(DateTime)
 
 
 class Education(Base):
@@ -131,22 +229,115 @@ class Education(Base):
     Attributes:
         id (int): Primary key
         area (str): Area of the education data
+        area_code (str): PxWeb code of the area, e.g. KU091
         age (str): Age
         description (str): Type of the education data
         value (int): Education data value
+        last_updated (datetime): When the value was fetched
     """
     __tablename__ = "education"
+    __table_args__ = (
+        Index("ux_education_cell", "area", "age", "description", unique=True),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     area = Column(String, index=True)
+    area_code = Column(String, index=True)
     age = Column(String)
     description = Column(String)
     value = Column(Integer)
+    last_updated = Column(DateTime)
+
+
+class SafetyRating(Base):
+    """
+    Represents the safety_rating table computed at ingest time.
+
+    Attributes:
+        area_code (str): PxWeb code of the area, e.g. KU091
+        area (str): Area of the safety rating
+        population (int): Population the rating is relative to
+        weighted_crimes_per_100k (float): Weighted crimes per 100 000 residents
+        value (float): Safety rating
+        rank (int): Position of the area, 1 being the safest
+    """
+    __tablename__ = "safety_rating"
+
+    area_code = Column(String, primary_key=True)
+    area = Column(String)
+    population = Column(Integer)
+    weighted_crimes_per_100k = Column(Float)
+    value = Column(Float)
+    rank = Column(Integer, index=True)
 
 
-def get_db():
+class SafetyRatingContribution(Base):
+    """
+    Represents the safety_rating_contribution table computed at ingest time.
+
+    Attributes:
+        area_code (str): PxWeb code of the area, e.g. KU091
+        category (str): Weighted crime category
+        weight (float): Weight of the category
+        crimes (int): Crimes of the category
+        weighted_per_100k (float): Weighted crimes per 100 000 residents
+    """
+    __tablename__ = "safety_rating_contribution"
+
+    area_code = Column(String, primary_key=True)
+    category = Column(String, primary_key=True)
+    weight = Column(Float)
+    crimes = Column(Integer)
+    weighted_per_100k = Column(Float)
+
+
+def create_table(conn: sqlite3.Connection, name: str):
+    """
+
+    Creates a table and its indexes from the model metadata on a plain sqlite3
+    connection, the refresh writes without SQLAlchemy. Existing tables and
+    indexes are kept.
+
+    Args:
+        conn (sqlite3.Connection): Open connection of the database to write
+        name (str): Table name of the model
+
+    """
+    table = Base.metadata.tables[name]
+    dialect = sqlite.dialect()
+    conn.execute(str(CreateTable(table, if_not_exists=True).compile(
+        dialect=dialect)))
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        conn.execute(str(CreateIndex(index, if_not_exists=True).compile(
+            dialect=dialect)))
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+
+    Returns:
+        Iterator[Session]: Session committed on success, rolled back on error
+        and always closed, returning its connection to the pool
+
+    """
     db = SessionLocal()
     try:
         yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
+
+
+def get_db() -> Iterator[Session]:
+    """
+
+    FastAPI dependency, other code should use session_scope() so that the
+    session is always closed
+
+    """
+    with session_scope() as db:
+        yield db
@@ -0,0 +1,124 @@
+"""
+
+Module for Relay style cursor pagination over snapshot rows
+
+"""
+
+
+import base64
+import binascii
+from typing import Generic, List, Optional, Sequence, TypeVar
+
+import strawberry
+
+T = TypeVar("T")
+
+
+@strawberry.type
+class PageInfo:
+    """
+    Represents the position of a page within the whole list
+    """
+
+    has_next_page: bool
+    has_previous_page: bool
+    start_cursor: Optional[str]
+    end_cursor: Optional[str]
+
+
+@strawberry.type
+class Edge(Generic[T]):
+    """
+    Represents one row of a page with its cursor
+    """
+
+    cursor: str
+    node: T
+
+
+@strawberry.type
+class Connection(Generic[T]):
+    """
+    Represents one page of a list field
+    """
+
+    edges: List[Edge[T]]
+    page_info: PageInfo
+    total_count: int
+
+
+def encode_cursor(version: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(f"{version}:{offset}".encode()).decode()
+
+
+def decode_cursor(cursor: str, version: str) -> int:
+    """
+
+    Args:
+        cursor (str): Cursor returned by an earlier page
+        version (str): Snapshot version the page is served from
+
+    Returns:
+        int: Offset of the row the cursor points at
+
+    """
+    try:
+        cursor_version, offset = base64.urlsafe_b64decode(cursor.encode()) \
+            .decode().rsplit(':', 1)
+        offset = int(offset)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor {cursor!r}") from e
+
+    # offsets shift when a refresh adds rows, cursors of older data are refused
+    # instead of silently skipping or repeating rows
+    if cursor_version != version:
+        raise ValueError("Cursor belongs to an earlier data version, "
+                         "restart from the first page")
+    return offset
+
+
+def paginate(rows: Sequence[T], version: str,
+             first: Optional[int] = None, after: Optional[str] = None,
+             last: Optional[int] = None, before: Optional[str] = None
+             ) -> Connection[T]:
+    """
+
+    Slices the rows as described by the Relay connection specification
+
+    Args:
+        rows (Sequence[T]): Every row of the list field
+        version (str): Snapshot version the rows belong to
+        first (Optional[int]): Number of rows after `after`
+        after (Optional[str]): Cursor the page starts after
+        last (Optional[int]): Number of rows before `before`
+        before (Optional[str]): Cursor the page ends before
+
+    Returns:
+        Connection[T]: The page
+
+    """
+    if (first is not None and first < 0) or (last is not None and last < 0):
+        raise ValueError("first and last must not be negative")
+
+    start = decode_cursor(after, version) + 1 if after else 0
+    end = decode_cursor(before, version) if before else len(rows)
+    start, end = max(start, 0), min(end, len(rows))
+
+    window_start, window_end = start, max(start, end)
+    if first is not None:
+        window_end = min(window_end, window_start + first)
+    if last is not None:
+        window_start = max(window_start, window_end - last)
+
+    edges = [Edge(cursor=encode_cursor(version, offset), node=rows[offset])
+             for offset in range(window_start, window_end)]
+    return Connection(
+        edges=edges,
+        page_info=PageInfo(
+            has_next_page=window_end < len(rows),
+            has_previous_page=window_start > 0,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+        total_count=len(rows),
+    )
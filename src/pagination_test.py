@@ -0,0 +1,79 @@
+import pytest
+
+from pagination import decode_cursor, encode_cursor, paginate
+
+ROWS = list(range(10))
+VERSION = "v1"
+
+
+def nodes(connection) -> list:
+    return [edge.node for edge in connection.edges]
+
+
+def test_pages_follow_each_other():
+    first = paginate(ROWS, VERSION, first=4)
+    second = paginate(ROWS, VERSION, first=4, after=first.page_info.end_cursor)
+    third = paginate(ROWS, VERSION, first=4, after=second.page_info.end_cursor)
+
+    assert nodes(first) + nodes(second) + nodes(third) == ROWS
+    assert first.page_info.has_next_page and not first.page_info.has_previous_page
+    assert not third.page_info.has_next_page and third.page_info.has_previous_page
+    assert third.total_count == len(ROWS)
+
+
+def test_first_past_the_end_returns_the_rest():
+    page = paginate(ROWS, VERSION, first=50, after=encode_cursor(VERSION, 6))
+    assert nodes(page) == [7, 8, 9]
+    assert not page.page_info.has_next_page
+
+
+def test_after_the_last_row_is_empty():
+    page = paginate(ROWS, VERSION, first=3, after=encode_cursor(VERSION, 9))
+    assert page.edges == []
+    assert page.page_info.start_cursor is None and page.page_info.end_cursor is None
+    assert not page.page_info.has_next_page
+
+
+def test_after_beyond_the_rows_is_empty():
+    page = paginate(ROWS, VERSION, first=3, after=encode_cursor(VERSION, 42))
+    assert page.edges == []
+
+
+def test_last_before_counts_backwards():
+    page = paginate(ROWS, VERSION, last=3, before=encode_cursor(VERSION, 5))
+    assert nodes(page) == [2, 3, 4]
+    assert page.page_info.has_previous_page and page.page_info.has_next_page
+
+
+def test_first_zero_is_empty():
+    page = paginate(ROWS, VERSION, first=0)
+    assert page.edges == [] and page.total_count == len(ROWS)
+
+
+def test_empty_rows():
+    page = paginate([], VERSION, first=5)
+    assert page.edges == []
+    assert not page.page_info.has_next_page and not page.page_info.has_previous_page
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", "!!!", encode_cursor(VERSION, 1)[:-3],
+                                    "djE6eA=="])  # v1:x
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        paginate(ROWS, VERSION, first=3, after=cursor)
+
+
+def test_cursor_of_an_earlier_version_is_rejected():
+    with pytest.raises(ValueError, match="earlier data version"):
+        paginate(ROWS, "v2", first=3, after=encode_cursor(VERSION, 1))
+
+
+def test_negative_counts_are_rejected():
+    with pytest.raises(ValueError):
+        paginate(ROWS, VERSION, first=-1)
+    with pytest.raises(ValueError):
+        paginate(ROWS, VERSION, last=-1)
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(VERSION, 7), VERSION) == 7
@@ -0,0 +1,87 @@
+import math
+
+import pytest
+
+from fetchers.safety_rating import WHOLE_COUNTRY
+from fetchers.snapshot_builder import build_rankings
+from snapshot import RankingRow, Snapshot
+
+INCOME = "Median income"
+
+
+def area(label: str, income=None, unemployment=(), rating=None) -> dict:
+    return {
+        "area": label,
+        "income": [] if income is None else [(label, INCOME, income)],
+        "demographics": [],
+        "unemployment_rate": [(label, year, "TYOTOSUUS", value)
+                              for year, value in unemployment],
+        "crimes": [],
+        "safety_rating": None if rating is None
+        else (label, "Safety Rating", rating, None, ()),
+    }
+
+
+@pytest.fixture
+def areas() -> dict:
+    return {
+        WHOLE_COUNTRY: area("WHOLE COUNTRY", 9999, [("2024", 1.0)], 50.0),
+        "KU001": area("Alpha", 300, [("2023", 9.0), ("2024", 7.0)], 80.0),
+        "KU002": area("Bravo", 500, [("2024", 5.0)], 80.0),
+        "KU003": area("Charlie", 500, [("2023", 2.0)], 60.0),
+        "KU004": area("Delta", 100, [("2024", 7.0)]),
+        "KU005": area("Echo", math.nan),
+        "KU006": area("Foxtrot"),
+    }
+
+
+def ranked(rows) -> list:
+    return [(rank, code, value) for rank, code, _, value, _ in rows]
+
+
+def test_equal_values_share_the_rank_of_the_first(areas):
+    descending, ascending = build_rankings(areas)["income"][INCOME]
+
+    assert ranked(descending) == [(1, "KU002", 500), (1, "KU003", 500),
+                                  (3, "KU001", 300), (4, "KU004", 100)]
+    assert ranked(ascending) == [(1, "KU004", 100), (2, "KU001", 300),
+                                 (3, "KU002", 500), (3, "KU003", 500)]
+
+
+def test_unemployment_is_ranked_on_the_latest_year(areas):
+    descending, _ = build_rankings(areas)["unemployment_rate"]["TYOTOSUUS"]
+
+    assert [(rank, code, value, timeframe)
+            for rank, code, _, value, timeframe in descending] == \
+        [(1, "KU001", 7.0, "2024"), (1, "KU004", 7.0, "2024"),
+         (3, "KU002", 5.0, "2024")]
+
+
+def test_whole_country_and_missing_values_are_not_ranked(areas):
+    rankings = build_rankings(areas)
+
+    descending, _ = rankings["safety_rating"]["Safety Rating"]
+    assert ranked(descending) == [(1, "KU001", 80.0), (1, "KU002", 80.0),
+                                  (3, "KU003", 60.0)]
+    assert rankings["crimes"] == {} and rankings["demographics"] == {}
+
+
+def test_snapshot_ranking_slices_the_presorted_rows(areas):
+    rankings = {
+        section: {
+            description: tuple(
+                tuple(RankingRow(area, description, value, rank, code=code,
+                                 timeframe=timeframe)
+                      for rank, code, area, value, timeframe in rows)
+                for rows in orders)
+            for description, orders in descriptions.items()}
+        for section, descriptions in build_rankings(areas).items()}
+    data = Snapshot({}, version="v1", built_at=None, rankings=rankings)
+
+    assert [row.area for row in data.ranking("income", limit=2)] == \
+        ["Bravo", "Charlie"]
+    assert [row.rank for row in data.ranking("income", ascending=True)] == \
+        [1, 2, 3, 3]
+    assert data.ranking("income", limit=-1) == ()
+    with pytest.raises(ValueError, match="one of: Median income"):
+        data.ranking("income", "Mean income")
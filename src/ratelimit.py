@@ -0,0 +1,165 @@
+"""
+
+Module for the rate limiter of the GraphQL endpoint
+
+"""
+
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import redis
+import redis.asyncio
+from limits import parse
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    """
+    Raised when a client exceeded its limit
+
+    Attributes:
+        retry_after (int): Seconds until the current window ends
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    """
+    Requests of one client in one window, as far as this process knows
+
+    Attributes:
+        window (int): Window the counts belong to
+        synced (int): Requests of every process counted in Redis at the last
+        sync, this process' synced requests included
+        pending (int): Requests admitted here and not yet sent to Redis
+    """
+    __slots__ = ("window", "synced", "pending")
+
+    def __init__(self, window: int):
+        self.window = window
+        self.synced = 0
+        self.pending = 0
+
+
+class HybridRateLimiter:
+    """
+    Fixed window limiter deciding from in-process buckets, the counts are
+    reconciled with Redis in one pipeline per sync interval instead of a round
+    trip per request
+
+    Across processes a client can exceed the limit by what the other
+    processes admit between two syncs, the sync interval is the tolerance.
+    While Redis is unreachable every process keeps limiting on its own counts.
+
+    Attributes:
+        limit (int): Requests allowed per window
+        window (int): Window length in seconds
+        sync_interval (float): Seconds between syncs with Redis
+    """
+
+    def __init__(self, redis_url: str, rate: str = "60/minute",
+                 sync_interval: float = 0.5, prefix: str = "odflow:ratelimit"):
+        item = parse(rate)
+        self.limit = item.amount
+        self.window = item.get_expiry()
+        self.sync_interval = sync_interval
+        self.prefix = prefix
+        self.client = redis.asyncio.from_url(redis_url,
+                                             socket_timeout=max(sync_interval, 1))
+        self._buckets: Dict[str, _Bucket] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._available = True
+
+    def hit(self, key: str) -> bool:
+        """
+
+        Args:
+            key (str): Client identifier, e.g. the remote address
+
+        Returns:
+            bool: True if the request is admitted
+
+        """
+        self._ensure_sync()
+        window = int(time.time() // self.window)
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.window != window:
+            # unsynced requests of a past window no longer limit anything
+            bucket = self._buckets[key] = _Bucket(window)
+
+        if bucket.synced + bucket.pending >= self.limit:
+            return False
+        bucket.pending += 1
+        return True
+
+    def retry_after(self) -> int:
+        return int(self.window - time.time() % self.window) + 1
+
+    async def sync(self):
+        """
+
+        Adds the pending requests to the Redis counters of their window and
+        takes over the totals of every process
+
+        """
+        window = int(time.time() // self.window)
+        for key in [key for key, bucket in self._buckets.items()
+                    if bucket.window != window]:
+            del self._buckets[key]
+
+        batch = [(key, bucket, bucket.pending)
+                 for key, bucket in self._buckets.items() if bucket.pending]
+        if not batch:
+            return
+
+        pipe = self.client.pipeline(transaction=False)
+        for key, bucket, pending in batch:
+            counter = f"{self.prefix}:{key}:{bucket.window}"
+            pipe.incrby(counter, pending)
+            pipe.expire(counter, self.window * 2)
+            bucket.pending -= pending
+
+        try:
+            results = await pipe.execute()
+        except (redis.RedisError, OSError, asyncio.TimeoutError) as e:
+            for _, bucket, pending in batch:
+                bucket.pending += pending
+            if self._available:
+                logger.warning("Rate limit sync failed, limiting per process "
+                               "until Redis is back: %s", e)
+            self._available = False
+            return
+
+        if not self._available:
+            logger.info("[✓] Rate limit sync with Redis restored")
+        self._available = True
+        for (_, bucket, _), total in zip(batch, results[::2]):
+            bucket.synced = max(bucket.synced, int(total))
+
+    async def close(self):
+        """
+
+        Stops the sync task after a last sync
+
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.sync()
+        await self.client.aclose()
+
+    def _ensure_sync(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
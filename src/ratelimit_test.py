@@ -0,0 +1,135 @@
+import asyncio
+
+import redis
+
+from ratelimit import HybridRateLimiter
+
+
+class FakePipeline:
+    """
+    Redis pipeline adding the increments to counters shared by limiters
+    """
+
+    def __init__(self, counters: dict, fail: bool = False):
+        self.counters = counters
+        self.fail = fail
+        self.commands = []
+
+    def incrby(self, key, amount):
+        self.commands.append((key, amount))
+
+    def expire(self, key, seconds):
+        pass
+
+    async def execute(self):
+        if self.fail:
+            raise redis.ConnectionError("unreachable")
+        results = []
+        for key, amount in self.commands:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            results += [self.counters[key], True]
+        return results
+
+
+class FakeRedis:
+    def __init__(self, counters: dict):
+        self.counters = counters
+        self.fail = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.counters, self.fail)
+
+    async def aclose(self):
+        pass
+
+
+def limiter(counters: dict) -> HybridRateLimiter:
+    limiter = HybridRateLimiter("redis://localhost:1/0", rate="5/minute",
+                                sync_interval=3600)
+    limiter.client = FakeRedis(counters)
+    return limiter
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_burst_up_to_the_limit(clock):
+    async def scenario():
+        rl = limiter({})
+        results = [rl.hit("client") for _ in range(7)]
+        await rl.close()
+        return results
+
+    assert run(scenario()) == [True] * 5 + [False] * 2
+
+
+def test_clients_are_limited_separately(clock):
+    async def scenario():
+        rl = limiter({})
+        for _ in range(5):
+            rl.hit("a")
+        results = rl.hit("a"), rl.hit("b")
+        await rl.close()
+        return results
+
+    assert run(scenario()) == (False, True)
+
+
+def test_limit_refills_in_the_next_window(clock):
+    async def scenario():
+        rl = limiter({})
+        for _ in range(5):
+            rl.hit("client")
+        blocked = rl.hit("client")
+        retry_after = rl.retry_after()
+        clock[0] += 60
+        admitted = rl.hit("client")
+        await rl.close()
+        return blocked, retry_after, admitted
+
+    blocked, retry_after, admitted = run(scenario())
+    assert not blocked and admitted
+    assert 0 < retry_after <= 61
+
+
+def test_sync_shares_the_counts_of_other_processes(clock):
+    counters = {}
+
+    async def scenario():
+        first, second = limiter(counters), limiter(counters)
+        for _ in range(3):
+            assert first.hit("client")
+        await first.sync()
+        await second.sync()
+        # the second process only learns about the first one's requests
+        # through Redis once it has requests of its own to sync
+        assert second.hit("client")
+        await second.sync()
+        results = [second.hit("client") for _ in range(2)]
+        await first.close()
+        await second.close()
+        return results
+
+    assert run(scenario()) == [True, False]
+
+
+def test_unreachable_redis_keeps_limiting_locally(clock):
+    counters = {}
+
+    async def scenario():
+        rl = limiter(counters)
+        rl.client.fail = True
+        for _ in range(3):
+            rl.hit("client")
+        await rl.sync()
+        results = [rl.hit("client") for _ in range(3)]
+
+        rl.client.fail = False
+        await rl.sync()
+        await rl.close()
+        return results
+
+    assert run(scenario()) == [True, True, False]
+    # the requests admitted while Redis was down are counted once it is back
+    assert sum(counters.values()) == 5
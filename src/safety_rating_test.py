@@ -0,0 +1,99 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from fetchers.safety_rating import (CRIME_WEIGHTS, POPULATION_DESCRIPTION,
+                                    WHOLE_COUNTRY, compute_safety_ratings,
+                                    write_safety_ratings)
+
+DESCRIPTIONS = [f"{category} {suffix}" for category in CRIME_WEIGHTS
+                for suffix in ("(reported)", "(solved)")] + ["Other offences"]
+MONTHS = ["2024M10", "2024M11", "2024M12"]
+
+
+def per_area_rating(conn: sqlite3.Connection, code: str) -> float:
+    """
+    Scores one area the way the safetyRating resolver did before ratings
+    were computed at ingest
+    """
+    population = conn.execute(
+        "SELECT value FROM demographics WHERE area_code = ? AND description = ?",
+        (code, POPULATION_DESCRIPTION)).fetchone()[0]
+    total_weighted_crime = 0
+    for description, total_crimes in conn.execute(
+            "SELECT description, SUM(value) FROM crime_rate WHERE area_code = ? "
+            "GROUP BY description", (code,)):
+        for crime_type, weight in CRIME_WEIGHTS.items():
+            if crime_type in description:
+                total_weighted_crime += total_crimes * weight
+                break
+    crime_rate_per_100k = total_weighted_crime / population * 100_000
+    return round(np.clip(200 * np.exp(-0.0002 * crime_rate_per_100k), 0, 99.5),
+                 2)
+
+
+@pytest.fixture
+def db(tmp_path):
+    rng = np.random.default_rng(13)
+    codes = [WHOLE_COUNTRY] + [f"KU{i:03d}" for i in range(1, 40)]
+    path = str(tmp_path / "data.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE demographics "
+                 "(area, area_code, description, value)")
+    conn.execute("CREATE TABLE crime_rate "
+                 "(area, area_code, timeframe, description, value)")
+    for code in codes:
+        population = 0 if code == "KU039" else int(rng.integers(1_000, 700_000))
+        conn.execute("INSERT INTO demographics VALUES (?, ?, ?, ?)",
+                     (f"Area {code}", code, POPULATION_DESCRIPTION, population))
+        conn.execute("INSERT INTO demographics VALUES (?, ?, ?, ?)",
+                     (f"Area {code}", code, "Males", population // 2))
+        if code == "KU038":
+            continue
+        for month in MONTHS:
+            for description in DESCRIPTIONS:
+                conn.execute("INSERT INTO crime_rate VALUES (?, ?, ?, ?, ?)",
+                             (f"Area {code}", code, month, description,
+                              int(rng.integers(0, 300))))
+    conn.commit()
+    yield conn, path
+    conn.close()
+
+
+def test_ratings_match_the_per_area_formula(db):
+    conn, _ = db
+    ratings, contributions = compute_safety_ratings(conn)
+
+    rated = dict(zip(ratings['area_code'], ratings['value']))
+    assert "KU039" not in rated
+    assert rated["KU038"] == 99.5
+    for code, value in rated.items():
+        assert value == pytest.approx(per_area_rating(conn, code), abs=1e-9)
+
+    weighted = contributions.groupby('area_code')['weighted_per_100k'].sum()
+    per_100k = ratings.set_index('area_code')['weighted_crimes_per_100k']
+    assert np.allclose(weighted, per_100k[weighted.index])
+
+
+def test_whole_country_is_rated_but_not_ranked(db):
+    conn, _ = db
+    ratings, _ = compute_safety_ratings(conn)
+    ratings = ratings.set_index('area_code')
+
+    assert ratings['rank'].isna()[WHOLE_COUNTRY]
+    ranked = ratings.drop(WHOLE_COUNTRY)
+    assert ranked['rank'].notna().all()
+    expected = ranked['value'].rank(method='min', ascending=False)
+    assert (ranked['rank'] == expected).all()
+    assert ranked['rank'].min() == 1
+
+
+def test_write_stores_the_whole_country_without_rank(db):
+    conn, path = db
+    assert write_safety_ratings(path) == 39
+
+    assert conn.execute("SELECT rank FROM safety_rating WHERE area_code = ?",
+                        (WHOLE_COUNTRY,)).fetchone() == (None,)
+    assert conn.execute("SELECT COUNT(*), MIN(rank) FROM safety_rating "
+                        "WHERE rank IS NOT NULL").fetchone() == (38, 1)
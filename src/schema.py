@@ -1,13 +1,54 @@
 # pylint: disable=R0903
 
-from statistics import mean
-from typing import List
+from enum import Enum
+from typing import Annotated, List, Optional, Tuple
 
 import strawberry
-import numpy as np
-from sqlalchemy.sql import func
+from strawberry.dataloader import DataLoader
 
-from models import DemographicsModel, EmploymentRate, TrafficAccidents, Education, CrimeRate, Income, get_db
+import columnar
+import snapshot
+from pagination import Connection, paginate
+
+# `from` is a keyword, the argument is declared as from_ and renamed
+FromArgument = Annotated[Optional[str], strawberry.argument(
+    name="from", description="First period, e.g. 2023, 2023Q2 or 2023M05")]
+ToArgument = Annotated[Optional[str], strawberry.argument(
+    description="Last period, e.g. 2023, 2023Q2 or 2023M05")]
+
+
+@strawberry.enum
+class Granularity(Enum):
+    """
+    Length of the periods time-series values are aggregated to
+    """
+
+    MONTH = 1
+    QUARTER = 3
+    YEAR = 12
+
+
+@strawberry.enum
+class RankingMetric(Enum):
+    """
+    Values areas can be ranked by
+    """
+
+    INCOME = "income"
+    DEMOGRAPHICS = "demographics"
+    UNEMPLOYMENT_RATE = "unemployment_rate"
+    CRIMES = "crimes"
+    SAFETY_RATING = "safety_rating"
+
+
+@strawberry.enum
+class SortOrder(Enum):
+    """
+    Direction of a ranking
+    """
+
+    DESC = "desc"
+    ASC = "asc"
 
 
 @strawberry.type
@@ -77,6 +118,19 @@ class CrimeRateSchema:
     description: str
     value: float
     area: str
+    timeframe: Optional[str] = None
+
+
+@strawberry.type
+class SafetyContributionSchema:
+    """
+    Represents the contribution of one crime category to a Safety Rating
+    """
+
+    category: str
+    weight: float
+    crimes: float
+    weighted_per_100k: float
 
 
 @strawberry.type
@@ -88,13 +142,143 @@ class SafetyRatingSchema:
     description: str
     value: float
     area: str
+    code: Optional[str] = None
+    rank: Optional[int] = None
+    contributions: List[SafetyContributionSchema] = strawberry.field(
+        default_factory=list)
+
+
+@strawberry.type
+class RankingSchema:
+    """
+    Represents the position of one area in a ranking
+    """
+
+    rank: int
+    area: str
+    code: Optional[str]
+    description: str
+    value: float
+    timeframe: Optional[str] = None
+
+
+@strawberry.type
+class AreaSchema:
+    """
+    Represents the schema for all information of one area
+    """
+
+    area: str
+    code: Optional[str]
+    demographics: List[DemographicSchema]
+    unemployment_rate: List[EmploymentSchema]
+    traffic_accidents: List[TrafficAccidentsSchema]
+    traffic_accidents_sum: List[TrafficAccidentsSchema]
+    education: List[EducationSchema]
+    income: List[IncomeSchema]
+    crimes: List[CrimeRateSchema]
+    safety_rating: Optional[SafetyRatingSchema]
+
+
+def create_area_loader(data: snapshot.Snapshot
+                       ) -> DataLoader[str, snapshot.AreaInsights]:
+    """
+
+    Args:
+        data (snapshot.Snapshot): Snapshot the request is served from
+
+    Returns:
+        DataLoader[str, snapshot.AreaInsights]: Loader resolving every area
+        requested in one GraphQL document in a single batch against the same
+        snapshot
+
+    """
+
+    async def load_areas(areas: List[str]) -> List[snapshot.AreaInsights]:
+        return [data.get(area) for area in areas]
+
+    return DataLoader(load_fn=load_areas, cache_key_fn=snapshot.area_key)
+
+
+async def get_context() -> dict:
+    data = await snapshot.current_async()
+    return {"snapshot": data, "area_loader": create_area_loader(data)}
+
+
+async def area_loader(info: strawberry.Info
+                      ) -> DataLoader[str, snapshot.AreaInsights]:
+    context = info.context if isinstance(info.context, dict) else {}
+    if "area_loader" not in context:
+        context["area_loader"] = create_area_loader(
+            await snapshot.current_async())
+    return context["area_loader"]
+
+
+async def load_area(info: strawberry.Info, area: str) -> snapshot.AreaInsights:
+    return await (await area_loader(info)).load(area)
+
+
+def period_range(from_: Optional[str], to: Optional[str]
+                 ) -> Tuple[Optional[int], Optional[int]]:
+    """
+
+    Returns:
+        Tuple[Optional[int], Optional[int]]: First and last month of the
+        requested range, as months since year 0, None if open
+
+    """
+    start = columnar.parse_period(from_)[0] if from_ else None
+    end = columnar.parse_period(to)[1] if to else None
+    return start, end
+
+
+async def load_page(info: strawberry.Info, area: str, section: str,
+                    first: Optional[int], after: Optional[str],
+                    last: Optional[int], before: Optional[str]) -> Connection:
+    """
+
+    Returns:
+        Connection: Page of a snapshot section of the area, cursors are tied
+        to the snapshot version
+
+    """
+    insights = await load_area(info, area)
+    context = info.context if isinstance(info.context, dict) else {}
+    data = context.get("snapshot") or await snapshot.current_async()
+    return paginate(getattr(insights, section), data.version, first=first,
+                    after=after, last=last, before=before)
+
+
+async def load_series(info: strawberry.Info, area: str, table: str,
+                      from_: Optional[str], to: Optional[str]
+                      ) -> Tuple[snapshot.AreaInsights, columnar.SeriesTable,
+                                 slice]:
+    """
+
+    Returns:
+        Tuple[snapshot.AreaInsights, columnar.SeriesTable, slice]: The area,
+        the time-series table and its rows of the area within the range
+
+    """
+    start, end = period_range(from_, to)
+    insights = await load_area(info, area)
+    context = info.context if isinstance(info.context, dict) else {}
+    data = context.get("snapshot") or await snapshot.current_async()
+    if data.series is None:
+        raise ValueError("Time ranges are not available before the next refresh")
+
+    series = data.series.table(table)
+    if insights.code is None:
+        return insights, series, slice(0, 0)
+    return insights, series, series.rows(insights.code, start, end)
 
 
 @strawberry.type
 class Query:
 
     @strawberry.field
-    def demographics(self, area: str) -> List[DemographicSchema]:
+    async def demographics(self, info: strawberry.Info,
+                           area: str) -> List[DemographicSchema]:
         """
 
         Args:
@@ -104,98 +288,95 @@ class Query:
             List[DemographicSchema]: A list of `DemographicSchema` objects
 
         """
-        db = next(get_db())
-        demographics = db.query(DemographicsModel).filter(
-            func.lower(DemographicsModel.area) == func.lower(area)).all()
-
-        return demographics
+        return (await load_area(info, area)).demographics
 
     @strawberry.field
-    def unemployment_rate(self, area: str) -> List[EmploymentSchema]:
+    async def unemployment_rate(self, info: strawberry.Info, area: str,
+                                from_: FromArgument = None,
+                                to: ToArgument = None,
+                                granularity: Granularity = Granularity.YEAR
+                                ) -> List[EmploymentSchema]:
         """
 
         Args:
             area (str): The area for which traffic accidents data should be retrieved
+            from_ (Optional[str]): First period
+            to (Optional[str]): Last period
+            granularity (Granularity): Periods the monthly rates are averaged to
 
         Returns:
-            List[EmploymentSchema]: A list of `EmploymentSchema` objects
+            List[EmploymentSchema]: A list of `EmploymentSchema` objects (average by periods)
 
         """
-        db = next(get_db())
-        unemployment_data = db.query(EmploymentRate).filter(
-            EmploymentRate.area.ilike(area)).all()
-
-        yearly_data = {}
-        description = "average unemployment rate"
-
-        for i in unemployment_data:
-
-            year = i.timeframe[:4]
-            if not description:
-                description = i.description
-            if year not in yearly_data:
-                yearly_data[year] = []
-
-            yearly_data[year].append(i.value)
-
-        res = []
-        for year, val in yearly_data.items():
-            avg_yearly_rate = round(mean(val), 2)
-            res.append(
-                EmploymentSchema(area=area,
-                                 description=description,
-                                 timeframe=year,
-                                 value=avg_yearly_rate))
-
-        return res
+        if from_ is None and to is None and granularity == Granularity.YEAR:
+            return (await load_area(info, area)).unemployment_rate
+
+        insights, series, rows = await load_series(info, area, 'employment_rate',
+                                                   from_, to)
+        return [
+            snapshot.EmploymentRow(insights.area, timeframe,
+                                   "average unemployment rate", round(value, 2))
+            for timeframe, _, value in series.aggregate(rows, granularity.value,
+                                                        'mean')
+        ]
 
     @strawberry.field
-    def traffic_accidents(self, area: str) -> List[TrafficAccidentsSchema]:
+    async def traffic_accidents(self, info: strawberry.Info, area: str,
+                                from_: FromArgument = None,
+                                to: ToArgument = None
+                                ) -> List[TrafficAccidentsSchema]:
         """
 
         Args:
             area (str): The area for which traffic accidents data should be retrieved
+            from_ (Optional[str]): First year
+            to (Optional[str]): Last year
 
         Returns:
             List[TrafficAccidentsSchema]: A list of `TrafficAccidentsSchema` objects
 
         """
-        db = next(get_db())
-        data = db.query(TrafficAccidents).filter(
-            TrafficAccidents.area.ilike(area)).all()
+        if from_ is None and to is None:
+            return (await load_area(info, area)).traffic_accidents
 
-        return data
+        insights, series, rows = await load_series(info, area,
+                                                   'traffic_accidents', from_, to)
+        return [
+            snapshot.TrafficAccidentRow(insights.area, timeframe, description,
+                                        value)
+            for timeframe, description, value in series.records(rows)
+        ]
 
     @strawberry.field
-    def traffic_accidents_sum(self, area: str) -> List[TrafficAccidentsSchema]:
+    async def traffic_accidents_sum(self, info: strawberry.Info, area: str,
+                                    from_: FromArgument = None,
+                                    to: ToArgument = None
+                                    ) -> List[TrafficAccidentsSchema]:
         """
 
         Args:
             area (str): The area for which traffic accidents data should be retrieved
+            from_ (Optional[str]): First year
+            to (Optional[str]): Last year
 
         Returns:
             List[TrafficAccidentsSchema]: A list of `TrafficAccidentsSchema` objects (sum by years)
 
         """
-        db = next(get_db())
-        traffic_accidents = (db.query(
-            TrafficAccidents.area, TrafficAccidents.timeframe,
-            func.sum(TrafficAccidents.value)).filter(
-                TrafficAccidents.area.ilike(area)).group_by(TrafficAccidents.timeframe))
-
-        result = []
-        for a, timeframe, total in traffic_accidents:
-            result.append(
-                TrafficAccidentsSchema(
-                    description="Total traffic accidents per year",
-                    area=a,
-                    timeframe=timeframe,
-                    value=total))
-
-        return result
+        if from_ is None and to is None:
+            return (await load_area(info, area)).traffic_accidents_sum
+
+        insights, series, rows = await load_series(info, area,
+                                                   'traffic_accidents', from_, to)
+        return [
+            snapshot.TrafficAccidentRow(insights.area, timeframe,
+                                        "Total traffic accidents per year", total)
+            for timeframe, _, total in series.aggregate(rows, 12, 'sum')
+        ]
 
     @strawberry.field
-    def education(self, area: str) -> List[EducationSchema]:
+    async def education(self, info: strawberry.Info,
+                        area: str) -> List[EducationSchema]:
         """
 
         Args:
@@ -205,13 +386,11 @@ class Query:
             List[EducationSchema]: A list of `EducationSchema` objects
 
         """
-        db = next(get_db())
-        data = db.query(Education).filter(Education.area.ilike(area)).all()
-
-        return data
+        return (await load_area(info, area)).education
 
     @strawberry.field
-    def income(self, area: str) -> List[IncomeSchema]:
+    async def income(self, info: strawberry.Info,
+                     area: str) -> List[IncomeSchema]:
         """
 
         Args:
@@ -221,80 +400,170 @@ class Query:
             List[IncomeSchema]: A list of `IncomeSchema` objects
 
         """
+        return (await load_area(info, area)).income
 
-        db = next(get_db())
-        data = db.query(Income).filter(Income.area == area).all()
+    @strawberry.field
+    async def crimes(self, info: strawberry.Info, area: str,
+                     from_: FromArgument = None, to: ToArgument = None,
+                     granularity: Optional[Granularity] = None
+                     ) -> List[CrimeRateSchema]:
+        """
 
-        return data
+        Args:
+            area (str): The area for which crime data should be retrieved
+            from_ (Optional[str]): First period
+            to (Optional[str]): Last period
+            granularity (Optional[Granularity]): Periods the crimes are summed
+            by, one sum per crime type over the whole range if omitted
+
+        Returns:
+            List[CrimeRateSchema]: A list of `CrimeRateSchema` objects
+
+        """
+        if from_ is None and to is None and granularity is None:
+            return (await load_area(info, area)).crimes
+
+        insights, series, rows = await load_series(info, area, 'crime_rate',
+                                                   from_, to)
+        totals = series.aggregate(rows, granularity.value if granularity else None,
+                                  'sum', by_description=True)
+        return [
+            snapshot.CrimeRow(insights.area, description, total,
+                              timeframe=timeframe)
+            for timeframe, description, total in sorted(
+                totals, key=lambda total: (total[0] or '', total[1]))
+        ]
 
     @strawberry.field
-    def crimes(self, area: str) -> List[CrimeRateSchema]:
+    async def safety_rating(self, info: strawberry.Info,
+                            area: str) -> SafetyRatingSchema:
+        rating = (await load_area(info, area)).safety_rating
+        if rating is None:
+            raise ValueError(f"No safety rating available for {area}")
 
-        db = next(get_db())
-        q = (db.query(
-            CrimeRate.area, CrimeRate.description,
-            func.sum(CrimeRate.value)).filter(CrimeRate.area == area).group_by(
-                CrimeRate.description))
+        return rating._replace(area=area)
 
-        result = []
-        for a, b, c in q:
-            result.append(CrimeRateSchema(area=a, description=b, value=c))
+    @strawberry.field
+    async def safety_ratings(self, info: strawberry.Info,
+                             limit: Optional[int] = None
+                             ) -> List[SafetyRatingSchema]:
+        """
 
-        return result
+        Args:
+            limit (Optional[int]): Number of areas to return, all if omitted
+
+        Returns:
+            List[SafetyRatingSchema]: Safety ratings of every rated area,
+            safest first
+
+        """
+        context = info.context if isinstance(info.context, dict) else {}
+        data = context.get("snapshot") or await snapshot.current_async()
+        ranking = data.safety_ranking
+        return list(ranking if limit is None else ranking[:max(limit, 0)])
 
     @strawberry.field
-    def safety_rating(self, area: str) -> SafetyRatingSchema:
-
-        total_weighted_crime = 0
-        crime_weights = {
-            "Total of thefts 28:1-3": 1.0,
-            "Robbery 31:1-2 total": 2.5,
-            "Damage to property 35:1-3 total": 1.2,
-            "Offences against life total 21:1-3,34a:1": 5.0,
-            "Sexual crimes": 4.5,
-            "Crimes against public authority and public peace": 3.0,
-            "Endangerment of traffic safety, hit-and-run 23:1,11": 2.0,
-            "Aggravated endangerment of traffic safety 23:2": 2.8,
-            "Drunken driving 23:3-4 total": 1.5,
-            "Offences involving narcotics 50:1-4": 2.3
-        }
-
-        db = next(get_db())
-
-        population_data = (db.query(DemographicsModel).filter(
-            DemographicsModel.area == area.capitalize(),
-            DemographicsModel.description == 'Population 31 Dec').first())
-
-        crime_data = (db.query(
-            CrimeRate.area, CrimeRate.description,
-            func.sum(CrimeRate.value).label('total_crimes')).filter(
-                CrimeRate.area == area.capitalize()).group_by(CrimeRate.description))
-
-        for crime_record in crime_data:
-            crime_description = crime_record.description
-            crime_total = crime_record.total_crimes
-
-            matched_weight = None
-
-            for crime_type, weight in crime_weights.items():
-
-                if crime_type in crime_description:
-                    matched_weight = weight
-                    break
-
-            if matched_weight is not None:
-                total_weighted_crime += crime_total * matched_weight
-
-        crime_rate_per_100k = (total_weighted_crime /
-                               population_data.value) * 100_000
-        safety_rating = round(np.clip(200 * np.exp(-0.0002 * crime_rate_per_100k), 0,
-                                99.5), 2)
-
-        return SafetyRatingSchema(
-            area=area,
-            description="Safety Rating",
-            value=safety_rating,
-        )
+    async def ranking(self, info: strawberry.Info, metric: RankingMetric,
+                      description: Optional[str] = None,
+                      limit: Optional[int] = None,
+                      order: SortOrder = SortOrder.DESC
+                      ) -> List[RankingSchema]:
+        """
+
+        Args:
+            metric (RankingMetric): Section the areas are ranked by
+            description (Optional[str]): Value of the section, e.g. the income
+            type, may be omitted when the section has a single one
+            limit (Optional[int]): Number of areas to return, all if omitted
+            order (SortOrder): Highest values first by default
+
+        Returns:
+            List[RankingSchema]: Areas ordered by the value, unemployment by
+            the average of the latest year and crimes by the total over the
+            whole data
+
+        """
+        context = info.context if isinstance(info.context, dict) else {}
+        data = context.get("snapshot") or await snapshot.current_async()
+        return list(data.ranking(
+            metric.value, description, limit,
+            ascending=order == SortOrder.ASC))
+
+    @strawberry.field
+    async def demographics_connection(self, info: strawberry.Info, area: str,
+                                      first: Optional[int] = None,
+                                      after: Optional[str] = None,
+                                      last: Optional[int] = None,
+                                      before: Optional[str] = None
+                                      ) -> Connection[DemographicSchema]:
+        """
+
+        Args:
+            area (str): The area for which demographics data should be retrieved
+            first, after, last, before: Relay pagination arguments
+
+        Returns:
+            Connection[DemographicSchema]: One page of `DemographicSchema` objects
+
+        """
+        return await load_page(info, area, "demographics", first, after, last,
+                               before)
+
+    @strawberry.field
+    async def traffic_accidents_connection(self, info: strawberry.Info,
+                                           area: str,
+                                           first: Optional[int] = None,
+                                           after: Optional[str] = None,
+                                           last: Optional[int] = None,
+                                           before: Optional[str] = None
+                                           ) -> Connection[TrafficAccidentsSchema]:
+        """
+
+        Args:
+            area (str): The area for which traffic accidents data should be retrieved
+            first, after, last, before: Relay pagination arguments
+
+        Returns:
+            Connection[TrafficAccidentsSchema]: One page of `TrafficAccidentsSchema` objects
+
+        """
+        return await load_page(info, area, "traffic_accidents", first, after,
+                               last, before)
+
+    @strawberry.field
+    async def education_connection(self, info: strawberry.Info, area: str,
+                                   first: Optional[int] = None,
+                                   after: Optional[str] = None,
+                                   last: Optional[int] = None,
+                                   before: Optional[str] = None
+                                   ) -> Connection[EducationSchema]:
+        """
+
+        Args:
+            area (str): The area for which education data should be retrieved
+            first, after, last, before: Relay pagination arguments
+
+        Returns:
+            Connection[EducationSchema]: One page of `EducationSchema` objects
+
+        """
+        return await load_page(info, area, "education", first, after, last,
+                               before)
+
+    @strawberry.field
+    async def area_insights(self, info: strawberry.Info,
+                            areas: List[str]) -> List[AreaSchema]:
+        """
+
+        Args:
+            areas (List[str]): Names or codes of the areas to compare
+
+        Returns:
+            List[AreaSchema]: One `AreaSchema` object per requested area, in
+            the requested order
+
+        """
+        return await (await area_loader(info)).load_many(areas)
 
 
 schema = strawberry.Schema(query=Query)
@@ -0,0 +1,471 @@
+"""
+
+Module for the in-memory insight snapshot the GraphQL resolvers read from
+
+"""
+
+
+import asyncio
+import fcntl
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional, Tuple
+
+import columnar
+
+logger = logging.getLogger(__name__)
+
+# written by fetchers.snapshot_builder, older files are rebuilt on load
+SNAPSHOT_FORMAT = 4
+
+DB_DIR = os.getenv("ODFLOW_DB_DIR",
+                   os.path.join(os.path.dirname(__file__), '..', 'db'))
+DB_PATH = os.path.join(DB_DIR, 'combined_db.sqlite3')
+SNAPSHOT_PATH = os.path.join(DB_DIR, 'snapshot.pickle')
+
+# seconds between checks for a snapshot published by the refresh worker
+CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "5"))
+
+
+class DemographicRow(NamedTuple):
+    area: str
+    description: str
+    value: float
+
+
+class EmploymentRow(NamedTuple):
+    area: str
+    timeframe: str
+    description: str
+    value: float
+
+
+class TrafficAccidentRow(NamedTuple):
+    area: str
+    timeframe: str
+    description: str
+    value: int
+
+
+class EducationRow(NamedTuple):
+    area: str
+    age: str
+    description: str
+    value: int
+
+
+class IncomeRow(NamedTuple):
+    area: str
+    description: str
+    value: int
+
+
+class CrimeRow(NamedTuple):
+    area: str
+    description: str
+    value: float
+    timeframe: Optional[str] = None
+
+
+class SafetyContributionRow(NamedTuple):
+    category: str
+    weight: float
+    crimes: float
+    weighted_per_100k: float
+
+
+class SafetyRatingRow(NamedTuple):
+    area: str
+    description: str
+    value: float
+    rank: Optional[int] = None
+    contributions: Tuple[SafetyContributionRow, ...] = ()
+    code: Optional[str] = None
+
+
+class RankingRow(NamedTuple):
+    area: str
+    description: str
+    value: float
+    rank: int
+    code: Optional[str] = None
+    timeframe: Optional[str] = None
+
+
+# section to description to the rows in descending and in ascending order
+Rankings = Mapping[str, Mapping[str, Tuple[Tuple[RankingRow, ...],
+                                           Tuple[RankingRow, ...]]]]
+
+
+class AreaInsights(NamedTuple):
+    """
+    All precomputed data of a single area
+
+    Attributes:
+        area (str): Area label as stored in the database
+        demographics (tuple): Demographics rows
+        unemployment_rate (tuple): Yearly average unemployment rows
+        traffic_accidents (tuple): Traffic accident rows
+        traffic_accidents_sum (tuple): Traffic accidents summed by year
+        education (tuple): Education rows
+        income (tuple): Income rows
+        crimes (tuple): Crimes summed by description
+        safety_rating (SafetyRatingRow): Safety rating, None without population data
+        code (str): PxWeb area code, None for unknown areas
+    """
+    area: str
+    demographics: Tuple[DemographicRow, ...] = ()
+    unemployment_rate: Tuple[EmploymentRow, ...] = ()
+    traffic_accidents: Tuple[TrafficAccidentRow, ...] = ()
+    traffic_accidents_sum: Tuple[TrafficAccidentRow, ...] = ()
+    education: Tuple[EducationRow, ...] = ()
+    income: Tuple[IncomeRow, ...] = ()
+    crimes: Tuple[CrimeRow, ...] = ()
+    safety_rating: Optional[SafetyRatingRow] = None
+    code: Optional[str] = None
+
+
+ROW_TYPES = {
+    "demographics": DemographicRow,
+    "unemployment_rate": EmploymentRow,
+    "traffic_accidents": TrafficAccidentRow,
+    "traffic_accidents_sum": TrafficAccidentRow,
+    "education": EducationRow,
+    "income": IncomeRow,
+    "crimes": CrimeRow,
+}
+
+
+def area_key(area: str) -> str:
+    """
+
+    Args:
+        area (str): Area name or code
+
+    Returns:
+        str: Normalised form used for alias lookups
+
+    """
+    return re.sub(r'\s+', ' ', area).strip().casefold()
+
+
+def area_aliases(code: str, area: str) -> set[str]:
+    """
+
+    Args:
+        code (str): PxWeb area code, e.g. `KU091`
+        area (str): Area label, e.g. `Helsinki`
+
+    Returns:
+        set[str]: Normalised names the area can be requested with
+        (`helsinki`, `ku091`, `091`)
+
+    """
+    aliases = {area_key(area), area_key(code)}
+    if code.upper().startswith('KU'):
+        aliases.add(code[2:])
+    return aliases
+
+
+class Snapshot:
+    """
+    Immutable view over every area, swapped as a whole on refresh
+
+    Attributes:
+        areas (Mapping[str, AreaInsights]): Area code to area data
+        aliases (Mapping[str, str]): Normalised area name or code to area code
+        safety_ranking (Tuple[SafetyRatingRow, ...]): Safety ratings of every
+        ranked area, safest first, without the whole country
+        series (columnar.SeriesStore): Time-series tables of the same refresh
+        for range queries, None if the columnar store is missing
+        rankings (Rankings): Presorted values of every ranked section and
+        description across the areas
+    """
+
+    def __init__(self, areas: Mapping[str, AreaInsights], version: str,
+                 built_at: Optional[datetime],
+                 series: Optional[columnar.SeriesStore] = None,
+                 rankings: Optional[Rankings] = None):
+        self.areas = MappingProxyType(dict(areas))
+        self.aliases = MappingProxyType({
+            alias: code
+            for code, insights in areas.items()
+            for alias in area_aliases(code, insights.area)
+        })
+        self.safety_ranking = tuple(sorted(
+            (insights.safety_rating for insights in areas.values()
+             if insights.safety_rating is not None
+             and insights.safety_rating.rank is not None),
+            key=lambda rating: (rating.rank, rating.area)))
+        self.version = version
+        self.built_at = built_at
+        self.series = series
+        self.rankings = MappingProxyType(dict(rankings or {}))
+
+    def ranking(self, section: str, description: Optional[str] = None,
+                limit: Optional[int] = None, ascending: bool = False
+                ) -> Tuple[RankingRow, ...]:
+        """
+
+        Args:
+            section (str): Ranked section, e.g. `income`
+            description (Optional[str]): Ranked value of the section, may be
+            omitted when the section has a single one
+            limit (Optional[int]): Number of areas to return, all if omitted
+            ascending (bool): Lowest values first
+
+        Returns:
+            Tuple[RankingRow, ...]: Areas ordered by the value, ranked in the
+            requested order
+
+        """
+        descriptions = self.rankings.get(section, {})
+        if description is None and len(descriptions) == 1:
+            description = next(iter(descriptions))
+        if description not in descriptions:
+            raise ValueError(
+                f"Choose the {section} value to rank by, one of: "
+                f"{', '.join(sorted(descriptions)) or 'none available'}")
+
+        rows = descriptions[description][1 if ascending else 0]
+        return rows if limit is None else rows[:max(limit, 0)]
+
+    def resolve(self, area: str) -> Optional[str]:
+        """
+
+        Args:
+            area (str): Area name or code given by the client
+
+        Returns:
+            Optional[str]: Area code, None if the area is unknown
+
+        """
+        return self.aliases.get(area_key(area))
+
+    def get(self, area: str) -> AreaInsights:
+        """
+
+        Args:
+            area (str): Area name or code given by the client
+
+        Returns:
+            AreaInsights: Data of the area, empty if the area is unknown
+
+        """
+        code = self.resolve(area)
+        return self.areas[code] if code is not None else AreaInsights(area=area)
+
+
+EMPTY_SNAPSHOT = Snapshot({}, version="empty", built_at=None)
+
+_current = EMPTY_SNAPSHOT
+_loaded = False
+_lock = threading.Lock()
+_stamp: Optional[tuple] = None
+_checked_at = 0.0
+
+# loads are serialised by _lock anyway, one thread keeps them off the event loop
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+
+def _after_fork():
+    # threads and locks do not survive a fork, a worker forked from a
+    # preloaded parent gets its own; the loaded snapshot is shared as is
+    global _executor, _lock  # pylint: disable=W0603
+    _lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _to_insights(code: str, data: dict) -> AreaInsights:
+    sections = {
+        section: tuple(row_type(*row) for row in data[section])
+        for section, row_type in ROW_TYPES.items()
+    }
+    rating = None
+    if data["safety_rating"]:
+        area, description, value, rank, contributions = data["safety_rating"]
+        rating = SafetyRatingRow(
+            area, description, value, rank=rank, code=code,
+            contributions=tuple(SafetyContributionRow(*contribution)
+                                for contribution in contributions))
+    return AreaInsights(area=data["area"],
+                        code=code,
+                        safety_rating=rating,
+                        **sections)
+
+
+def _rebuild(path: str):
+    # pylint: disable=C0415
+    from fetchers.snapshot_builder import write_snapshot
+
+    # every worker finds the outdated snapshot at start, one rebuilds it and
+    # the others load its result
+    with open(f"{path}.lock", 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            payload = _read(path)
+            if payload is None or payload.get("format") != SNAPSHOT_FORMAT:
+                write_snapshot(DB_PATH, path)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _read(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logger.error("Unreadable snapshot %s: %s", path, e)
+        return None
+
+
+def _load_series() -> Optional[columnar.SeriesStore]:
+    try:
+        return columnar.SeriesStore.load()
+    except (OSError, ValueError) as e:
+        logger.error("Unreadable columnar store, time ranges unavailable: %s", e)
+        return None
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> Snapshot:
+    """
+
+    Reads the snapshot file, rebuilding it from the database when it is missing
+    or written in an older format
+
+    Args:
+        path (str): Snapshot file
+
+    Returns:
+        Snapshot: Loaded snapshot, empty if no data is available
+
+    """
+    payload = _read(path)
+
+    if (payload is None or payload.get("format") != SNAPSHOT_FORMAT) \
+            and os.path.exists(DB_PATH):
+        logger.info("Building snapshot from %s", DB_PATH)
+        _rebuild(path)
+        payload = _read(path)
+
+    if payload is None:
+        logger.warning("No snapshot or database available, serving empty data")
+        return EMPTY_SNAPSHOT
+
+    areas = {
+        code: _to_insights(code, data) for code, data in payload["areas"].items()
+    }
+    rankings = {
+        section: {
+            description: tuple(
+                tuple(RankingRow(area, description, value, rank, code=code,
+                                 timeframe=timeframe)
+                      for rank, code, area, value, timeframe in rows)
+                for rows in orders)
+            for description, orders in descriptions.items()
+        }
+        for section, descriptions in payload["rankings"].items()
+    }
+    logger.info("[✓] Loaded snapshot %s with %s areas", payload["version"],
+                len(areas))
+    return Snapshot(areas, version=payload["version"],
+                    built_at=payload["built_at"],
+                    series=_load_series(),
+                    rankings=rankings)
+
+
+def _file_stamp(path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _swap() -> Snapshot:
+    global _current, _loaded, _stamp  # pylint: disable=W0603
+    # stamped before reading, a file replaced during the load is picked up by
+    # the next check
+    _stamp = _file_stamp(SNAPSHOT_PATH)
+    _current = load_snapshot()
+    _loaded = True
+    return _current
+
+
+def _reload_if_published():
+    with _lock:
+        if _file_stamp(SNAPSHOT_PATH) != _stamp:
+            _swap()
+
+
+def published() -> bool:
+    """
+
+    Returns:
+        bool: True if another process replaced the snapshot file since it was
+        loaded, the file is checked at most once per CHECK_INTERVAL
+
+    """
+    global _checked_at  # pylint: disable=W0603
+    now = time.monotonic()
+    if now - _checked_at < CHECK_INTERVAL:
+        return False
+    _checked_at = now
+    return _file_stamp(SNAPSHOT_PATH) != _stamp
+
+
+def reload() -> Snapshot:
+    """
+
+    Loads the snapshot file and swaps it in, requests in flight keep reading
+    the previous one
+
+    Returns:
+        Snapshot: The new current snapshot
+
+    """
+    with _lock:
+        return _swap()
+
+
+def current() -> Snapshot:
+    """
+
+    Returns:
+        Snapshot: Snapshot currently served, loaded on first use. A snapshot
+        published by the refresh worker is loaded in the snapshot thread and
+        swapped in once ready, callers keep the previous one until then
+
+    """
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                return _swap()
+    if published():
+        _executor.submit(_reload_if_published)
+    return _current
+
+
+async def current_async() -> Snapshot:
+    """
+
+    Returns:
+        Snapshot: Snapshot currently served, the first load runs in the
+        snapshot thread instead of blocking the event loop
+
+    """
+    if _loaded:
+        return current()
+    return await asyncio.get_running_loop().run_in_executor(_executor, current)
@@ -0,0 +1,47 @@
+import itertools
+import json
+import os
+
+import pytest
+
+from fetchers.fetcher import BASE_DIR, query_cells, split_query
+
+CONFIGS = ['crime_rate.json', 'education.json', 'employment_rate.json',
+           'income.json']
+
+
+def config_query(name: str) -> dict:
+    with open(os.path.join(BASE_DIR, "config", name)) as file:
+        return json.load(file)['queryObj']
+
+
+def cell_keys(query: dict) -> list:
+    dimensions = [[(item['code'], value) for value in item['selection']['values']]
+                  for item in query['query']]
+    return [tuple(sorted(cell)) for cell in itertools.product(*dimensions)]
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+@pytest.mark.parametrize("max_cells", [7, 1000, 25_000])
+def test_pieces_cover_the_query_once(name, max_cells):
+    query = config_query(name)
+    pieces = split_query(query, max_cells)
+
+    keys = [key for piece in pieces for key in cell_keys(piece)]
+    assert len(keys) == len(set(keys))
+    assert set(keys) == set(cell_keys(query))
+    assert all(query_cells(piece) <= max_cells for piece in pieces)
+    # everything but the selections is kept, e.g. the response format
+    assert all(piece['response'] == query['response'] for piece in pieces)
+
+
+def test_query_within_the_limit_is_not_split():
+    query = config_query('income.json')
+    assert split_query(query, query_cells(query)) == [query]
+
+
+def test_query_of_unknown_size_is_not_split():
+    query = config_query('income.json')
+    query['query'][0]['selection'] = {"filter": "all", "values": ["*"]}
+    assert query_cells(query) is None
+    assert split_query(query, 1) == [query]
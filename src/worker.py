@@ -0,0 +1,154 @@
+"""
+
+Refresh worker, runs the fetch/parse/save cycle outside of the API processes
+
+The worker refreshes on a cron schedule and whenever the API queues a request
+through the trigger endpoint. Every refresh builds a new database next to the
+live one and publishes it with the snapshot, the API processes notice the new
+snapshot file and load it in the background.
+
+Usage:
+    python worker.py            run the scheduler and wait for triggers
+    python worker.py --once     refresh once and exit
+    python worker.py --replay   rebuild the database from the raw response
+                                archive without any request, and exit
+
+With METRICS_PORT set, the fetcher metrics are served on that port.
+
+"""
+
+
+import argparse
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Tuple
+
+import redis
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+from leader import LeaderElection
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REFRESH_QUEUE = "odflow:refresh"
+REFRESH_CRON = os.getenv("REFRESH_CRON", "0 3 * * *")
+LEADER_KEY = "odflow:scheduler:leader"
+LEADER_TTL = float(os.getenv("LEADER_TTL", "30"))
+
+# a trigger arriving while a refresh runs waits for it instead of overlapping
+_refresh_lock = threading.Lock()
+
+
+def refresh(full: bool = False, replay: bool = False):
+    with _refresh_lock:
+        try:
+            # imported here, the API imports this module for the scheduler
+            # and must not load the ingestion stack
+            from fetchers.fetcher import run_all_fetchers
+            run_all_fetchers(full=full, replay=replay)
+        except Exception as e:
+            logger.error("Refresh failed: %s", e)
+
+
+def request_refresh(client: redis.Redis, full: bool = False):
+    """
+
+    Queues a refresh for the worker
+
+    Args:
+        client (redis.Redis): Redis connection shared with the worker
+        full (bool): Refetch every table completely
+
+    """
+    client.rpush(REFRESH_QUEUE, "full" if full else "incremental")
+
+
+def start_scheduler(client: redis.Redis, job: Callable[[], None]
+                    ) -> Tuple[BackgroundScheduler, LeaderElection]:
+    """
+
+    Starts the refresh schedule, every process runs one but the job only
+    runs in the elected leader
+
+    Args:
+        client (redis.Redis): Redis connection the election runs on
+        job (Callable[[], None]): Refresh to run on schedule
+
+    Returns:
+        Tuple[BackgroundScheduler, LeaderElection]: Running scheduler and the
+        election, to be passed to stop_scheduler
+
+    """
+    election = LeaderElection(client, LEADER_KEY, ttl=LEADER_TTL)
+
+    def scheduled_job():
+        if election.is_leader:
+            job()
+        else:
+            logger.info("Scheduled refresh left to the leader")
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(election.heartbeat, 'interval', seconds=LEADER_TTL / 3,
+                      next_run_time=datetime.now())
+    scheduler.add_job(scheduled_job, CronTrigger.from_crontab(REFRESH_CRON),
+                      max_instances=1, coalesce=True)
+    scheduler.start()
+    return scheduler, election
+
+
+def stop_scheduler(scheduler: BackgroundScheduler, election: LeaderElection):
+    scheduler.shutdown(wait=False)
+    election.release()
+
+
+def serve(client: redis.Redis):
+    """
+
+    Runs the scheduled refresh and handles queued triggers until interrupted
+
+    Args:
+        client (redis.Redis): Redis connection the triggers are queued on
+
+    """
+    scheduler, election = start_scheduler(client, refresh)
+    logger.info("[✓] Refresh worker started, schedule '%s'", REFRESH_CRON)
+
+    try:
+        while True:
+            item = client.blpop([REFRESH_QUEUE], timeout=60)
+            if item is None:
+                continue
+            _, mode = item
+            logger.info("Refresh triggered (%s)", mode.decode())
+            refresh(full=mode == b"full")
+    finally:
+        stop_scheduler(scheduler, election)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument("--once", action="store_true",
+                        help="refresh once and exit")
+    parser.add_argument("--full", action="store_true",
+                        help="refetch every table completely")
+    parser.add_argument("--replay", action="store_true",
+                        help="rebuild from the raw response archive and exit")
+    args = parser.parse_args()
+
+    if args.once or args.replay:
+        refresh(full=args.full, replay=args.replay)
+        return
+
+    # the API does not see the fetcher metrics of this process
+    if os.getenv("METRICS_PORT"):
+        metrics.serve(int(os.getenv("METRICS_PORT")))
+    serve(redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()